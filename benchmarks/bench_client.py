@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+""" Benchmark the Twitter API client end to end against the local stand-in server.
+
+    Requests are signed, sent over HTTP to twitter.standin_server running in the same process,
+    verified and answered, so this measures the whole client path: signing, aiohttp, decoding
+    and the circuit breakers. Latency and error rates can be injected on the server side.
+
+    Usage: python3 benchmarks/bench_client.py [--requests 2000] [--concurrency 20]
+               [--latency 0.0] [--error-rate 0.0]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "discord-bot"))
+
+import aiohttp.web
+
+import utils.config
+import twitter.client
+import twitter.standin_server
+
+
+def _get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _write_config(port):
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({
+        "discord": {"client_id": 0, "token": "benchmark"},
+        "database": {"host": "localhost", "port": 6379},
+        "twitter": {
+            "consumer_key": "benchmark-key",
+            "consumer_secret": "benchmark-secret",
+            "access_token": "benchmark-token",
+            "access_token_secret": "benchmark-token-secret",
+            "api_base_url": "http://127.0.0.1:%d" % (port,),
+        },
+    }, config_file)
+    config_file.close()
+    return config_file.name
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+async def run(args, port):
+    server = twitter.standin_server.StandinTwitterServer(
+        utils.config.get().get_twitter_config(),
+        latency=args.latency, error_rate=args.error_rate, rate_limit=10 ** 9, seed=0)
+    runner = aiohttp.web.AppRunner(server.make_app())
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+
+    client = twitter.client.TwitterApiClient()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = []
+
+    async def one_request(index):
+        async with semaphore:
+            start = time.perf_counter()
+            if index % 2:
+                _, error_reason = await client.get_tweets_from_list(
+                    "owner", "list%d" % (index % 10,), max_count=200)
+            else:
+                _, error_reason = await client.get_tweets_from_screen_name(
+                    "account%d" % (index % 500,))
+            latencies.append(time.perf_counter() - start)
+            if error_reason:
+                errors.append(error_reason)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one_request(index) for index in range(args.requests)])
+    elapsed = time.perf_counter() - start
+
+    await client.session.close()
+    await runner.cleanup()
+
+    latencies.sort()
+    print("Requests:        %d in %.2fs (%.0f per second)" % (
+        args.requests, elapsed, args.requests / elapsed))
+    print("Latency:         p50 %.1fms, p90 %.1fms, p99 %.1fms" % tuple(
+        1000 * _percentile(latencies, fraction) for fraction in (0.5, 0.9, 0.99)))
+    print("Errors:          %d" % (len(errors),))
+    print("Server statuses: %s" % (dict(server.responses_by_status),))
+    for family, breaker in sorted(client.circuit_breakers.items()):
+        print("Breaker %-24s state %s, rejected %d, transitions %s" % (
+            family, breaker.state, breaker.rejected_count, dict(breaker.transition_counts)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    port = _get_free_port()
+    config_path = _write_config(port)
+    os.environ[utils.config.config_json_file_envvar] = config_path
+    try:
+        asyncio.get_event_loop().run_until_complete(run(args, port))
+    finally:
+        os.remove(config_path)
+
+
+if __name__ == "__main__":
+    main()
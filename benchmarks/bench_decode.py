@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+""" Benchmark decoding of Twitter timeline responses.
+
+    Compares materializing the full JSON document (as response.json() does) against the
+    field-projecting decoder in twitter.tweet, on payloads shaped like lists/statuses pages.
+
+    Usage: python3 benchmarks/bench_decode.py [--tweets 200] [--iterations 200]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "discord-bot"))
+
+import twitter.tweet
+
+
+def _make_user(index):
+    return {
+        "id": 1000000 + index,
+        "id_str": str(1000000 + index),
+        "name": "List Member %d" % (index,),
+        "screen_name": "member%d" % (index,),
+        "location": "Somewhere, Earth",
+        "description": "Streams games, tweets about streaming games. " * 3,
+        "url": "https://t.co/abcdefghij",
+        "entities": {
+            "url": {"urls": [{"url": "https://t.co/abcdefghij",
+                              "expanded_url": "https://twitch.tv/member%d" % (index,),
+                              "display_url": "twitch.tv/member%d" % (index,),
+                              "indices": [0, 23]}]},
+            "description": {"urls": []},
+        },
+        "protected": False,
+        "followers_count": 12345,
+        "friends_count": 678,
+        "listed_count": 90,
+        "created_at": "Wed Aug 27 13:08:45 +0000 2008",
+        "favourites_count": 4321,
+        "verified": False,
+        "statuses_count": 9876,
+        "lang": None,
+        "profile_background_color": "C0DEED",
+        "profile_image_url_https": "https://pbs.twimg.com/profile_images/1/abc_normal.jpg",
+        "profile_banner_url": "https://pbs.twimg.com/profile_banners/1/1500000000",
+        "profile_link_color": "1DA1F2",
+        "default_profile": True,
+        "following": False,
+        "follow_request_sent": False,
+        "notifications": False,
+    }
+
+
+def _make_tweet(tweet_id, index):
+    return {
+        "created_at": "Thu Apr 06 15:24:15 +0000 2017",
+        "id": tweet_id,
+        "id_str": str(tweet_id),
+        "text": "Going live now with some speedruns, come hang out! #speedrun https://t.co/xyz",
+        "truncated": False,
+        "entities": {
+            "hashtags": [{"text": "speedrun", "indices": [52, 61]}],
+            "symbols": [],
+            "user_mentions": [],
+            "urls": [{"url": "https://t.co/xyz",
+                      "expanded_url": "https://twitch.tv/member%d" % (index,),
+                      "display_url": "twitch.tv/member%d" % (index,),
+                      "indices": [62, 85]}],
+        },
+        "source": "<a href=\"https://about.twitter.com/products/tweetdeck\">TweetDeck</a>",
+        "in_reply_to_status_id": None,
+        "in_reply_to_user_id": None,
+        "in_reply_to_screen_name": None,
+        "user": _make_user(index),
+        "geo": None,
+        "coordinates": None,
+        "place": None,
+        "contributors": None,
+        "is_quote_status": False,
+        "retweet_count": 3,
+        "favorite_count": 17,
+        "favorited": False,
+        "retweeted": False,
+        "possibly_sensitive": False,
+        "lang": "en",
+    }
+
+
+def make_payload(tweet_count):
+    tweets = [_make_tweet(850000000000000000 - i, i % 150) for i in range(tweet_count)]
+    return json.dumps(tweets).encode("utf-8")
+
+
+def bench(name, decode, payload, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(payload)
+    elapsed = time.perf_counter() - start
+
+    # Measure the memory held by one decoded page
+    tracemalloc.start()
+    result = decode(payload)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    print("%-28s %8.1f us/page  %8.1f KiB retained" % (
+        name, elapsed / iterations * 1e6, retained / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    payload = make_payload(args.tweets)
+    print("payload: %d tweets, %.1f KiB (JSON parser: %s)" % (
+        args.tweets, len(payload) / 1024.0, twitter.tweet._loads.__module__))
+
+    bench("json.loads (full objects)", json.loads, payload, args.iterations)
+    bench("twitter.tweet.decode_response", twitter.tweet.decode_response, payload,
+          args.iterations)
+
+
+if __name__ == "__main__":
+    main()
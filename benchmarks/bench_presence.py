@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+""" Load harness for the on_member_update stream start check.
+
+    Replays a synthetic storm of member updates, shaped like a large guild's gateway traffic:
+    mostly status changes and role or nickname edits, some game changes and a few streams
+    starting and stopping. Compares the previous check, which scanned both members' activities
+    on every event, with StreamNotifications.is_member_starting_to_stream, and reports how many
+    events the fast path filtered.
+
+    Usage: python3 benchmarks/bench_presence.py [--events 500000] [--members 5000]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "discord-bot"))
+
+import discord
+
+import utils.config
+import utils.stream_notification
+
+
+class _FakeGuild(object):
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class _FakeMember(object):
+    __slots__ = ["id", "guild", "activities"]
+
+    def __init__(self, member_id, guild, activities):
+        self.id = member_id
+        self.guild = guild
+        self.activities = activities
+
+
+def _write_config():
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({
+        "discord": {"client_id": 0, "token": "benchmark"},
+        "database": {"host": "localhost", "port": 6379},
+    }, config_file)
+    config_file.close()
+    return config_file.name
+
+
+def _make_events(event_count, member_count, seed):
+    """ Return a list of (member_before, member_after) tuples and the number of stream starts. """
+    rng = random.Random(seed)
+    guild = _FakeGuild(1)
+    game = discord.Game(name="A Game")
+    members = [_FakeMember(index, guild, ()) for index in range(member_count)]
+    events = []
+    stream_starts = 0
+    for _ in range(event_count):
+        before = rng.choice(members)
+        roll = rng.random()
+        if roll < 0.35:
+            # Role or nickname change: discord.py copies the member, sharing activities
+            activities = before.activities
+        elif roll < 0.85:
+            # Status change: a new but equivalent activities tuple
+            activities = tuple(before.activities)
+        elif roll < 0.98:
+            # Game started or stopped
+            activities = () if before.activities else (game,)
+        else:
+            # Stream started or stopped
+            is_streaming = any(isinstance(x, discord.Streaming) for x in before.activities)
+            if is_streaming:
+                activities = ()
+            else:
+                activities = (discord.Streaming(name="Live", url="https://twitch.tv/m%d" % (
+                    before.id,)),)
+                stream_starts += 1
+        after = _FakeMember(before.id, guild, activities)
+        members[before.id] = after
+        events.append((before, after))
+    return events, stream_starts
+
+
+def _legacy_is_member_starting_to_stream(logger, member_before, member_after):
+    """ The previous implementation. """
+    logger.debug('In utils.stream_notification.StreamNotifications.isMemberStartingToStream')
+    try:
+        is_streaming = any((isinstance(x, discord.Streaming) for x in member_after.activities))
+    except Exception:
+        return False
+
+    was_streaming = False
+    try:
+        was_streaming = any((isinstance(x, discord.Streaming) for x in member_before.activities))
+    except Exception:
+        pass
+
+    return was_streaming == False and is_streaming == True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=500000)
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config_path = _write_config()
+    os.environ[utils.config.config_json_file_envvar] = config_path
+    try:
+        run(args)
+    finally:
+        os.remove(config_path)
+
+
+def run(args):
+    events, stream_starts = _make_events(args.events, args.members, args.seed)
+    logger = logging.getLogger("bench_presence")
+
+    start = time.perf_counter()
+    legacy_starts = sum(1 for before, after in events
+                        if _legacy_is_member_starting_to_stream(logger, before, after))
+    legacy_time = time.perf_counter() - start
+
+    stream_notifications = utils.stream_notification.StreamNotifications(None)
+    check = stream_notifications.is_member_starting_to_stream
+    start = time.perf_counter()
+    new_starts = sum(1 for before, after in events if check(before, after))
+    new_time = time.perf_counter() - start
+
+    print("Events:            %d (%d stream starts generated)" % (len(events), stream_starts))
+    print("Previous check:    %.3fs, %.0f events/s, %d starts detected" % (
+        legacy_time, len(events) / legacy_time, legacy_starts))
+    print("Fast path check:   %.3fs, %.0f events/s, %d starts detected" % (
+        new_time, len(events) / new_time, new_starts))
+    print("Filtered events:   %d of %d (%.1f%%)" % (
+        stream_notifications.filtered_member_update_count,
+        stream_notifications.member_update_count,
+        100.0 * stream_notifications.filtered_member_update_count
+        / stream_notifications.member_update_count))
+
+
+if __name__ == "__main__":
+    main()
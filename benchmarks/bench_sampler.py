@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+""" Micro-benchmark for TwitterListSampler scoring and weight decay on large lists.
+
+    Usage: python3 benchmarks/bench_sampler.py [--members 10000] [--rounds 2000]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "discord-bot"))
+
+from twitter.sampler import TwitterListSampler
+from twitter.tweet import Tweet
+
+
+class _FakeApiClient(object):
+    """ Serves a steady stream of tweets from a list with a fixed number of members. """
+    def __init__(self, member_count, tweets_per_round):
+        self.member_count = member_count
+        self.tweets_per_round = tweets_per_round
+        self.next_tweet_id = 1
+
+    def _make_tweet(self):
+        self.next_tweet_id += 1
+        return Tweet(self.next_tweet_id, "member%d" % (random.randrange(self.member_count),))
+
+    async def get_tweets_from_list(self, owner_screen_name, list_slug, max_count=1, since_id=None):
+        tweets = [self._make_tweet() for _ in range(min(max_count, self.tweets_per_round))]
+        tweets.reverse()
+        return (tweets, None)
+
+    async def get_list_data(self, list_owner, list_slug):
+        return ({"member_count": self.member_count}, None)
+
+
+def _legacy_adjust_weights(screen_name_weight_map, shown_screen_names, k):
+    """ The previous implementation: rebuild the whole weight map every round. """
+    for screen_name in shown_screen_names:
+        screen_name_weight_map[screen_name] = 0.0
+    new_screen_name_weight_map = {}
+    for screen_name, weight in screen_name_weight_map.items():
+        new_weight = weight + k
+        if new_weight < 1.0:
+            new_screen_name_weight_map[screen_name] = new_weight
+    return new_screen_name_weight_map
+
+
+def bench_legacy(member_count, rounds):
+    # Start from a fully populated map, as seen on a list where everyone has been shown
+    k = 1.0 / member_count
+    weight_map = {"member%d" % (i,): i * k for i in range(member_count)}
+    start = time.perf_counter()
+    for i in range(rounds):
+        weight_map = _legacy_adjust_weights(
+            weight_map, ["member%d" % (random.randrange(member_count),)], k)
+    return time.perf_counter() - start
+
+
+def bench_sampler(member_count, rounds, tweets_per_round):
+    api_client = _FakeApiClient(member_count, tweets_per_round)
+    sampler = TwitterListSampler(api_client)
+
+    async def run():
+        # Warm up so the weight map holds an entry for (almost) every member
+        for _ in range(member_count):
+            await sampler._adjust_weights("owner", "slug", [(api_client._make_tweet(), 1.0)])
+        start = time.perf_counter()
+        for _ in range(rounds):
+            results, error_reason = await sampler.get_tweets("owner", "slug")
+            assert error_reason is None and results
+        return time.perf_counter() - start
+
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--tweets-per-round", type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(0)
+    legacy = bench_legacy(args.members, args.rounds)
+    print("legacy weight decay:   %8.1f us/round" % (legacy / args.rounds * 1e6,))
+
+    current = bench_sampler(args.members, args.rounds, args.tweets_per_round)
+    print("sampler full round:    %8.1f us/round (fetch, score, top-k, decay)" % (
+        current / args.rounds * 1e6,))
+
+
+if __name__ == "__main__":
+    main()
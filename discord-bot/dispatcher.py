@@ -1,17 +1,25 @@
 """ Class for dispatching incoming messages to appropriate handlers.
 """
 import logging
-
-import opentracing
+import time
 
 import utils.config
 import utils.database
 import utils.guild
+import utils.metrics
+import utils.overload
+
+import handlers.handler_base
 
 # Command handlers
 from handlers.guild_admin import GuildAdminHandler
 from handlers.twitter import TwitterHandler
 
+dispatch_seconds = utils.metrics.histogram(
+    "discord_bot_dispatch_seconds",
+    "Time taken to dispatch messages, by handler and outcome",
+    ("handler", "outcome"))
+
 class Dispatcher(object):
     """ Accepts messages and possibly dispatches them to an appropriate
         handler instance.
@@ -43,70 +51,97 @@ class Dispatcher(object):
 
     async def dispatch(self, context, parent_span):
         """ Try to dispatch message to an appropriate handler instance. """
-        with opentracing.tracer.start_span(
-                "Dispatcher.dispatch", child_of=parent_span) as dispatch_span:
+        start_time = time.perf_counter()
+        # Updated by _dispatch as it goes. Exceptions from handlers leave the outcome as "error".
+        labels = {"handler": "none", "outcome": "error"}
+        try:
+            # Use the parent's tracer, which on_message swaps for a no-op one while overloaded
+            with parent_span.tracer.start_span(
+                    "Dispatcher.dispatch", child_of=parent_span) as dispatch_span:
+                await self._dispatch(context, dispatch_span, labels)
+        finally:
+            dispatch_seconds.labels(labels["handler"], labels["outcome"]).observe(
+                time.perf_counter() - start_time)
+
+    async def _dispatch(self, context, dispatch_span, labels):
+        """ Dispatch a message, recording the handler and outcome in labels. """
+        # Ignore messages outside of guilds.
+        if not context.message.guild:
+            labels["outcome"] = "not_in_guild"
+            await context.send(
+                    "Please issue commands in the Discord guild they're meant for!")
+            return
 
-            # Ignore messages outside of guilds.
-            if not context.message.guild:
-                await context.message.channel.send(
-                        "Please issue commands in the Discord guild they're meant for!")
-                return
+        # Ignore messages without our prefix
+        prefix = context.guild_data.get_command_prefix()
+        if not context.message.content.startswith(prefix):
+            labels["outcome"] = "no_prefix"
+            return
 
-            # Ignore messages without our prefix
-            prefix = context.guild_data.get_command_prefix()
-            if not context.message.content.startswith(prefix):
-                return
+        # Strip the prefix out for ease of parsing
+        context.args = context.message.content.lstrip(prefix).split()
 
-            # Strip the prefix out for ease of parsing
-            context.args = context.message.content.lstrip(prefix).split()
+        is_help_request = bool("help" in context.args[:2])
 
-            is_help_request = bool("help" in context.args[:2])
+        # Determine what the real command is if there is one (that is not "help")
+        try:
+            real_command = [arg for arg in context.args[:2] if arg != "help"][0]
+        except IndexError:
+            real_command = None
 
-            # Determine what the real command is if there is one (that is not "help")
-            try:
-                real_command = [arg for arg in context.args[:2] if arg != "help"][0]
-            except IndexError:
-                real_command = None
+        if not real_command:
+            labels["outcome"] = "generic_help" if is_help_request else "no_command"
+            if is_help_request:
+                await self._generic_help(context, dispatch_span)
+            # If it's not a help request, don't respond
+            return
 
-            if not real_command:
-                if is_help_request:
-                    await self._generic_help(context, dispatch_span)
-                # If it's not a help request, don't respond
-                return
+        # We will dispatch this to a handler
+        handler = self._command_handler_map.get(real_command)
 
-            # We will dispatch this to a handler
-            handler = self._command_handler_map.get(real_command)
+        if not handler:
+            # Might be a hidden handler
+            handler = self._hidden_command_handler_map.get(real_command)
 
-            if not handler:
-                # Might be a hidden handler
-                handler = self._hidden_command_handler_map.get(real_command)
+        if not handler:
+            self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
+                              "Can't find handler for command")
+            labels["outcome"] = "no_handler"
+            await self._generic_help(context, dispatch_span)
+            return
 
-            if not handler:
-                self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
-                                  "Can't find handler for command")
-                await self._generic_help(context, dispatch_span)
-                return
+        # Is this user allowed to use this command?
+        labels["handler"] = type(handler).__name__
+        if not handler.permissions(context):
+            self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
+                          "Failed permissions check, ignoring command")
+            labels["outcome"] = "denied"
+            return
 
-            # Is this user allowed to use this command?
-            if not handler.permissions(context):
-                self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
-                              "Failed permissions check, ignoring command")
-                return
+        # While badly overloaded, only admin and officer commands are served
+        if handler.permission_level == handlers.handler_base.permissions_member \
+                and utils.overload.get().is_scheduler_paused():
+            self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
+                              "Overloaded, ignoring member command")
+            labels["outcome"] = "shed"
+            return
 
-            # We have a handler and the user has permission. Dispatch!
-            if is_help_request:
-                self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
-                                  "Dispatching help command to handler")
-                await handler.help(context)
+        # We have a handler and the user has permission. Dispatch!
+        if is_help_request:
+            self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
+                              "Dispatching help command to handler")
+            await handler.help(context)
+            labels["outcome"] = "help"
 
-            else:
-                self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
-                                  "Dispatching real command to handler")
-                await handler.apply(context)
+        else:
+            self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
+                              "Dispatching real command to handler")
+            await handler.apply(context)
+            labels["outcome"] = "applied"
 
     async def _generic_help(self, context, parent_span):
         """ Dispatch a help command. """
-        with opentracing.tracer.start_span(
+        with parent_span.tracer.start_span(
                 "Dispatcher._generic_help", child_of=parent_span):
 
             self.logger.debug("utils.dispatcher.Dispatcher.dispatch: "
@@ -116,7 +151,7 @@ class Dispatcher(object):
             if not context.guild_data.user_has_member_permissions(context.message.author):
                 return
 
-            await context.message.channel.send(
+            await context.send(
                 "Supported commands (in guilds only): %s" % (
                     ", ".join("`!%s`" % command for command in self._command_handler_map)))
             return
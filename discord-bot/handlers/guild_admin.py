@@ -2,6 +2,10 @@
 '''
 from handlers import handler_base
 
+import utils.memory
+import utils.misc
+import utils.profiler
+
 class GuildAdminHandler(handler_base.HandlerBase):
     """ Implement some commands for guild admins to configure the bot with. """
     commands = ['admin']
@@ -14,7 +18,10 @@ class GuildAdminHandler(handler_base.HandlerBase):
             "prefix": "`!admin prefix <prefix>`",
             "role": "`!admin role (member|officer) <rolename>`",
             "twitch": "`!admin twitch channel <channelname>`",
-            "twitter": "`!admin twitter (channel|listscreenname|listslug) <value>`"
+            "twitter": "`!admin twitter (channel|listscreenname|listslug) <value>`",
+            "webhook": "`!admin webhook (on|off)`",
+            "profile": "`!admin profile <seconds>`",
+            "memory": "`!admin memory [snapshot|stop]`"
         }
         self._basic_usage_msg = 'Usage:\n' + '\n'.join(self._subcommand_usage_msg_map.values())
 
@@ -28,7 +35,7 @@ class GuildAdminHandler(handler_base.HandlerBase):
         # !admin prefix <prefix>
         if command == 'prefix':
             if len(args) > 3:
-                await context.message.channel.send(
+                await context.send(
                         "Usage: `!admin prefix <prefix>`")
                 return
 
@@ -39,12 +46,12 @@ class GuildAdminHandler(handler_base.HandlerBase):
                 return
 
             if len(prefix) != 1:
-                await context.message.channel.send(
+                await context.send(
                         "Command prefix must be a single character!")
                 return
 
             context.guild_data.set_command_prefix(prefix)
-            await context.message.channel.send(
+            await context.send(
                     "Command prefix updated!")
 
         # Commands to set the permission role names.
@@ -57,18 +64,18 @@ class GuildAdminHandler(handler_base.HandlerBase):
                 role_type, role_name = None, None
 
             if not role_name or role_type not in ('member', 'officer'):
-                await context.message.channel.send(
+                await context.send(
                         "Usage: `!admin role (member|officer) <channel_name>`")
                 return
 
             if role_type == 'member':
                 context.guild_data.set_member_role(role_name)
-                await context.message.channel.send(
+                await context.send(
                         "Member role name updated!")
 
             elif role_type == "officer":
                 context.guild_data.set_officer_role(role_name)
-                await context.message.channel.send(
+                await context.send(
                         "Officer role name updated!")
 
         # Commands to set data for Twitch
@@ -80,12 +87,12 @@ class GuildAdminHandler(handler_base.HandlerBase):
                 subcommand, channel_name = None, None
 
             if not channel_name or subcommand != 'channel':
-                await context.message.channel.send(
+                await context.send(
                         "Usage: `!admin twitch channel <channel_name>`")
                 return
 
             context.guild_data.set_twitch_data('channel', channel_name)
-            await context.message.channel.send(
+            await context.send(
                 'Twitch notifications will be sent to `%s`!' % (channel_name,))
 
         # Commands to set data for Twitter
@@ -99,10 +106,120 @@ class GuildAdminHandler(handler_base.HandlerBase):
                 key, value = None, None
 
             if not value or key not in ('channel', 'listscreenname', 'listslug'):
-                await context.message.channel.send(
+                await context.send(
                         "Usage: `!admin twitter (channel|listscreenname|listslug) <value>`")
                 return
 
             context.guild_data.set_twitter_data(key, value)
-            await context.message.channel.send(
+            await context.send(
                 'Twitter list key %s sent to value `%s`!' % (key, value))
+
+        # Command to send scheduled Tweets and stream notifications through webhooks
+        # !admin webhook on
+        # !admin webhook off
+        elif command == 'webhook':
+            try:
+                setting, = args[2:]
+            except ValueError:
+                setting = None
+
+            if setting not in ('on', 'off'):
+                await context.send(
+                        "Usage: `!admin webhook (on|off)`")
+                return
+
+            context.guild_data.set_webhook_posting_enabled(setting == 'on')
+            if setting == 'on':
+                await context.send(
+                    "Tweets and stream notifications will be sent through webhooks!"
+                    " The bot needs the Manage Webhooks permission for this.")
+            else:
+                await context.send(
+                    "Tweets and stream notifications will be sent by the bot!")
+
+        # Command to profile the bot for a while, sending the results to the owner
+        # !admin profile <seconds>
+        elif command == 'profile':
+            if not utils.profiler.is_enabled():
+                await context.send(
+                        "Profiling isn't enabled, ask the bot's operator to configure it!")
+                return
+
+            try:
+                seconds, = args[2:]
+                seconds = float(seconds)
+            except ValueError:
+                seconds = None
+
+            max_seconds = utils.profiler.get_max_seconds()
+            if not seconds or not 0 < seconds <= max_seconds:
+                await context.send(
+                        "Usage: `!admin profile <seconds>`, for up to %s seconds" % (
+                            max_seconds,))
+                return
+
+            cooldown_remaining = utils.profiler.get_cooldown_remaining()
+            if cooldown_remaining:
+                await context.send(
+                        "A profile was taken recently, try again in %d seconds!" % (
+                            cooldown_remaining + 1,))
+                return
+
+            await context.send(
+                "Profiling for %s seconds, I'll send you the results!" % (seconds,))
+            result, error_reason = await utils.profiler.profile_event_loop(
+                seconds, name_prefix="profile-%s" % (context.message.guild.id,))
+            if error_reason:
+                await context.send_to_author(error_reason)
+                return
+
+            summary, path = result
+            await context.send_to_author(
+                "Profile saved to `%s`. Top functions by cumulative time:" % (path,))
+            for message in utils.misc.split_into_code_blocks(summary):
+                await context.send_to_author(message)
+
+        # Commands to report memory usage to the owner
+        # !admin memory
+        # !admin memory snapshot
+        # !admin memory stop
+        elif command == 'memory':
+            if self.config.get_memory_config() is None:
+                await context.send(
+                        "Memory reports aren't enabled, ask the bot's operator to configure them!")
+                return
+
+            subcommand = args[2] if len(args) == 3 else None
+            if len(args) > 3:
+                subcommand = 'invalid'
+
+            memory_monitor = utils.memory.get()
+            baseline_name = "guild:%s" % (context.message.guild.id,)
+            if subcommand is None:
+                report = await memory_monitor.format_cache_report()
+
+            elif subcommand == 'snapshot':
+                report = await memory_monitor.take_snapshot_diff(baseline_name)
+                if report is None:
+                    await context.send_to_author(
+                        "Took a snapshot of memory allocations. Run `!admin memory snapshot`"
+                        " again later to see what's changed, and `!admin memory stop` when"
+                        " you're done, since tracing allocations slows the bot down.")
+                    return
+
+            elif subcommand == 'stop':
+                if memory_monitor.stop_tracing(baseline_name):
+                    await context.send_to_author("Stopped tracing memory allocations!")
+                else:
+                    await context.send_to_author(
+                        "Forgot this server's snapshot. Memory allocations are still being"
+                        " traced for other snapshots.")
+                return
+
+            else:
+                await context.send(
+                        "Usage: `!admin memory [snapshot|stop]`")
+                return
+
+            for message in utils.misc.split_into_code_blocks(report):
+                await context.send_to_author(message)
@@ -4,11 +4,17 @@ import logging
 
 import utils.config
 import utils.guild
+import utils.metrics
 
 permissions_member = 'member'
 permissions_officer = 'officer'
 permissions_owner = 'owner'
 
+permission_checks = utils.metrics.counter(
+    "discord_bot_permission_checks_total",
+    "Command permission checks, by required permission level and result",
+    ("level", "result"))
+
 class HandlerBase(object):
     """ Base class for command handlers. """
     commands = []  # List of commands which the dispatcher shall register to be
@@ -33,23 +39,24 @@ class HandlerBase(object):
         """
         # This bot's commands are usable in guilds only.
         if not context.guild_data:
+            permission_checks.labels(self.permission_level, "no_guild").inc()
             return False
 
         # Perform the appropriate permission check based on the value of self.permission_level.
+        allowed = False
         if self.permission_level == permissions_member:
-            if context.guild_data.user_has_member_permissions(context.message.author):
-                return True
+            allowed = context.guild_data.user_has_member_permissions(context.message.author)
 
         elif self.permission_level == permissions_officer:
-            if context.guild_data.user_has_officer_permissions(context.message.author):
-                return True
+            allowed = context.guild_data.user_has_officer_permissions(context.message.author)
 
         elif self.permission_level == permissions_owner:
-            if context.guild_data.user_is_guild_owner(context.message.author):
-                return True
+            allowed = context.guild_data.user_is_guild_owner(context.message.author)
 
         # Otherwise: refuse permissions.
-        return False
+        permission_checks.labels(
+            self.permission_level, "allowed" if allowed else "denied").inc()
+        return bool(allowed)
 
     async def apply(self, context):
         """ Override for each implementation of HandlerBase.
@@ -66,9 +73,9 @@ class HandlerBase(object):
 
         # Route officer and guild admin commands to private messages to avoid confusing others.
         if self.permission_level == permissions_member:
-            target_channel = context.message.channel
+            send = context.send
         else:
-            target_channel = context.message.author
+            send = context.send_to_author
 
         try:
             # Account for the fact we tolerate the "help" command being in variable positions
@@ -94,8 +101,8 @@ class HandlerBase(object):
 
         # Some people just want to watch the world suffer
         if not help_text:
-            await target_channel.send(
+            await send(
                 "Sorry, this command does not have a help feature yet!")
             return
 
-        await target_channel.send(help_text)
+        await send(help_text)
@@ -2,11 +2,17 @@
     themselves. The role names are configured separately by the guild admin.
 '''
 
+import asyncio
+
 import discord
 
 from handlers import handler_base
-from twitter.client import TwitterApiClient, getTwitterListUrl
-from twitter.sampler import TwitterListSampler
+import twitter.client
+from twitter.client import getTwitterListUrl
+
+max_message_length = 2000
+max_lasttweet_screen_names = 10
+max_concurrent_lasttweet_requests = 4
 
 class TwitterHandler(handler_base.HandlerBase):
     """ Provides commands for members to interact with Twitter features of the bot. """
@@ -17,15 +23,17 @@ class TwitterHandler(handler_base.HandlerBase):
 
     def __init__(self, *args, **kwargs):
         super(TwitterHandler, self).__init__(*args, **kwargs)
-        self._api_client = TwitterApiClient()
-        self._list_sampler = TwitterListSampler(self._api_client)
+        # Share the Twitter client and sampler with the scheduler and prefetcher, so commands
+        # can be answered from their caches
+        self._api_client = twitter.client.api_client
+        self._list_sampler = twitter.client.list_sampler
 
         self._subcommand_usage_msg_map = {
             "list": [
-                "`!twitter list (add|remove) <screen_name>`",
+                "`!twitter list (add|remove) <screen_name> [<screen_name> ...]`",
                 "`!twitter list url`"
             ],
-            "lasttweet": '`!twitter lasttweet [screen_name]`'
+            "lasttweet": '`!twitter lasttweet [<screen_name> ...]`'
         }
         basic_usage_msg_list = []
         for item in self._subcommand_usage_msg_map.values():
@@ -45,27 +53,33 @@ class TwitterHandler(handler_base.HandlerBase):
 
             self.logger.debug("Handling !twitter command with args: %r", args)
 
-            # !twitter lasttweet [screen_name]
+            # !twitter lasttweet [<screen_name> ...]
             if args[1] == 'lasttweet':
-                num_args = len(args)
-                if num_args < 2 or num_args > 3:
+                # Guard against empty strings
+                screen_names = [screen_name for screen_name in args[2:] if screen_name]
+                if len(args) > 2 and not screen_names:
                     await self.help(context)
                     return
 
-                # !twitter lasttweet <screen_name>
-                # We'll return the result for this screen name
-                if num_args == 3:
-                    screen_name = args[2]
-
-                    # Guard against empty strings
-                    if not screen_name:
-                        await self.help(context)
-                        return
+                if len(screen_names) > max_lasttweet_screen_names:
+                    await context.send(
+                        "Please ask for at most %d accounts at a time!" % (
+                            max_lasttweet_screen_names,))
+                    return
 
-                    # Try to fetch a list of Tweets from the Twitter API
-                    tweet_list, error_reason = \
-                            await self._api_client.get_tweet_urls_from_screen_name(
-                                screen_name, max_count=1)
+                # !twitter lasttweet <screen_name> [<screen_name> ...]
+                # We'll return the result for each screen name
+                if screen_names:
+                    results = await self._get_last_tweets_from_screen_names(screen_names)
+                    if len(results) == 1:
+                        response = self._format_last_tweet_response(*results[0])
+                    else:
+                        response = "\n".join(
+                            "`%s`: %s" % (screen_name,
+                                          self._format_last_tweet_response(*result))
+                            for screen_name, result in zip(screen_names, results))
+                        if len(response) > max_message_length:
+                            response = response[:max_message_length - 3] + "..."
 
                 # !twitter lasttweet
                 # We'll return the result for a configured list if there is one
@@ -74,33 +88,24 @@ class TwitterHandler(handler_base.HandlerBase):
                     list_slug = context.guild_data.get_twitter_data("listslug")
                     if not list_owner or not list_slug:
                         self.logger.error("Could not get Twitter list data from database!")
-                        await context.message.channel.send(
+                        await context.send(
                             "There was a database lookup error! Blame the owner!")
                         return
 
-                    # Try to fetch a list of Tweets from the Twitter API
-                    tweet_list, error_reason = await self._api_client.get_tweet_urls_from_list(
-                            list_owner, list_slug, max_count=1)
-
-                # All error scenarios
-                if tweet_list is None:
-                    response = "Sorry, the request didn't work!"
-                    if error_reason:
-                        error_reason = "Reason: `%s`" % (error_reason,)
-                        response = " ".join([response, error_reason])
-
-                # "No new tweets" scenario: iterable is empty but is not None
-                elif not tweet_list:
-                    response = "No new tweets since last time, sorry!"
-
-                # Success scenario
-                else:
-                    response = tweet_list[0]
+                    # Use the latest prefetched Tweet if there is one, otherwise try to fetch a
+                    # list of Tweets from the Twitter API
+                    latest_tweet = self._list_sampler.get_latest_tweet(list_owner, list_slug)
+                    if latest_tweet:
+                        tweet_list, error_reason = [latest_tweet.url], None
+                    else:
+                        tweet_list, error_reason = await self._api_client.get_tweet_urls_from_list(
+                                list_owner, list_slug, max_count=1, use_cache=True)
+                    response = self._format_last_tweet_response(tweet_list, error_reason)
 
-                await context.message.channel.send(response)
+                await context.send(response)
 
-            # !twitter list add <screen_name>
-            # !twitter list remove <screen_name>
+            # !twitter list add <screen_name> [<screen_name> ...]
+            # !twitter list remove <screen_name> [<screen_name> ...]
             # !twitter list url
             elif args[1] == 'list':
                 try:
@@ -117,65 +122,31 @@ class TwitterHandler(handler_base.HandlerBase):
                 list_slug = context.guild_data.get_twitter_data("listslug")
                 if not list_owner or not list_slug:
                     self.logger.error("Could not get Twitter list data from database!")
-                    await context.message.channel.send(
+                    await context.send(
                         "There was a database lookup error! "
                         "The guild admin needs to set the data.")
                     return
 
                 if action == "url":
                     url = getTwitterListUrl(list_owner, list_slug)
-                    await context.message.channel.send(url)
+                    await context.send(url)
 
-                elif action == "add":
-                    if len(args) != 4:
-                        await self.help(context)
-                        return
-
-                    screen_name = args[3] # any twitter screen name, case doesn't matter
+                elif action in ("add", "remove"):
+                    # any twitter screen names, case doesn't matter
                     # Don't allow empty strings as parameters
-                    if not screen_name:
+                    screen_names = [screen_name for screen_name in args[3:] if screen_name]
+                    if not screen_names:
                         await self.help(context)
                         return
 
-                    success, error_reason = await self._api_client.add_user_to_list(
-                            list_owner, list_slug, screen_name)
-
-                    if success:
-                        response = "Added the Twitter account `%s` to my follow list!" % (
-                                screen_name,)
+                    if len(screen_names) == 1:
+                        response = await self._apply_list_action(
+                                action, list_owner, list_slug, screen_names[0])
                     else:
-                        response = "Sorry, the request didn't work!"
-                        self.logger.debug("error_reason: %r", error_reason)
-                        if error_reason:
-                            error_reason = "Reason: `%s`" % (error_reason,)
-                            response = " ".join([response, error_reason])
+                        response = await self._apply_bulk_list_action(
+                                action, list_owner, list_slug, screen_names)
 
-                    await context.message.channel.send(response)
-
-                elif action == "remove":
-                    if len(args) != 4:
-                        await self.help(context)
-                        return
-
-                    screen_name = args[3] # any twitter screen name, case doesn't matter
-                    # Don't allow empty strings as parameters
-                    if not screen_name:
-                        await self.help(context)
-                        return
-
-                    success, error_reason = await self._api_client.remove_user_from_list(
-                            list_owner, list_slug, screen_name)
-
-                    if success:
-                        response = "Removed the Twitter account `%s` from my follow list!" % (
-                                screen_name,)
-                    else:
-                        response = "Sorry, the request didn't work!"
-                        if error_reason:
-                            error_reason = "Reason: `%s`" % (error_reason,)
-                            response = " ".join([response, error_reason])
-
-                    await context.message.channel.send(response)
+                    await context.send(response)
 
             # Help or unknown action case
             else:
@@ -184,3 +155,107 @@ class TwitterHandler(handler_base.HandlerBase):
         except discord.Forbidden:
             self.logger.warning('No permission for tweet action with author %r',
                 context.message.author)
+
+    async def _get_last_tweets_from_screen_names(self, screen_names):
+        """ Fetch the last tweet URL of each screen name concurrently, with at most
+            max_concurrent_lasttweet_requests requests in flight at once.
+
+            Returns a list of two-part tuples: [(tweet_list, error_reason), ...], in the same
+            order as screen_names.
+        """
+        semaphore = asyncio.Semaphore(max_concurrent_lasttweet_requests)
+
+        async def get_last_tweet(screen_name):
+            async with semaphore:
+                try:
+                    return await self._api_client.get_tweet_urls_from_screen_name(
+                        screen_name, max_count=1, use_cache=True)
+                except Exception as exc:
+                    # Don't let one failed request spoil the results for the other accounts
+                    self.logger.warning("Failed to get last tweet for %r: %r", screen_name, exc)
+                    return (None, None)
+
+        return await asyncio.gather(*[get_last_tweet(screen_name) for screen_name in screen_names])
+
+    def _format_last_tweet_response(self, tweet_list, error_reason):
+        """ Return the response message for a lasttweet request. """
+        # All error scenarios
+        if tweet_list is None:
+            response = "Sorry, the request didn't work!"
+            if error_reason:
+                error_reason = "Reason: `%s`" % (error_reason,)
+                response = " ".join([response, error_reason])
+
+        # "No new tweets" scenario: iterable is empty but is not None
+        elif not tweet_list:
+            response = "No new tweets since last time, sorry!"
+
+        # Success scenario
+        else:
+            response = tweet_list[0]
+
+        return response
+
+    async def _apply_list_action(self, action, list_owner, list_slug, screen_name):
+        """ Add or remove a single account, and return the response message. """
+        if action == "add":
+            success, error_reason = await self._api_client.add_user_to_list(
+                    list_owner, list_slug, screen_name)
+            success_response = "Added the Twitter account `%s` to my follow list!"
+        else:
+            success, error_reason = await self._api_client.remove_user_from_list(
+                    list_owner, list_slug, screen_name)
+            success_response = "Removed the Twitter account `%s` from my follow list!"
+
+        if success:
+            return success_response % (screen_name,)
+
+        response = "Sorry, the request didn't work!"
+        self.logger.debug("error_reason: %r", error_reason)
+        if error_reason:
+            error_reason = "Reason: `%s`" % (error_reason,)
+            response = " ".join([response, error_reason])
+        return response
+
+    async def _apply_bulk_list_action(self, action, list_owner, list_slug, screen_names):
+        """ Add or remove many accounts, and return one response message summarising
+            which of them failed.
+        """
+        # Drop duplicates, keeping the order they were given in
+        unique_screen_names = []
+        seen_screen_names = set()
+        for screen_name in screen_names:
+            if screen_name.lower() not in seen_screen_names:
+                seen_screen_names.add(screen_name.lower())
+                unique_screen_names.append(screen_name)
+
+        if action == "add":
+            failures = await self._api_client.add_users_to_list(
+                    list_owner, list_slug, unique_screen_names)
+            response = "Added %d Twitter accounts to my follow list!"
+        else:
+            failures = await self._api_client.remove_users_from_list(
+                    list_owner, list_slug, unique_screen_names)
+            response = "Removed %d Twitter accounts from my follow list!"
+        response = response % (len(unique_screen_names) - len(failures),)
+
+        if not failures:
+            return response
+
+        # Group the failed screen names by reason to keep the message short
+        screen_names_by_reason = {}
+        for screen_name, error_reason in failures:
+            screen_names_by_reason.setdefault(
+                    error_reason or "Unknown error", []).append(screen_name)
+
+        lines = [response, "These didn't work:"]
+        for error_reason, failed_screen_names in screen_names_by_reason.items():
+            lines.append("%s (Reason: `%s`)" % (
+                    ", ".join("`%s`" % (screen_name,) for screen_name in failed_screen_names),
+                    error_reason))
+        response = "\n".join(lines)
+
+        # Stay within Discord's message length limit
+        if len(response) > max_message_length:
+            response = response[:max_message_length - 3] + "..."
+        return response
@@ -6,7 +6,6 @@ import logging
 import logging.config
 import sys
 
-import asyncio
 import discord
 import jaeger_client
 import opentracing
@@ -15,10 +14,16 @@ import dispatcher
 from message_context import MessageContext
 
 import utils.config
+import utils.log_queue
+import utils.loop_monitor
+import utils.memory
+import utils.metrics
 import utils.misc
+import utils.overload
 import utils.stream_notification
 
 import twitter.client
+import twitter.prefetch
 import twitter.scheduler
 
 # Use logging module to log errors until we load the real log config
@@ -39,6 +44,11 @@ if logging_config:
     try:
         logging.config.dictConfig(logging_config)
         logging.info("Using the provided logging module config")
+
+        # Keep slow handlers off the event loop
+        logging_queue_config = config.get_logging_queue_config()
+        if logging_queue_config is not None:
+            utils.log_queue.install(logging_queue_config)
     except (ValueError, TypeError, AttributeError, ImportError) as exc:
         logging.error("Error applying logging config: %r", exc)
         logging.info('Not proceeding without logging configuration, exiting.')
@@ -65,16 +75,35 @@ if jaeger_config:
 if not tracer:
     logger.info("Using Opentracing no-op Tracer")
     tracer = opentracing.Tracer()
+# Used instead while overloaded
+noop_tracer = opentracing.Tracer()
+
+# Overload controller: sheds optional work when the event loop falls behind
+overload_controller = utils.overload.get()
+
+# Metrics: served over HTTP if configured
+metrics_config = config.get_metrics_config()
+events = utils.metrics.counter(
+    "discord_bot_events_total",
+    "Discord gateway events received. own_message counts messages the bot sent as itself.",
+    ("event",))
+message_events = events.labels("message")
+own_message_events = events.labels("own_message")
+member_update_events = events.labels("member_update")
 
 # Client: The interface to Discord's API
 discord_client = discord.Client()
 
 # Only instantiate if there is a Twitter config provided
+twitter_scheduler = None
+twitter_prefetcher = None
 if config.get_twitter_config():
     # Twitter API interface
     twitter.client.initialize()
     # Twitter scheduler: periodically tries to send Tweets to channels
     twitter_scheduler = twitter.scheduler.TwitterScheduler(discord_client)
+    # Twitter prefetcher: keeps recent Tweets from configured lists in memory
+    twitter_prefetcher = twitter.prefetch.TwitterPrefetcher(discord_client)
     logger.info("Using the provided Twitter config")
 else:
     logger.warning("No usable Twitter config, so Twitter functionality will not be available.")
@@ -93,36 +122,98 @@ async def on_ready():
     logger.info('Discord client has logged into Discord as user %r, ID %r',
                 discord_client.user.name, discord_client.user.id)
 
+    # Presence data was just replayed, so start tracking streams from what's live now
+    stream_notifications.snapshot_streaming_state()
+
+    # Watch for anything blocking the event loop. Like the tasks below, this only starts once.
+    utils.loop_monitor.get().start()
+    overload_controller.start()
+    utils.memory.get().start()
+
+    if metrics_config:
+        try:
+            await utils.metrics.get().start_server(
+                metrics_config.get("host", "127.0.0.1"), metrics_config["port"])
+        except OSError as exc:
+            logger.error("Couldn't start the metrics server: %r", exc)
+
     # Schedule Twitter stuffs
     for guild in discord_client.guilds:
         logger.info('Discord client has joined the guild %r', guild.name)
 
         if twitter_scheduler:
-            # Create asyncio tasks to run the Twitter scheduler for each guild that
-            # doesn't already have one running
-            asyncio.get_event_loop().call_soon(
-                asyncio.ensure_future(twitter_scheduler.run(guild)))
+            twitter_scheduler.add_guild(guild)
+
+    # A single task posts Tweets to every guild. on_ready can fire again after
+    # reconnecting, so this won't start a second one.
+    if twitter_scheduler:
+        twitter_scheduler.start()
+    if twitter_prefetcher:
+        twitter_prefetcher.start()
+
+
+@discord_client.event
+async def on_resumed():
+    """ Called when the bot resumes its session after a disconnect. """
+    logger.info('Discord client has resumed its session')
+    stream_notifications.snapshot_streaming_state()
+
+
+@discord_client.event
+async def on_guild_join(guild):
+    """ Called when the bot joins a guild after startup. """
+    logger.info('Discord client has joined the guild %r', guild.name)
+    stream_notifications.add_guild(guild)
+    if twitter_scheduler:
+        twitter_scheduler.add_guild(guild)
+
+
+@discord_client.event
+async def on_guild_remove(guild):
+    """ Called when the bot leaves or is removed from a guild. """
+    logger.info('Discord client has left the guild %r', guild.name)
+    stream_notifications.remove_guild(guild)
+    if twitter_scheduler:
+        twitter_scheduler.remove_guild(guild)
+
+
+@discord_client.event
+async def on_member_join(member):
+    """ Called when a Member joins a guild. """
+    stream_notifications.add_member(member)
+
+
+@discord_client.event
+async def on_member_remove(member):
+    """ Called when a Member leaves a guild. """
+    stream_notifications.remove_member(member)
 
 
 @discord_client.event
 async def on_message(message):
     """ Called whenever a message is received from Discord. """
-    with tracer.start_span('on_message') as on_message_span:
+    # Tracing is the first thing to go when overloaded
+    is_tracing_enabled = overload_controller.is_tracing_enabled()
+    active_tracer = tracer if is_tracing_enabled else noop_tracer
+    with active_tracer.start_span('on_message') as on_message_span:
         # Bot loopback protection
         if message.author.id == discord_client.user.id:
+            own_message_events.inc()
             return
+        message_events.inc()
 
         # Create contexts for request processing and tracing
         context = MessageContext(message, root_span=on_message_span)
-        on_message_span.set_tag("author_name", str(context.author_name))
-        message_guild = context.message.guild
-        if message_guild is not None:
-            on_message_span.set_tag("guild_name", str(message_guild.name))
-        else:
-            on_message_span.set_tag("guild_name", str(None))
+        if is_tracing_enabled:
+            on_message_span.set_tag("author_name", str(context.author_name))
+            message_guild = context.message.guild
+            if message_guild is not None:
+                on_message_span.set_tag("guild_name", str(message_guild.name))
+            else:
+                on_message_span.set_tag("guild_name", str(None))
 
-        channel_name = getattr(context.message.channel, "name", "none")
-        on_message_span.set_tag("channel_name", channel_name)
+            channel_name = getattr(context.message.channel, "name", "none")
+            on_message_span.set_tag("channel_name", channel_name)
 
         # Dispatch command
         await dispatcher.dispatch(context, on_message_span)
@@ -131,6 +222,7 @@ async def on_message(message):
 @discord_client.event
 async def on_member_update(member_before, member_after):
     """ Called when a Member updates their profile. """
+    member_update_events.inc()
     await stream_notifications.on_member_update(member_before, member_after)
 
 
@@ -148,3 +240,4 @@ except Exception as exc:
 
 finally:
     discord_client.close()
+    utils.log_queue.stop()
@@ -1,6 +1,7 @@
 """ Classes representing contextual data. """
 
 import utils.guild
+import utils.webhook
 
 class MessageContext(object):
     """ Contextual data about a message. """
@@ -15,3 +16,15 @@ class MessageContext(object):
 
         # Properties that are set later
         self.args = None
+
+    async def send(self, content):
+        """ Reply in the channel the message was sent in. """
+        message = await self.message.channel.send(content)
+        utils.webhook.sent_messages.labels("reply", "bot").inc()
+        return message
+
+    async def send_to_author(self, content):
+        """ Reply privately to the message's author. """
+        message = await self.message.author.send(content)
+        utils.webhook.sent_messages.labels("private_reply", "bot").inc()
+        return message
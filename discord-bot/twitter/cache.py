@@ -0,0 +1,99 @@
+''' A short-lived cache for Twitter API responses.
+'''
+
+import collections
+import logging
+import time
+
+import asyncio
+
+class ResponseCache(object):
+    ''' Caches successful responses keyed by (url, request_params).
+
+        - Entries younger than ttl are served as is.
+        - Entries older than ttl, but younger than ttl + stale_ttl, are still served while a
+          single background request refreshes them.
+        - Otherwise the caller waits for a fresh response. Concurrent requests for the same
+          key share one fetch.
+    '''
+    def __init__(self, ttl, stale_ttl, max_entries=1000, clock=None):
+        self.logger = logging.getLogger(__name__)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._clock = clock or time.time
+        self._entries = collections.OrderedDict() # Maps keys to (fetch_time, response) tuples
+        # Maps keys to futures for fetches in progress. Invalidation removes fetches, and a
+        # fetch that's been removed doesn't store its response.
+        self._fetches = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(url, request_params):
+        ''' Return a hashable cache key for a request. '''
+        return (url, tuple(sorted(request_params.items())))
+
+    async def get(self, key, fetch):
+        ''' Return the response for key, calling the coroutine function fetch if needed.
+            fetch must return a two-part tuple: (resp_status, resp_data). Only responses with
+            a 200 status are cached.
+        '''
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = self._clock() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                if key not in self._fetches:
+                    self._start_fetch(key, fetch)
+                return entry[1]
+
+        self.misses += 1
+        future = self._fetches.get(key)
+        if future is None:
+            future = self._start_fetch(key, fetch)
+        # Shield the shared fetch so one caller being cancelled doesn't cancel it for others
+        return await asyncio.shield(future)
+
+    def _start_fetch(self, key, fetch):
+        future = asyncio.ensure_future(self._fetch(key, fetch))
+        # Background refreshes, and misses whose callers were all cancelled, have nobody else
+        # to retrieve their exceptions
+        future.add_done_callback(self._log_fetch_failure)
+        self._fetches[key] = future
+        return future
+
+    async def _fetch(self, key, fetch):
+        try:
+            response = await fetch()
+            resp_status, _ = response
+            # Skip storing if invalidation replaced this fetch with a newer one
+            is_current = self._fetches.get(key) is asyncio.Task.current_task()
+            if resp_status == 200 and is_current:
+                self._entries.pop(key, None)
+                self._entries[key] = (self._clock(), response)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return response
+        finally:
+            if self._fetches.get(key) is asyncio.Task.current_task():
+                del self._fetches[key]
+
+    def _log_fetch_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.warning("ResponseCache: fetch failed: %r", future.exception())
+
+    def invalidate(self, predicate):
+        ''' Drop cached responses whose request_params satisfy predicate. Requests for them that
+            are in flight won't be shared with later callers, who fetch afresh instead.
+        '''
+        for key in [key for key in self._entries if predicate(dict(key[1]))]:
+            del self._entries[key]
+        for key in [key for key in self._fetches if predicate(dict(key[1]))]:
+            del self._fetches[key]
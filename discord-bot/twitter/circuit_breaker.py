@@ -0,0 +1,108 @@
+''' A circuit breaker to stop waiting on Twitter while it's failing or slow.
+'''
+
+import collections
+import logging
+import time
+
+state_closed = 'closed'
+state_open = 'open'
+state_half_open = 'half_open'
+
+class CircuitBreaker(object):
+    ''' Tracks the outcomes of recent requests to one family of endpoints.
+
+        - closed: requests are allowed. If enough of the recent requests failed or were slow,
+          the circuit opens.
+        - open: requests are refused without being made, until open_duration has passed.
+        - half_open: a single trial request is allowed. If it succeeds quickly the circuit
+          closes, otherwise it opens again.
+    '''
+    window_size = 20
+    min_requests = 5
+    error_rate_threshold = 0.5
+    slow_rate_threshold = 0.5
+
+    def __init__(self, name, open_duration=60.0, slow_call_threshold=5.0, clock=None):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.open_duration = open_duration
+        self.slow_call_threshold = slow_call_threshold
+        self._clock = clock or time.monotonic
+
+        self.state = state_closed
+        self._outcomes = collections.deque(maxlen=self.window_size) # (failed, slow) tuples
+        self._opened_time = None
+        self._trial_in_progress = False
+
+        # Maps (old_state, new_state) tuples to how many times that transition happened
+        self.transition_counts = collections.Counter()
+        self.rejected_count = 0
+
+    def _transition(self, new_state):
+        old_state = self.state
+        self.state = new_state
+        self.transition_counts[(old_state, new_state)] += 1
+        if new_state == state_open:
+            self._opened_time = self._clock()
+            self.logger.warning("CircuitBreaker %r: %s -> %s", self.name, old_state, new_state)
+        else:
+            self.logger.info("CircuitBreaker %r: %s -> %s", self.name, old_state, new_state)
+
+    def is_available(self):
+        ''' Return True if a request would be allowed now. Doesn't change any state. '''
+        if self.state == state_closed:
+            return True
+        if self.state == state_open:
+            return self._clock() - self._opened_time >= self.open_duration
+        return not self._trial_in_progress
+
+    def allow_request(self):
+        ''' Return True if a request may be made now. If so, the caller must then call
+            either record_result or record_abandoned.
+        '''
+        if self.state == state_open and self._clock() - self._opened_time >= self.open_duration:
+            self._transition(state_half_open)
+
+        if self.state == state_closed:
+            return True
+
+        if self.state == state_half_open and not self._trial_in_progress:
+            self._trial_in_progress = True
+            return True
+
+        self.rejected_count += 1
+        return False
+
+    def record_result(self, success, latency):
+        ''' Record the outcome of an allowed request. '''
+        slow = latency >= self.slow_call_threshold
+
+        if self.state == state_half_open:
+            self._trial_in_progress = False
+            if success and not slow:
+                self._outcomes.clear()
+                self._transition(state_closed)
+            else:
+                self._transition(state_open)
+            return
+
+        if self.state != state_closed:
+            return
+
+        self._outcomes.append((not success, slow))
+        if len(self._outcomes) < self.min_requests:
+            return
+
+        error_rate = sum(1 for failed, _ in self._outcomes if failed) / float(len(self._outcomes))
+        slow_rate = sum(1 for _, slow in self._outcomes if slow) / float(len(self._outcomes))
+        if error_rate >= self.error_rate_threshold or slow_rate >= self.slow_rate_threshold:
+            self.logger.warning("CircuitBreaker %r: error rate %.2f, slow rate %.2f",
+                                self.name, error_rate, slow_rate)
+            self._outcomes.clear()
+            self._transition(state_open)
+
+    def record_abandoned(self):
+        ''' Record that an allowed request was cancelled before it completed. '''
+        if self.state == state_half_open:
+            self._trial_in_progress = False
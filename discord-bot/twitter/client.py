@@ -5,21 +5,58 @@ import base64
 import hmac
 import logging
 import random
+import re
 import time
 import urllib
 
 import aiohttp
+import asyncio
 
 import utils.config
+import utils.memory
+import utils.metrics
+import twitter.cache
+import twitter.circuit_breaker
 import twitter.sampler
+import twitter.tweet
 
 api_client = None
 list_sampler = None
 
+# The lists/members/create_all and destroy_all endpoints accept up to this many users per request
+max_list_members_per_request = 100
+screen_name_regex = re.compile(r"^[A-Za-z0-9_]{1,15}$")
+
+# Interactive commands may be answered from cached responses up to this old, in seconds
+default_response_cache_ttl = 30
+# After that, stale responses are served for this much longer while they are refreshed
+default_response_cache_stale_ttl = 300
+
+# Where to send API requests. Pointing this at twitter.standin_server allows offline testing.
+default_api_base_url = "https://api.twitter.com"
+# Give up on a request to Twitter after this many seconds
+default_request_timeout = 10
+# Requests slower than this many seconds count against the endpoint's circuit breaker
+default_circuit_breaker_slow_call_threshold = 5
+# How long a circuit breaker stays open before letting a trial request through, in seconds
+default_circuit_breaker_open_duration = 60
+
+no_response_error_reason = "Couldn't get a response from Twitter, please try again later!"
+circuit_open_error_reason = ("Twitter isn't responding properly right now,"
+                             " please try again in a minute!")
+
 def initialize():
     global api_client, list_sampler
+    twitter_config = utils.config.get().get_twitter_config()
     api_client = TwitterApiClient()
-    list_sampler = twitter.sampler.TwitterListSampler(api_client)
+    list_sampler = twitter.sampler.TwitterListSampler(
+            api_client,
+            max_candidates=twitter_config.get("sampler_max_candidates"),
+            max_candidate_age=twitter_config.get("sampler_max_candidate_age"),
+            deep_window_pages=twitter_config.get("sampler_deep_window_pages"))
+    utils.memory.register_cache("twitter_list_sampler", lambda: list_sampler.list_map)
+    utils.memory.register_cache(
+        "twitter_response_cache", lambda: api_client.response_cache._entries)
 
 def _make_nonce():
     ''' Return a random string to use as a request identifier. '''
@@ -56,9 +93,34 @@ def _make_signature(logger, method, base_url, request_params, oauth_header_param
 
     return signature
 
+def _get_endpoint_family(url):
+    ''' Return the name of the group of endpoints a request URL belongs to,
+        e.g. "lists/statuses" or "lists/members".
+    '''
+    path = urllib.parse.urlsplit(url).path
+    path = path.split("/1.1/", 1)[-1].rsplit(".json", 1)[0]
+    if path.startswith("lists/members/"):
+        return "lists/members"
+    return path
+
 def getTwitterListUrl(list_screen_name, list_slug):
     return "https://twitter.com/%s/lists/%s" % (list_screen_name, list_slug)
 
+request_seconds = utils.metrics.histogram(
+    "discord_bot_twitter_request_seconds",
+    "Time taken by requests to the Twitter API, by endpoint family",
+    ("endpoint",))
+responses = utils.metrics.counter(
+    "discord_bot_twitter_responses_total",
+    "Outcomes of requests to the Twitter API, by endpoint family and HTTP status. "
+    "Requests that got no response have status \"error\", and requests refused by a circuit "
+    "breaker have status \"circuit_open\".",
+    ("endpoint", "status"))
+circuit_breaker_state = utils.metrics.gauge(
+    "discord_bot_twitter_circuit_breaker_state",
+    "Set to 1 for the current state of each endpoint family's circuit breaker",
+    ("endpoint", "state"))
+
 class TwitterApiClient(object):
     ''' This class represents a client interface to make Twitter requests.
         It is able to authenticate with Twitter's application-only auth flow.
@@ -68,13 +130,58 @@ class TwitterApiClient(object):
         self.logger = logging.getLogger(__name__)
         self.session = None
 
+        twitter_config = self.config.get_twitter_config() or {}
+        self.response_cache = twitter.cache.ResponseCache(
+            ttl=twitter_config.get("response_cache_ttl", default_response_cache_ttl),
+            stale_ttl=twitter_config.get(
+                "response_cache_stale_ttl", default_response_cache_stale_ttl))
+
+        self.api_base_url = twitter_config.get("api_base_url", default_api_base_url).rstrip("/")
+        self.request_timeout = twitter_config.get("request_timeout", default_request_timeout)
+        self.circuit_breaker_slow_call_threshold = twitter_config.get(
+            "circuit_breaker_slow_call_threshold", default_circuit_breaker_slow_call_threshold)
+        self.circuit_breaker_open_duration = twitter_config.get(
+            "circuit_breaker_open_duration", default_circuit_breaker_open_duration)
+        self.circuit_breakers = {} # Maps endpoint families to CircuitBreaker objects
+        circuit_breaker_state.set_function(self._get_circuit_breaker_states)
+
     async def _get_session(self):
         ''' Retrieve the AIOHTTP client session object.
         '''
         if not self.session:
-            self.session = aiohttp.ClientSession()
+            self.session = aiohttp.ClientSession(
+                    timeout=aiohttp.ClientTimeout(total=self.request_timeout))
         return self.session
 
+    def _time(self):
+        ''' Return the event loop's clock, so latencies follow virtual time in simulations. '''
+        return asyncio.get_event_loop().time()
+
+    def _get_circuit_breaker(self, url):
+        ''' Return the circuit breaker for the endpoint family of a request URL. '''
+        family = _get_endpoint_family(url)
+        breaker = self.circuit_breakers.get(family)
+        if breaker is None:
+            breaker = twitter.circuit_breaker.CircuitBreaker(
+                    family,
+                    open_duration=self.circuit_breaker_open_duration,
+                    slow_call_threshold=self.circuit_breaker_slow_call_threshold,
+                    clock=self._time)
+            self.circuit_breakers[family] = breaker
+        return breaker
+
+    def _get_circuit_breaker_states(self):
+        ''' Return circuit breaker states in the form expected by Metric.set_function. '''
+        return [((family, breaker.state), 1) for family, breaker in sorted(
+                self.circuit_breakers.items())]
+
+    def is_endpoint_available(self, family):
+        ''' Return False if requests to an endpoint family, e.g. "lists/statuses", would
+            currently be refused by its circuit breaker. No request is made.
+        '''
+        breaker = self.circuit_breakers.get(family)
+        return breaker is None or breaker.is_available()
+
     def _get_authorization_header_value(self, method, base_url, request_params):
         ''' Returns a two part tuple: (result, error_reason).
             - On success, result is the value for an Authorization header and error_reason is None.
@@ -113,22 +220,78 @@ class TwitterApiClient(object):
 
         return (auth_header, None)
 
-    async def _api_request(self, method, url, request_params):
+    async def _api_request(self, method, url, request_params, project_tweets=False,
+            use_cache=False):
         ''' Returns a two-part tuple: (resp_status, resp_data).
-            - On failure to make a request, both values are None.
+            - On failure to make a request, resp_status is None and resp_data is a string
+              explaining why.
+            - If project_tweets is True and the response is an array of tweets, resp_data is a
+              list of twitter.tweet.Tweet objects.
+            - If use_cache is True, the response may come from the response cache.
         '''
+        if use_cache and self.response_cache.ttl > 0:
+            return await self.response_cache.get(
+                    twitter.cache.ResponseCache.make_key(url, request_params),
+                    lambda: self._api_request(method, url, request_params, project_tweets))
+
         auth_header_value, error_reason = self._get_authorization_header_value(
                 method, url, request_params)
         if not auth_header_value:
-            return (None, None)
+            return (None, error_reason)
+
+        # Fail fast while Twitter is known to be struggling with this kind of request
+        breaker = self._get_circuit_breaker(url)
+        if not breaker.allow_request():
+            self.logger.debug("TwitterApiClient._api_request: circuit %r is open, not requesting"
+                    " %s", breaker.name, url)
+            responses.labels(breaker.name, "circuit_open").inc()
+            return (None, circuit_open_error_reason)
 
         # Make the request
+        start_time = self._time()
+        try:
+            resp_status, resp_data = await self._send_request(
+                    method, url, {"Authorization": auth_header_value},
+                    request_params, project_tweets)
+        except asyncio.CancelledError:
+            breaker.record_abandoned()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as exc:
+            latency = self._time() - start_time
+            breaker.record_result(False, latency)
+            request_seconds.labels(breaker.name).observe(latency)
+            responses.labels(breaker.name, "error").inc()
+            self.logger.warning("TwitterApiClient._api_request: request to %s failed: %r",
+                    url, exc)
+            return (None, no_response_error_reason)
+        except Exception:
+            latency = self._time() - start_time
+            breaker.record_result(False, latency)
+            request_seconds.labels(breaker.name).observe(latency)
+            responses.labels(breaker.name, "error").inc()
+            raise
+
+        # Rate limiting and server errors mean Twitter is struggling, unlike other client errors
+        success = resp_status < 500 and resp_status != 429
+        latency = self._time() - start_time
+        breaker.record_result(success, latency)
+        request_seconds.labels(breaker.name).observe(latency)
+        responses.labels(breaker.name, str(resp_status)).inc()
+        return (resp_status, resp_data)
+
+    async def _send_request(self, method, url, headers, request_params, project_tweets):
+        ''' Send a signed request over HTTP and decode the response.
+            Returns a two-part tuple: (resp_status, resp_data).
+        '''
         client = await self._get_session()
 
-        async with client.request(method, url, headers={"Authorization": auth_header_value},
+        async with client.request(method, url, headers=headers,
                 params=request_params) as response:
 
-            resp_data = await response.json()
+            if project_tweets:
+                resp_data = twitter.tweet.decode_response(await response.read())
+            else:
+                resp_data = await response.json()
 
             return (response.status, resp_data)
 
@@ -136,16 +299,21 @@ class TwitterApiClient(object):
         ''' Get an error from the response status and data, if there is one.
             If there is no error, return None.
         '''
+        # No response at all: resp_data explains why
+        if resp_status is None:
+            return resp_data or no_response_error_reason
+
         # Validate the response status
         if resp_status != 200:
             try:
                 error_reason = resp_data["errors"][0]["message"]
-            except (KeyError, IndexError):
+            except (KeyError, IndexError, TypeError):
                 error_reason = None
 
             if error_reason is None:
                 self.logger.warning("TwitterApiClient._getErrorReason: Twitter API didn't provide"
                         " a 200 response code or an error message: %r" % (resp_data,))
+                error_reason = "Twitter responded with status %s" % (resp_status,)
             else:
                 self.logger.debug("TwitterApiClient._getErrorReason: Reason for bad response: %r",
                         error_reason)
@@ -161,7 +329,7 @@ class TwitterApiClient(object):
             - On other outcomes: success_bool is False and error_reason explains why.
         '''
         method = "POST"
-        url = "https://api.twitter.com/1.1/lists/members/%s.json" % (action,)
+        url = "%s/1.1/lists/members/%s.json" % (self.api_base_url, action)
         request_params={
             "slug": list_slug,
             "owner_screen_name": list_owner,
@@ -175,6 +343,7 @@ class TwitterApiClient(object):
 
         # Make the request
         resp_status, resp_data = await self._api_request(method, url, request_params)
+        self._invalidate_cached_list(list_owner, list_slug)
         error_reason = self._get_error_reason(resp_status, resp_data)
         if error_reason:
             return (None, error_reason)
@@ -182,10 +351,56 @@ class TwitterApiClient(object):
         # Success
         return (True, None)
 
-    async def get_tweets_from_screen_name(self, twitter_screen_name, max_count=1, since_id=None):
+    def _invalidate_cached_list(self, list_owner, list_slug):
+        ''' Forget cached responses about a list whose membership may have changed. '''
+        list_owner = list_owner.lower()
+        self.response_cache.invalidate(lambda request_params: (
+                request_params.get("slug") == list_slug
+                and request_params.get("owner_screen_name", "").lower() == list_owner))
+
+    async def _list_members_bulk_action(self, list_owner, list_slug, twitter_screen_names, action):
+        ''' Supported actions: "create_all", "destroy_all".
+
+            Screen names are sent in chunks of up to max_list_members_per_request.
+            Returns a list of two-part tuples: [(screen_name, error_reason), ...] for the screen
+            names that could not be processed. The list is empty if all requests succeeded.
+            Twitter silently skips unknown accounts in these requests, so they aren't reported.
+        '''
+        method = "POST"
+        url = "%s/1.1/lists/members/%s.json" % (self.api_base_url, action)
+
+        failures = []
+        valid_screen_names = []
+        for screen_name in twitter_screen_names:
+            if screen_name_regex.match(screen_name):
+                valid_screen_names.append(screen_name)
+            else:
+                failures.append((screen_name, "Not a valid Twitter screen name"))
+
+        for index in range(0, len(valid_screen_names), max_list_members_per_request):
+            chunk = valid_screen_names[index:index + max_list_members_per_request]
+            request_params = {
+                "slug": list_slug,
+                "owner_screen_name": list_owner,
+                "screen_name": ",".join(chunk),
+            }
+
+            resp_status, resp_data = await self._api_request(method, url, request_params)
+            error_reason = self._get_error_reason(resp_status, resp_data)
+            if error_reason:
+                failures.extend((screen_name, error_reason) for screen_name in chunk)
+
+        if valid_screen_names:
+            self._invalidate_cached_list(list_owner, list_slug)
+
+        return failures
+
+    async def get_tweets_from_screen_name(self, twitter_screen_name, max_count=1, since_id=None,
+            use_cache=False):
         ''' Get a list of tweet URLs posted by the user with the specified twitter_screen_name.
             - max_count: the maximum number of results that can be returned in the list.
             - since_id: if provided, Twitter will only return tweets with IDs later than this.
+            - use_cache: if True, a recently cached response may be returned.
 
             Returns a two-part tuple: (results, error_reason).
             - On success: results is a list of zero or more tweet URLs.
@@ -193,7 +408,7 @@ class TwitterApiClient(object):
             - On failure: results is None and error_reason explains why.
         '''
         method = "GET"
-        url = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+        url = "%s/1.1/statuses/user_timeline.json" % (self.api_base_url,)
         request_params = {
             "screen_name": twitter_screen_name,
             "count": str(max_count),
@@ -203,19 +418,23 @@ class TwitterApiClient(object):
         if since_id:
             request_params["since_id"] = since_id
 
-        resp_status, resp_data = await self._api_request(method, url, request_params)
+        resp_status, resp_data = await self._api_request(method, url, request_params,
+                project_tweets=True, use_cache=use_cache)
         error_reason = self._get_error_reason(resp_status, resp_data)
         if error_reason:
             return (None, error_reason)
 
-        # For a 200 response we expect Twitter to provide a JSON array of results
-        # It's possible there are no tweets the results list.
+        # For a 200 response we expect Twitter to provide a JSON array of results, which are
+        # decoded to Tweet objects. It's possible there are no tweets the results list.
         return (resp_data, None)
 
-    async def get_tweets_from_list(self, owner_screen_name, list_slug, max_count=1, since_id=None):
+    async def get_tweets_from_list(self, owner_screen_name, list_slug, max_count=1, since_id=None,
+            max_id=None, use_cache=False):
         ''' Get the last tweet posted by any member of the specified list.
             - max_count: the maximum number of results that can be returned in the list.
             - since_id: if provided, Twitter will only return tweets with IDs later than this.
+            - max_id: if provided, Twitter will only return tweets with IDs up to and including this.
+            - use_cache: if True, a recently cached response may be returned.
 
             Returns a two-part tuple: (results, error_reason).
             - On success: results is a list of zero or more tweet URLs.
@@ -223,7 +442,7 @@ class TwitterApiClient(object):
             - On failure: results is None and error_reason explains why.
         '''
         method = "GET"
-        url = "https://api.twitter.com/1.1/lists/statuses.json"
+        url = "%s/1.1/lists/statuses.json" % (self.api_base_url,)
         request_params = {
             "owner_screen_name": owner_screen_name,
             "slug": list_slug,
@@ -234,42 +453,68 @@ class TwitterApiClient(object):
         # since_id prevents Twitter from returning tweets we've already seen before
         if since_id:
             request_params["since_id"] = since_id
+        # max_id lets callers page backwards through the list timeline
+        if max_id:
+            request_params["max_id"] = max_id
 
-        resp_status, resp_data = await self._api_request(method, url, request_params)
+        resp_status, resp_data = await self._api_request(method, url, request_params,
+                project_tweets=True, use_cache=use_cache)
         error_reason = self._get_error_reason(resp_status, resp_data)
         if error_reason:
             return (None, error_reason)
 
-        # For a 200 response we expect Twitter to provide a JSON array of results
-        # It's possible there are no tweets the results list.
+        # For a 200 response we expect Twitter to provide a JSON array of results, which are
+        # decoded to Tweet objects. It's possible there are no tweets the results list.
         return (resp_data, None)
 
-    def get_urls_from_tweets(self, tweet_list):
-        results = []
-        for tweet_data in tweet_list:
-            try:
-                tweet_creator_screen_name = tweet_data["user"]["screen_name"]
-                tweet_id = tweet_data["id"]
-                results.append("https://twitter.com/%s/status/%s" % (
-                        tweet_creator_screen_name, tweet_id))
-            except KeyError:
-                self.logger.debug("TwitterApiClient.getUrlsFromTweets: Bad tweet data from"
-                        "Twitter API, missing id field: %r", tweet_data)
+    async def iter_tweet_pages_from_list(self, owner_screen_name, list_slug, page_size=200,
+            max_id=None, max_pages=None):
+        ''' Asynchronously iterate over pages of a list timeline, newest first, using max_id
+            cursors to walk backwards.
+            - page_size: the maximum number of tweets requested per page.
+            - max_id: if provided, start from tweets with IDs up to and including this.
+            - max_pages: if provided, stop after this many requests.
+
+            Yields two-part tuples: (results, error_reason).
+            - On success: results is a non-empty list of tweets.
+            - On failure: results is None and error_reason explains why. Iteration then stops.
+        '''
+        pages_fetched = 0
+        while max_pages is None or pages_fetched < max_pages:
+            tweet_list, error_reason = await self.get_tweets_from_list(
+                    owner_screen_name, list_slug, max_count=page_size,
+                    max_id=str(max_id) if max_id else None)
+            pages_fetched += 1
+            if error_reason:
+                yield (None, error_reason)
+                return
 
-        return results
+            # An empty page means we've reached the end of what Twitter will give us
+            if not tweet_list:
+                return
 
-    async def get_tweet_urls_from_screen_name(self, twitter_screen_name, max_count=1, since_id=None):
+            yield (tweet_list, None)
+
+            max_id = min(tweet.id for tweet in tweet_list) - 1
+
+    def get_urls_from_tweets(self, tweet_list):
+        return [tweet.url for tweet in tweet_list]
+
+    async def get_tweet_urls_from_screen_name(self, twitter_screen_name, max_count=1, since_id=None,
+            use_cache=False):
         tweet_list, error_reason = await self.get_tweets_from_screen_name(
-                twitter_screen_name, max_count=max_count, since_id=since_id)
+                twitter_screen_name, max_count=max_count, since_id=since_id, use_cache=use_cache)
         if error_reason:
             return (None, error_reason)
 
         tweet_urls = self.get_urls_from_tweets(tweet_list)
         return (tweet_urls, None)
 
-    async def get_tweet_urls_from_list(self, owner_screen_name, list_slug, max_count=1, since_id=None):
+    async def get_tweet_urls_from_list(self, owner_screen_name, list_slug, max_count=1, since_id=None,
+            use_cache=False):
         tweet_list, error_reason = await self.get_tweets_from_list(
-                owner_screen_name, list_slug, max_count=max_count, since_id=since_id)
+                owner_screen_name, list_slug, max_count=max_count, since_id=since_id,
+                use_cache=use_cache)
         if error_reason:
             return (None, error_reason)
 
@@ -280,7 +525,7 @@ class TwitterApiClient(object):
         ''' Return data about a Twitter list.
         '''
         method = "GET"
-        url = "https://api.twitter.com/1.1/lists/show.json"
+        url = "%s/1.1/lists/show.json" % (self.api_base_url,)
         request_params = {
             "owner_screen_name": list_owner,
             "slug": list_slug
@@ -315,3 +560,21 @@ class TwitterApiClient(object):
         result, error_reason = await self._list_members_action(
                 list_owner, list_slug, twitter_screen_name, "destroy")
         return (result, error_reason)
+
+    async def add_users_to_list(self, list_owner, list_slug, twitter_screen_names):
+        ''' Add many users to a Twitter list, using as few requests as possible.
+
+            Returns a list of two-part tuples: [(screen_name, error_reason), ...] for the screen
+            names that could not be added.
+        '''
+        return await self._list_members_bulk_action(
+                list_owner, list_slug, twitter_screen_names, "create_all")
+
+    async def remove_users_from_list(self, list_owner, list_slug, twitter_screen_names):
+        ''' Remove many users from a Twitter list, using as few requests as possible.
+
+            Returns a list of two-part tuples: [(screen_name, error_reason), ...] for the screen
+            names that could not be removed.
+        '''
+        return await self._list_members_bulk_action(
+                list_owner, list_slug, twitter_screen_names, "destroy_all")
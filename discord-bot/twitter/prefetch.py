@@ -0,0 +1,156 @@
+""" Keeps candidate tweets for each configured guild list warm in the background.
+"""
+
+import logging
+import time
+
+import asyncio
+
+import twitter.client
+import twitter.scheduler
+import utils.config
+import utils.guild
+import utils.memory
+import utils.misc
+import utils.overload
+
+default_prefetch_interval = 15 * 60 # 15 minutes
+default_prefetch_max_requests_per_hour = 120
+# Quiet lists are fetched less often, down to once per this many seconds
+default_prefetch_max_interval = 4 * 60 * 60 # 4 hours
+# How often to look for newly configured lists while every known list is up to date
+rescan_interval = 60
+
+class TwitterPrefetcher(object):
+    """ Periodically fetches new tweets for every (listscreenname, listslug) configured in a
+        guild, so that scheduled posts and commands can be served from the sampler's buffers.
+
+        Requests are made one at a time and spaced out to stay within the configured number of
+        requests per hour. Each list is fetched about once per polling_target_new_tweets new
+        tweets, between the prefetch interval and the maximum interval. When there are more
+        lists than the budget allows, the most overdue lists go first.
+    """
+    def __init__(self, client, list_sampler=None, clock=None):
+        self.logger = logging.getLogger(__name__)
+        self.config = utils.config.get()
+        self.client = client
+        self.list_sampler = list_sampler or twitter.client.list_sampler
+        self._clock = clock or time.time
+
+        twitter_config = self.config.get_twitter_config() or {}
+        self.interval = twitter_config.get("prefetch_interval", default_prefetch_interval)
+        self.max_requests_per_hour = twitter_config.get(
+            "prefetch_max_requests_per_hour", default_prefetch_max_requests_per_hour)
+        self.max_interval = max(self.interval, twitter_config.get(
+            "prefetch_max_interval", default_prefetch_max_interval))
+        self.polling_target_new_tweets = twitter_config.get(
+            "polling_target_new_tweets", twitter.scheduler.default_polling_target_new_tweets)
+        self._attempt_times = {} # Maps (list_owner, list_slug) to the last time we tried to fetch
+        self._task = None
+        utils.memory.register_cache("twitter_prefetch_attempt_times", lambda: self._attempt_times)
+
+        # Let the sampler use prefetched candidates until two prefetches have been missed
+        if self.is_enabled():
+            self.list_sampler.max_candidate_staleness = 2 * self.interval
+
+    def is_enabled(self):
+        """ Return True if prefetching is configured to run. """
+        return self.interval > 0 and self.max_requests_per_hour > 0
+
+    def start(self):
+        """ Start the prefetch task if it's enabled and isn't already running. """
+        if not self.is_enabled():
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    def _get_configured_lists(self):
+        """ Return the set of (list_owner, list_slug) tuples configured across all guilds. """
+        configured_lists = set()
+        for guild in self.client.guilds:
+            guild_data = utils.guild.get(guild)
+            list_owner = guild_data.get_twitter_data('listscreenname')
+            list_slug = guild_data.get_twitter_data('listslug')
+            if list_owner and list_slug:
+                configured_lists.add((list_owner, list_slug))
+        return configured_lists
+
+    def _get_interval(self, lists_key):
+        """ Return how often to fetch a list, based on how busy it is. """
+        interval = self.list_sampler.get_polling_interval(
+                lists_key[0], lists_key[1], self.polling_target_new_tweets,
+                self.interval, self.max_interval)
+        if interval is None:
+            return self.interval
+        return interval
+
+    def _get_most_overdue_list(self, configured_lists):
+        """ Return a two-part tuple: (lists_key, seconds_until_due) for the list whose next
+            fetch is most overdue. If there are no lists, both values are None.
+        """
+        # Forget lists that are no longer configured anywhere
+        for key in list(self._attempt_times):
+            if key not in configured_lists:
+                del self._attempt_times[key]
+
+        lists_key = None
+        earliest_due_time = None
+        for key in configured_lists:
+            last_time = max(self.list_sampler.get_fetch_time(*key) or float("-inf"),
+                            self._attempt_times.get(key, float("-inf")))
+            due_time = last_time + self._get_interval(key)
+            if earliest_due_time is None or due_time < earliest_due_time:
+                lists_key, earliest_due_time = key, due_time
+
+        if lists_key is None:
+            return (None, None)
+        return (lists_key, max(earliest_due_time - self._clock(), 0))
+
+    async def run(self):
+        """ Fetch new tweets for configured lists as they become due. """
+        self.logger.info("TwitterPrefetcher.run started")
+        request_spacing = 3600.0 / self.max_requests_per_hour
+        while True:
+            try:
+                lists_key, delay_time = self._get_most_overdue_list(self._get_configured_lists())
+                if lists_key is None or delay_time > 0:
+                    await asyncio.sleep(min(delay_time or rescan_interval, rescan_interval))
+                    continue
+
+                # Prefetching is optional work, so leave the list overdue while overloaded
+                if utils.overload.get().is_background_work_deferred():
+                    await asyncio.sleep(request_spacing)
+                    continue
+
+                self._attempt_times[lists_key] = self._clock()
+                # Don't spend the request budget while Twitter is failing
+                api_client = self.list_sampler.twitter_api_client
+                if not api_client.is_endpoint_available("lists/statuses"):
+                    await asyncio.sleep(request_spacing)
+                    continue
+
+                self.logger.debug("TwitterPrefetcher: refreshing candidates for list %r",
+                                  lists_key)
+                error_reason = await self.list_sampler.refresh_candidates(*lists_key)
+                if error_reason:
+                    self.logger.warning("TwitterPrefetcher: refresh failed for list %r: %r",
+                                        lists_key, error_reason)
+                else:
+                    # Let the sampler keep using this list's candidates until two fetches have
+                    # been missed
+                    self.list_sampler.set_max_candidate_staleness(
+                        lists_key[0], lists_key[1], 2 * self._get_interval(lists_key))
+
+                # Spread requests out to stay within budget and leave room for other work
+                await asyncio.sleep(request_spacing)
+
+            # The only scenario we should abort is when asyncio cancels us
+            except asyncio.CancelledError:
+                self.logger.debug("Cancelling Tweet prefetcher")
+                break
+
+            except Exception as exc:
+                # Suppress, log the traceback and then continue looping
+                self.logger.info("Exception in TwitterPrefetcher.run: %r", exc)
+                utils.misc.log_traceback(self.logger)
+                await asyncio.sleep(request_spacing)
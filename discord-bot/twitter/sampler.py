@@ -1,5 +1,8 @@
+import collections
+import heapq
 import logging
 import pprint
+import time
 
 class TwitterListSampler(object):
     ''' Class that selects recent Tweets to share from lists based on a set of weighting criteria.
@@ -9,69 +12,283 @@ class TwitterListSampler(object):
     '''
     max_tweets_to_consider = 33
     results_to_return = 1
-    def __init__(self, twitter_api_client):
+    # Tweets fetched from a list are kept in a rolling buffer so that each round only needs to
+    # ask Twitter for tweets newer than the ones we've already seen.
+    max_candidates = 200
+    max_candidate_age = 24 * 60 * 60 # 24 hours
+    # Optionally page further back in the list timeline to find quiet accounts, up to this many
+    # extra requests per round. Disabled by default to save API budget.
+    deep_window_pages = 0
+    deep_window_page_size = 200
+    # Weights are capped, so no tweet can ever score higher than this
+    max_weight = 1.0
+    # Candidates fetched more recently than this (for example by a prefetcher) are used without
+    # asking Twitter for newer tweets first. By default, every round fetches.
+    max_candidate_staleness = 0
+    # List sizes change slowly, so they're only looked up this often
+    max_list_size_age = 60 * 60 # 1 hour
+    # Each list's new tweet rate is a moving average over roughly this long
+    tweet_rate_averaging_time = 24 * 60 * 60 # 24 hours
+    def __init__(self, twitter_api_client, max_candidates=None, max_candidate_age=None,
+            deep_window_pages=None, max_candidate_staleness=None, clock=None):
         self.logger = logging.getLogger(__name__)
         self.twitter_api_client = twitter_api_client
         self.list_map = {}
+        self._clock = clock or time.time
+        if max_candidates is not None:
+            self.max_candidates = max_candidates
+        if max_candidate_age is not None:
+            self.max_candidate_age = max_candidate_age
+        if deep_window_pages is not None:
+            self.deep_window_pages = deep_window_pages
+        if max_candidate_staleness is not None:
+            self.max_candidate_staleness = max_candidate_staleness
 
     async def _get_twitter_list_size(self, list_owner, list_slug):
+        sampler_list_data = self._get_list_data(list_owner, list_slug)
+        now = self._clock()
+        if now - sampler_list_data["list_size_time"] < self.max_list_size_age:
+            return (sampler_list_data["list_size"], None)
+
         list_data, error_string = await self.twitter_api_client.get_list_data(list_owner, list_slug)
         if list_data is None:
             return (None, error_string)
 
+        sampler_list_data["list_size"] = list_data["member_count"]
+        sampler_list_data["list_size_time"] = now
         return (list_data["member_count"], None)
 
-    def _get_weighted_results(self, list_owner, list_slug, tweet_list):
+    def _get_list_data(self, list_owner, list_slug):
         lists_key = (list_owner, list_slug)
-        list_data = self.list_map.setdefault(lists_key, {})
-        screen_name_weight_map = list_data.setdefault("screen_name_weight", {})
-        screen_name_last_tweet_id_map = list_data.setdefault("screen_name_last_tweet_id", {})
+        list_data = self.list_map.get(lists_key)
+        if list_data is None:
+            list_data = self.list_map[lists_key] = {
+                "since_id": None,
+                "candidates": collections.deque(maxlen=self.max_candidates),
+                "fetch_time": None,
+                "list_size": None,
+                "list_size_time": float("-inf"),
+                "decay_offset": 0.0,
+                "screen_name_reset_offset": collections.OrderedDict(),
+                "screen_name_last_tweet_id": {},
+                "new_tweet_rate": None, # Tweets per second, once it has been measured
+                # True if the latest fetch was capped at max_tweets_to_consider, so the list
+                # may be busier than new_tweet_rate says
+                "new_tweet_rate_is_lower_bound": False,
+                "max_candidate_staleness": None, # Overrides self.max_candidate_staleness
+            }
+        return list_data
 
-        self.logger.debug("TwitterListSampler._get_weighted_results: Number of tweets received from"
-                " Twitter API: %d", len(tweet_list))
+    async def refresh_candidates(self, list_owner, list_slug):
+        ''' Fetch tweets newer than the list's high-water mark and merge them into the
+            rolling candidate buffer, expiring entries that are too old to be worth sharing.
 
-        # results_map maps screen names to two-item tuples of the form: (tweet_data, weighted_score).
-        # a screen_name's highest scoring tweet will be kept in the map.
-        results_map = {}
+            Returns None on success, or the error reason on failure.
+        '''
+        list_data = self._get_list_data(list_owner, list_slug)
+        since_id = list_data["since_id"]
+        candidates = list_data["candidates"]
 
-        for tweet_data in tweet_list:
-            try:
-                screen_name = tweet_data["user"]["screen_name"]
+        tweet_list, error_reason = await self.twitter_api_client.get_tweets_from_list(
+                list_owner, list_slug, max_count=self.max_tweets_to_consider,
+                since_id=str(since_id) if since_id else None)
+        if error_reason:
+            return error_reason
+
+        self.logger.debug("TwitterListSampler.refresh_candidates: %d new tweets since %r",
+                len(tweet_list), since_id)
+
+        now = self._clock()
+        self._update_new_tweet_rate(list_data, since_id, len(tweet_list), now)
+
+        # Twitter returns the newest tweets first. Keep the buffer in the same order, so the
+        # newest candidates are on the left and the oldest are dropped from the right.
+        for tweet in reversed(tweet_list):
+            candidates.appendleft((now, tweet))
+            if not since_id or tweet.id > since_id:
+                since_id = tweet.id
+        list_data["since_id"] = since_id
+        list_data["fetch_time"] = now
+
+        expiry_time = now - self.max_candidate_age
+        while candidates and candidates[-1][0] < expiry_time:
+            candidates.pop()
+
+        return None
+
+    def _update_new_tweet_rate(self, list_data, since_id, new_tweet_count, now):
+        ''' Fold the number of tweets found by a since_id fetch into the list's moving average
+            of new tweets per second. Longer gaps between fetches carry more weight.
+
+            A fetch that returns max_tweets_to_consider tweets may have missed others, so its
+            rate is only a lower bound. The average isn't allowed to fall below it.
+        '''
+        previous_fetch_time = list_data["fetch_time"]
+        # The first fetch returns a page of old tweets, which says nothing about the rate
+        if not since_id or previous_fetch_time is None or now <= previous_fetch_time:
+            return
+
+        elapsed = now - previous_fetch_time
+        sample_rate = new_tweet_count / elapsed
+        is_lower_bound = new_tweet_count >= self.max_tweets_to_consider
+        rate = list_data["new_tweet_rate"]
+        if rate is None:
+            rate = sample_rate
+        else:
+            weight = min(elapsed / self.tweet_rate_averaging_time, 1.0)
+            rate = rate + weight * (sample_rate - rate)
+        if is_lower_bound:
+            rate = max(rate, sample_rate)
+        list_data["new_tweet_rate"] = rate
+        list_data["new_tweet_rate_is_lower_bound"] = is_lower_bound
+
+    def get_polling_interval(self, list_owner, list_slug, target_new_tweets, min_interval,
+            max_interval):
+        ''' Return how long to wait between fetches of a list so that about target_new_tweets
+            new tweets are found each time, clamped between min_interval and max_interval.
+            Returns None if the list's new tweet rate hasn't been measured yet.
+            Lists whose latest fetch was capped are busier than can be measured, so they're
+            fetched as often as min_interval allows until a fetch comes back under the cap.
+        '''
+        list_data = self._get_list_data(list_owner, list_slug)
+        rate = list_data["new_tweet_rate"]
+        if rate is None:
+            return None
+        if list_data["new_tweet_rate_is_lower_bound"]:
+            return min_interval
+        if rate <= 0:
+            return max_interval
+        return min(max(target_new_tweets / rate, min_interval), max_interval)
+
+    def set_max_candidate_staleness(self, list_owner, list_slug, max_candidate_staleness):
+        ''' Override max_candidate_staleness for one list, for example because a prefetcher
+            fetches it less often than others.
+        '''
+        self._get_list_data(list_owner, list_slug)["max_candidate_staleness"] = \
+            max_candidate_staleness
+
+    def has_fresh_candidates(self, list_owner, list_slug):
+        ''' Return True if the list's candidates were fetched within max_candidate_staleness. '''
+        list_data = self._get_list_data(list_owner, list_slug)
+        fetch_time = list_data["fetch_time"]
+        max_candidate_staleness = list_data["max_candidate_staleness"]
+        if max_candidate_staleness is None:
+            max_candidate_staleness = self.max_candidate_staleness
+        return (fetch_time is not None
+                and self._clock() - fetch_time < max_candidate_staleness)
+
+    def can_get_tweets(self, list_owner, list_slug):
+        ''' Return False if get_tweets would need to fetch from Twitter but the circuit
+            breaker for list timelines is open. No request is made.
+        '''
+        return (self.has_fresh_candidates(list_owner, list_slug)
+                or self.twitter_api_client.is_endpoint_available("lists/statuses"))
 
-                # Skip if we've returned this tweet or more recent tweets by the same user
-                if screen_name_last_tweet_id_map.get(screen_name, 0) >= tweet_data["id"]:
-                    continue
+    def get_fetch_time(self, list_owner, list_slug):
+        ''' Return when the list's candidates were last fetched, or None if they never were. '''
+        return self._get_list_data(list_owner, list_slug)["fetch_time"]
 
-                # Gather weighting parameters (default to 1.0 if it's not there)
-                screen_name_weighting_factor = screen_name_weight_map.get(screen_name, 1.0)
+    def get_latest_tweet(self, list_owner, list_slug):
+        ''' Return the newest buffered tweet from the list if the buffer is fresh,
+            otherwise None.
+        '''
+        if not self.has_fresh_candidates(list_owner, list_slug):
+            return None
+        candidates = self._get_list_data(list_owner, list_slug)["candidates"]
+        if not candidates:
+            return None
+        return candidates[0][1]
+
+    @staticmethod
+    def _get_weight(list_data, screen_name):
+        ''' Return the current weighting factor for a screen name, between 0.0 and 1.0. '''
+        reset_offset = list_data["screen_name_reset_offset"].get(screen_name)
+        if reset_offset is None:
+            return 1.0
+        return min(list_data["decay_offset"] - reset_offset, 1.0)
+
+    def _score_tweets(self, list_data, tweet_list, results_map, exclude_ids=None):
+        ''' Score tweets using known weightings and merge them into results_map.
+
+            results_map maps screen names to two-item tuples of the form: (tweet, weighted_score).
+            A screen_name's highest scoring tweet will be kept in the map. Since all of a user's
+            tweets share the same score, that is the first (newest) eligible tweet seen.
+            Tweets with IDs in exclude_ids are not eligible.
+        '''
+        screen_name_last_tweet_id_map = list_data["screen_name_last_tweet_id"]
+
+        for tweet in tweet_list:
+            screen_name = tweet.screen_name
+
+            if screen_name in results_map:
+                continue
 
-                # Compute final weighted score
-                weighted_score = screen_name_weighting_factor
+            # Skip if we've returned this tweet or more recent tweets by the same user
+            if screen_name_last_tweet_id_map.get(screen_name, 0) >= tweet.id:
+                continue
 
-                # Add the tweet to the results if it's the highest scoring tweet for this screen name
-                if (screen_name not in results_map or
-                        weighted_score > results_map[screen_name][1]):
-                    results_map[screen_name] = (tweet_data, weighted_score)
+            # Skip if the caller has already posted this tweet
+            if exclude_ids and tweet.id in exclude_ids:
+                continue
 
-            except KeyError:
-                self.logger.warning("TwitterListSampler._get_weighted_results: Bad tweet data from"
-                        " Twitter API, missing id field: %r", tweet_data)
+            # Compute final weighted score
+            weighted_score = self._get_weight(list_data, screen_name)
 
-        self.logger.debug("TwitterListSampler._get_weighted_results: results_map: %r",
+            results_map[screen_name] = (tweet, weighted_score)
+
+    def _get_top_results(self, results_map):
+        ''' Return the results_to_return highest scoring entries of results_map, as a list of
+            two-part tuples like: [(tweet, weighted_score), ...]
+        '''
+        self.logger.debug("TwitterListSampler._get_top_results: results_map: %r",
                           results_map.keys())
 
-        # Sort results by weight and return all of them
-        sorted_result_keys = sorted(results_map,
-                key=lambda item_key: results_map[item_key][1], reverse=True)
-        results = [results_map[item_key] for item_key in sorted_result_keys]
+        # Select the highest weighted results without sorting every candidate.
+        # Like a stable sort, ties are resolved in favour of newer tweets.
+        return heapq.nlargest(self.results_to_return, results_map.values(),
+                key=lambda item: item[1])
+
+    def _is_unbeatable(self, top_results):
+        ''' Return True if no further tweets could displace any of the top results. '''
+        return (len(top_results) >= self.results_to_return
+                and all(score >= self.max_weight for _, score in top_results))
+
+    async def _score_older_pages(self, list_owner, list_slug, max_id, results_map,
+            exclude_ids=None):
+        ''' Stream older pages of the list timeline into results_map, stopping as soon as the
+            top results can't be beaten or the page budget is spent.
+
+            Returns the top results.
+        '''
+        list_data = self._get_list_data(list_owner, list_slug)
+        top_results = self._get_top_results(results_map)
 
-        return results
+        pages = self.twitter_api_client.iter_tweet_pages_from_list(
+                list_owner, list_slug, page_size=self.deep_window_page_size,
+                max_id=max_id, max_pages=self.deep_window_pages)
+        async for tweet_list, error_reason in pages:
+            if error_reason:
+                # The deep window is best effort, so settle for what we already have
+                self.logger.warning("TwitterListSampler._score_older_pages: stopping early: %r",
+                        error_reason)
+                break
+
+            self._score_tweets(list_data, tweet_list, results_map, exclude_ids)
+            top_results = self._get_top_results(results_map)
+            if self._is_unbeatable(top_results):
+                break
+
+        return top_results
 
     async def _adjust_weights(self, list_owner, list_slug, tweets_shown):
         ''' This method adds a constant to all twitter handle weights, to increase the
             chance a user's tweets will be shown again over time.
             The constant is the inverse of the list size, multiplied by the number of
             tweets shown.
+
+            Rather than updating every weight, the constant is added to a per-list decay offset.
+            A screen name's weight is the distance between the current offset and the offset at
+            which its weight was last reset to zero, capped at 1.0.
         '''
         # k is the constant we will add to all screen_name weights. Avoid div by zero if list is empty.
         # Compute the adjustment constant using the list size.
@@ -81,64 +298,81 @@ class TwitterListSampler(object):
         list_size = max(list_size, 1)
         k = (1.0 / float(list_size)) * len(tweets_shown)
 
-        lists_key = (list_owner, list_slug)
-        list_data = self.list_map[lists_key]
+        list_data = self._get_list_data(list_owner, list_slug)
 
-        screen_name_weight_map = list_data.setdefault("screen_name_weight", {})
-        screen_name_last_tweet_id_map = list_data.setdefault("screen_name_last_tweet_id", {})
+        screen_name_reset_offset_map = list_data["screen_name_reset_offset"]
+        screen_name_last_tweet_id_map = list_data["screen_name_last_tweet_id"]
+        decay_offset = list_data["decay_offset"]
 
         # Set the screen name weights to zero for all users associated with any shown tweet
         # Also record the id_str of the shown tweet
-        for tweet_data, _ in tweets_shown:
-            screen_name = tweet_data["user"]["screen_name"]
+        for tweet, _ in tweets_shown:
+            screen_name = tweet.screen_name
             self.logger.debug("Adjusting weight for %r", screen_name)
-            screen_name_weight_map[screen_name] = 0.0
-            tweet_id = tweet_data["id"]
-            if tweet_id > screen_name_last_tweet_id_map.get(screen_name, 0):
-                screen_name_last_tweet_id_map[screen_name] = tweet_id
+            # Move the screen name to the end, so the map stays ordered by reset offset
+            screen_name_reset_offset_map.pop(screen_name, None)
+            screen_name_reset_offset_map[screen_name] = decay_offset
+            if tweet.id > screen_name_last_tweet_id_map.get(screen_name, 0):
+                screen_name_last_tweet_id_map[screen_name] = tweet.id
 
-        # Add k to each value. If the result is greater than 1.0, don't include it in the new map.
-        new_screen_name_weight_map = {}
-        for screen_name, weight in screen_name_weight_map.items():
-            new_weight = weight + k
-            if new_weight < 1.0:
-                new_screen_name_weight_map[screen_name] = new_weight
+        # Add k to every weight at once.
+        decay_offset += k
+        list_data["decay_offset"] = decay_offset
 
-        list_data["screen_name_weight"] = new_screen_name_weight_map
+        # Weights that have reached 1.0 don't need to be stored. They are the oldest resets,
+        # so they can be dropped from the front of the map.
+        while screen_name_reset_offset_map:
+            screen_name, reset_offset = next(iter(screen_name_reset_offset_map.items()))
+            if decay_offset - reset_offset < 1.0:
+                break
+            del screen_name_reset_offset_map[screen_name]
 
-        self.logger.debug("TwitterListSampler._adjustWeights: new list weighting data: %s",
-                pprint.pformat(new_screen_name_weight_map))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("TwitterListSampler._adjustWeights: new list weighting data: %s",
+                    pprint.pformat({
+                        screen_name: self._get_weight(list_data, screen_name)
+                        for screen_name in screen_name_reset_offset_map}))
 
         return None
 
-    async def get_tweets(self, list_owner, list_slug):
+    async def get_tweets(self, list_owner, list_slug, exclude_ids=None):
         ''' On success, returns tuple where first item is a list of two part tuples like:
-                    [(tweet_url, weighted_score), ...]
+                    [(tweet, weighted_score), ...]
                 second item is None.
             On failure, returns None instead of the list and the second item is the error reason.
+
+            exclude_ids is an optional set of tweet IDs that must not be returned, such as
+            tweets that were already posted to the caller's channel.
         '''
-        tweet_list, error_reason = await self.twitter_api_client.get_tweets_from_list(
-                list_owner, list_slug, max_count=self.max_tweets_to_consider)
-        if error_reason:
-            return (None, error_reason)
+        if not self.has_fresh_candidates(list_owner, list_slug):
+            error_reason = await self.refresh_candidates(list_owner, list_slug)
+            if error_reason:
+                return (None, error_reason)
 
-        # Score tweets using known weightings
-        weighted_results = self._get_weighted_results(list_owner, list_slug, tweet_list)
+        # Score buffered tweets using known weightings
+        list_data = self._get_list_data(list_owner, list_slug)
+        candidates = list_data["candidates"]
+        self.logger.debug("TwitterListSampler.get_tweets: Number of candidate tweets"
+                " to score: %d", len(candidates))
+        results_map = {}
+        self._score_tweets(list_data, [tweet for _, tweet in candidates], results_map,
+                exclude_ids)
 
         # Sample the highest weighted results
-        tweet_score_tuples = weighted_results[:self.results_to_return]
+        tweet_score_tuples = self._get_top_results(results_map)
+
+        # Look further back for better candidates if configured to, and if it could help
+        if self.deep_window_pages and not self._is_unbeatable(tweet_score_tuples):
+            try:
+                max_id = min(tweet.id for _, tweet in candidates) - 1
+            except ValueError:
+                max_id = None
+            tweet_score_tuples = await self._score_older_pages(
+                    list_owner, list_slug, max_id, results_map, exclude_ids)
 
         # Adjust weightings
         error_reason = await self._adjust_weights(list_owner, list_slug, tweet_score_tuples)
         if error_reason:
             return (None, error_reason)
 
-        # Return two-part tuples like: (tweet_url, weighted_score)
-        results = []
-        for tweet_data, weighted_score in tweet_score_tuples:
-            tweet_creator_screen_name = tweet_data["user"]["screen_name"]
-            tweet_id = tweet_data["id"]
-            tweet_url = "https://twitter.com/%s/status/%s" % (tweet_creator_screen_name, tweet_id)
-            results.append((tweet_url, weighted_score))
-
-        return (results, None)
+        return (tweet_score_tuples, None)
@@ -1,8 +1,10 @@
 """ Code to send Tweets to Discord chatrooms.
 """
 
+import heapq
 import logging
 import random
+import time
 
 import asyncio
 
@@ -10,52 +12,203 @@ import twitter.client
 import utils.config
 import utils.misc
 import utils.guild
+import utils.memory
+import utils.overload
+import utils.webhook
 
 minimum_delay_time = 4 * 60 * 60 # 4 hours
 random_extra_delay_time = 2 * 60 * 60 # 2 hours
+# Once a list's activity is known, guilds are posted to about once per this many new tweets,
+# but no more often than the minimum interval and no less often than the maximum interval
+default_polling_target_new_tweets = 10
+default_min_post_interval = minimum_delay_time
+default_max_post_interval = 24 * 60 * 60 # 24 hours
+# Posts that fell due while the bot was offline are spread over this window after startup
+overdue_spread_time = 10 * 60 # 10 minutes
+default_max_concurrent_posts = 10
+# How many recently posted tweet IDs to remember per channel, to avoid posting them again
+default_max_posted_tweets_per_channel = 500
+# While overloaded, check whether posting can resume this often, in seconds
+overload_pause_interval = 5
 
 class TwitterScheduler(object):
-    """ Class to handle scheduling the posting of Tweets to Discord guilds. """
-    def __init__(self, client):
+    """ Class to handle scheduling the posting of Tweets to Discord guilds.
+
+        A single task serves every guild. Each guild has a due time, persisted in the database
+        so that restarts resume the existing schedule, and the task waits on a heap of due times.
+    """
+    def __init__(self, client, list_sampler=None, clock=None, get_guild_data=None):
+        """ The optional arguments let simulations substitute their own sampler, a clock
+            function returning the current time, and a function returning guild data.
+        """
         self.logger = logging.getLogger(__name__)
         self.config = utils.config.get()
         self.client = client
-        self.list_sampler = twitter.client.list_sampler
-        self.active_scheduler_guild_ids = set()
+        self.list_sampler = list_sampler or twitter.client.list_sampler
+        self._clock = clock or time.time
+        self._get_guild_data = get_guild_data or utils.guild.get
+
+        twitter_config = self.config.get_twitter_config() or {}
+        self.max_concurrent_posts = twitter_config.get(
+            "scheduler_max_concurrent_posts", default_max_concurrent_posts)
+        self.max_posted_tweets_per_channel = twitter_config.get(
+            "scheduler_max_posted_tweets_per_channel", default_max_posted_tweets_per_channel)
+        self.polling_target_new_tweets = twitter_config.get(
+            "polling_target_new_tweets", default_polling_target_new_tweets)
+        self.min_post_interval = twitter_config.get(
+            "scheduler_min_interval", default_min_post_interval)
+        self.max_post_interval = twitter_config.get(
+            "scheduler_max_interval", default_max_post_interval)
+
+        self._guilds = {} # Maps guild IDs to guilds
+        self._due_times = {} # Maps guild IDs to the time their next post is due
+        self._heap = [] # Two-part tuples (due_time, guild_id). May hold stale entries.
+        self._wakeup = asyncio.Event()
+        self._post_semaphore = asyncio.Semaphore(self.max_concurrent_posts)
+        self._task = None
+        self.posts_in_progress = 0
+        utils.memory.register_cache("twitter_scheduler_guilds", lambda: self._guilds)
+        utils.memory.register_cache("twitter_scheduler_due_times", lambda: self._due_times)
+        utils.memory.register_cache("twitter_scheduler_heap", lambda: self._heap)
+
+    def _make_due_time(self, now, guild=None):
+        """ Return a jittered time for a guild's next post. Busier lists are posted from more
+            often, once their new tweet rate has been measured.
+        """
+        interval = None
+        if guild is not None:
+            guild_data = self._get_guild_data(guild)
+            list_owner = guild_data.get_twitter_data('listscreenname')
+            list_slug = guild_data.get_twitter_data('listslug')
+            if list_owner and list_slug:
+                interval = self.list_sampler.get_polling_interval(
+                        list_owner, list_slug, self.polling_target_new_tweets,
+                        self.min_post_interval, self.max_post_interval)
+
+        if interval is None:
+            return now + minimum_delay_time + random.random() * random_extra_delay_time
+
+        # Jitter by the same proportion as the fixed schedule, without exceeding the maximum
+        jitter = random.random() * random_extra_delay_time / minimum_delay_time
+        return now + min(interval * (1 + jitter), self.max_post_interval)
 
-    async def run(self, guild):
-        """ Start sending Tweets to a discord guild. """
-        # If we're already sending tweets for this guild, don't start a second loop
-        if guild.id in self.active_scheduler_guild_ids:
+    def _schedule(self, guild_id, due_time):
+        """ Set the time at which to next post to a guild. """
+        self._due_times[guild_id] = due_time
+        heapq.heappush(self._heap, (due_time, guild_id))
+        # Let the scheduler task re-evaluate how long to sleep if this is now the earliest entry
+        if self._heap[0][1] == guild_id:
+            self._wakeup.set()
+
+    def add_guild(self, guild):
+        """ Start sending Tweets to a Discord guild, resuming its persisted schedule. """
+        if guild.id in self._guilds:
             return
-        self.active_scheduler_guild_ids.add(guild.id)
+        self._guilds[guild.id] = guild
+
+        now = self._clock()
+        guild_data = self._get_guild_data(guild)
+        due_time = guild_data.get_twitter_next_post_time()
+        if due_time is None:
+            due_time = self._make_due_time(now)
+            guild_data.set_twitter_next_post_time(due_time)
+        elif due_time < now:
+            # Avoid a burst of posts when many guilds fell due while we were offline
+            due_time = now + random.random() * overdue_spread_time
+
+        self.logger.info("TwitterScheduler scheduling guild %r in %d seconds",
+                guild.name, due_time - now)
+        self._schedule(guild.id, due_time)
+
+    def remove_guild(self, guild):
+        """ Stop sending Tweets to a Discord guild. """
+        self._guilds.pop(guild.id, None)
+        self._due_times.pop(guild.id, None)
+        self.logger.info("TwitterScheduler unscheduled guild %r", guild.name)
+
+    def start(self):
+        """ Start the scheduler task if it isn't already running. """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
 
-        self.logger.info("TwitterScheduler.run started for guild %r", guild.name)
+    def _pop_due_guild(self, now):
+        """ Pop the earliest scheduled guild from the heap.
+            Returns a two-part tuple: (guild, seconds_until_due).
+            If the heap is empty, both values are None.
+        """
+        while self._heap:
+            due_time, guild_id = self._heap[0]
+            # Skip entries for removed guilds or superseded due times
+            if self._due_times.get(guild_id) != due_time:
+                heapq.heappop(self._heap)
+                continue
+            if due_time > now:
+                return (None, due_time - now)
+            heapq.heappop(self._heap)
+            return (self._guilds[guild_id], 0)
+        return (None, None)
+
+    async def run(self):
+        """ Post Tweets to each guild as its due time arrives. """
+        self.logger.info("TwitterScheduler.run started")
         while True:
             try:
-                # Repeatedly wait a while, then post a tweet to the chat
-                delay_time = minimum_delay_time + random.random() * random_extra_delay_time
-                await asyncio.sleep(delay_time)
+                # Posting is optional work, so it waits out heavy load. Guilds that fall due
+                # meanwhile are posted to afterwards.
+                if utils.overload.get().is_scheduler_paused():
+                    await asyncio.sleep(overload_pause_interval)
+                    continue
+
+                self._wakeup.clear()
+                now = self._clock()
+                guild, delay_time = self._pop_due_guild(now)
+
+                if guild is None:
+                    # Sleep until the earliest due time, or until the schedule changes
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay_time)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
 
-                self.logger.debug("About to call post_tweets_to_chat for guild %r", guild.name)
-                await self.post_tweets_to_chat(guild)
+                # Persist the next due time before posting, so a restart mid-post can't repeat it
+                due_time = self._make_due_time(now, guild)
+                self._get_guild_data(guild).set_twitter_next_post_time(due_time)
+                self._schedule(guild.id, due_time)
+
+                # Bound the number of guilds being posted to at once
+                await self._post_semaphore.acquire()
+                asyncio.ensure_future(self._post_and_release(guild))
 
             # The only scenario we should abort is when asyncio cancels us
             except asyncio.CancelledError:
-                self.logger.debug("Cancelling Tweet scheduler for guild %r", guild.name)
-                self.active_scheduler_guild_ids.remove(guild.id)
+                self.logger.debug("Cancelling Tweet scheduler")
                 break
 
             except Exception as exc:
                 # Suppress, log the traceback and then continue looping
-                self.logger.info("Exception in TwitterScheduler.start for guild %r: %r",
-                                 guild.name, exc)
+                self.logger.info("Exception in TwitterScheduler.run: %r", exc)
                 utils.misc.log_traceback(self.logger)
 
+    async def _post_and_release(self, guild):
+        """ Post Tweets to a guild, then release its concurrency slot. """
+        self.posts_in_progress += 1
+        try:
+            self.logger.debug("About to call post_tweets_to_chat for guild %r", guild.name)
+            await self.post_tweets_to_chat(guild)
+
+        except Exception as exc:
+            self.logger.info("Exception in TwitterScheduler.post_tweets_to_chat for guild %r: %r",
+                             guild.name, exc)
+            utils.misc.log_traceback(self.logger)
+
+        finally:
+            self.posts_in_progress -= 1
+            self._post_semaphore.release()
 
     async def post_tweets_to_chat(self, guild):
-        """ Loop forever and post Tweets periodically to a Discord channel. """
-        guild_data = utils.guild.get(guild)
+        """ Post Tweets to the guild's configured Discord channel. """
+        guild_data = self._get_guild_data(guild)
         list_owner = guild_data.get_twitter_data('listscreenname')
         list_slug = guild_data.get_twitter_data('listslug')
         target_channel_name = guild_data.get_twitter_data('channel')
@@ -66,12 +219,33 @@ class TwitterScheduler(object):
                     guild.name)
             return
 
-        results, error_reason = await self.list_sampler.get_tweets(list_owner, list_slug)
+        # Skip this round cheaply while Twitter is failing, rather than waiting on it
+        if not self.list_sampler.can_get_tweets(list_owner, list_slug):
+            self.logger.info("Skipping tweets for guild %r while the Twitter circuit is open",
+                    guild.name)
+            return
+
+        # Tweets already posted to this channel, including before a restart, aren't eligible
+        posted_tweet_ids = guild_data.get_twitter_posted_tweet_ids(target_channel)
+        results, error_reason = await self.list_sampler.get_tweets(
+                list_owner, list_slug, exclude_ids=posted_tweet_ids)
         if error_reason:
             self.logger.error("get_tweets failed, reason: %r", error_reason)
             return
 
-        for tweet_url, _ in results:
+        for tweet, _ in results:
+            # Record the tweet before sending, so a concurrent round can't post it too
+            if not guild_data.add_twitter_posted_tweet_id(
+                    target_channel, tweet.id, self.max_posted_tweets_per_channel):
+                self.logger.debug("Tweet %r was already posted to channel %r, skipping",
+                                  tweet.id, target_channel.name)
+                continue
+
             self.logger.debug("About to call channel.send for channel %r, tweet_url %r",
-                              target_channel.name, tweet_url)
-            await target_channel.send(tweet_url)
+                              target_channel.name, tweet.url)
+            try:
+                await utils.webhook.get().send(guild_data, target_channel, tweet.url,
+                                               purpose="tweet")
+            except Exception:
+                guild_data.remove_twitter_posted_tweet_id(target_channel, tweet.id)
+                raise
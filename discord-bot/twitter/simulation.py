@@ -0,0 +1,443 @@
+''' Simulate Tweet scheduling for many guilds in virtual time.
+
+    TwitterScheduler and TwitterListSampler run against a fake Twitter backend and fake
+    Discord guilds, on an event loop whose clock jumps straight to the next scheduled callback.
+    Weeks of scheduling for thousands of guilds take seconds, and the run reports API call
+    volume, peak concurrency and how fairly posts are spread across list members.
+
+    Usage, from the discord-bot directory:
+        python3 -m twitter.simulation --guilds 2000 --lists 50 --days 14 --restart-every 24
+'''
+
+import argparse
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import os
+import random
+import selectors
+import tempfile
+
+import utils.config
+import twitter.client
+import twitter.sampler
+import twitter.scheduler
+import twitter.tweet
+
+# Twitter only serves roughly this many of the most recent tweets from a timeline
+timeline_retention = 3200
+
+class _VirtualSelector(selectors.BaseSelector):
+    ''' A selector with no real I/O. Waiting for events advances the loop's virtual clock
+        by the timeout instead of blocking.
+    '''
+    def __init__(self):
+        self.loop = None
+        self._map = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self._map[fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return self._map.pop(fd)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Simulation stalled: nothing is scheduled to run")
+        self.loop.advance(timeout)
+        return []
+
+    def get_map(self):
+        return self._map
+
+    def close(self):
+        self._map.clear()
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    ''' An event loop whose time() only moves forward when every task is waiting. '''
+    def __init__(self, start_time=0.0):
+        self._virtual_time = start_time
+        selector = _VirtualSelector()
+        super(VirtualTimeEventLoop, self).__init__(selector=selector)
+        selector.loop = self
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        ''' Move the virtual clock forward. '''
+        self._virtual_time += seconds
+
+class _FakeList(object):
+    ''' A Twitter list whose members tweet as independent Poisson processes. Posting rates
+        follow a heavy-tailed distribution, so a few accounts are much busier than the rest.
+    '''
+    def __init__(self, rng, owner, slug, member_count, tweets_per_day, now):
+        self.rng = rng
+        self.owner = owner
+        self.slug = slug
+        self.screen_names = ["%s_member%d" % (slug, index) for index in range(member_count)]
+        rates = [rng.paretovariate(1.5) for _ in self.screen_names]
+        scale = (tweets_per_day / 86400.0) / sum(rates)
+        self.total_rate = sum(rates) * scale
+        self.cum_weights = list(_accumulate(rates))
+        self.tweet_ids = []
+        self.tweets = []
+        self.next_tweet_time = now + rng.expovariate(self.total_rate)
+
+    def advance(self, now, id_source):
+        ''' Generate the tweets posted up to now. '''
+        while self.next_tweet_time <= now:
+            screen_name = self.rng.choices(self.screen_names, cum_weights=self.cum_weights)[0]
+            tweet_id = next(id_source)
+            self.tweet_ids.append(tweet_id)
+            self.tweets.append(twitter.tweet.Tweet(tweet_id, screen_name))
+            self.next_tweet_time += self.rng.expovariate(self.total_rate)
+
+        if len(self.tweets) > 2 * timeline_retention:
+            del self.tweet_ids[:-timeline_retention]
+            del self.tweets[:-timeline_retention]
+
+    def query(self, count, since_id=None, max_id=None):
+        ''' Return up to count tweets, newest first, like lists/statuses. '''
+        hi = bisect.bisect_right(self.tweet_ids, max_id) if max_id else len(self.tweet_ids)
+        lo = bisect.bisect_right(self.tweet_ids, since_id) if since_id else 0
+        lo = max(lo, hi - count)
+        return self.tweets[lo:hi][::-1]
+
+def _accumulate(values):
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+class FakeTwitterBackend(object):
+    ''' Serves lists/statuses and lists/show from generated timelines, with simulated
+        latency, and records when each request was made.
+    '''
+    def __init__(self, simulation, lists, latency):
+        self.simulation = simulation
+        self.lists = {(fake_list.owner, fake_list.slug): fake_list for fake_list in lists}
+        self.latency = latency
+        self.request_times = []
+        self.requests_by_endpoint = collections.Counter()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._id_source = iter(range(10 ** 15, 10 ** 16))
+
+    async def handle(self, method, url, request_params):
+        now = self.simulation.loop.time()
+        endpoint = url.rsplit("/1.1/", 1)[-1]
+        self.request_times.append(now)
+        self.requests_by_endpoint[endpoint] += 1
+        self.simulation.observe_concurrency()
+
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency * self.simulation.rng.uniform(0.5, 1.5))
+        finally:
+            self.in_flight -= 1
+
+        fake_list = self.lists.get(
+            (request_params.get("owner_screen_name"), request_params.get("slug")))
+        if fake_list is None:
+            return (404, {"errors": [{"message": "Sorry, that page does not exist."}]})
+
+        if endpoint == "lists/statuses.json":
+            fake_list.advance(self.simulation.loop.time(), self._id_source)
+            since_id = request_params.get("since_id")
+            max_id = request_params.get("max_id")
+            return (200, fake_list.query(
+                int(request_params.get("count", 20)),
+                since_id=int(since_id) if since_id else None,
+                max_id=int(max_id) if max_id else None))
+
+        if endpoint == "lists/show.json":
+            return (200, {"member_count": len(fake_list.screen_names)})
+
+        return (404, {"errors": [{"message": "Not simulated: %s" % (endpoint,)}]})
+
+class FakeTwitterApiClient(twitter.client.TwitterApiClient):
+    ''' The real client, with HTTP requests answered by a FakeTwitterBackend. '''
+    def __init__(self, backend):
+        super(FakeTwitterApiClient, self).__init__()
+        self.backend = backend
+
+    def _get_authorization_header_value(self, method, base_url, request_params):
+        # Signing doesn't affect scheduling, and is the most expensive part of a fake request
+        return ("OAuth simulation", None)
+
+    async def _send_request(self, method, url, headers, request_params, project_tweets):
+        return await self.backend.handle(method, url, request_params)
+
+class _FakeChannel(object):
+    name = "tweets"
+
+    def __init__(self, simulation, guild):
+        self.simulation = simulation
+        self.guild = guild
+
+    async def send(self, content):
+        await asyncio.sleep(self.simulation.send_latency)
+        self.simulation.record_post(self.guild, content)
+
+class _FakeGuild(object):
+    def __init__(self, simulation, guild_id, fake_list):
+        self.id = guild_id
+        self.name = "guild%d" % (guild_id,)
+        self.list = fake_list
+        self.channel = _FakeChannel(simulation, self)
+
+class _FakeGuildData(object):
+    ''' Stands in for utils.guild._GuildData, keeping persisted values in a dict that
+        survives simulated restarts.
+    '''
+    def __init__(self, guild, store, posted_store):
+        self.guild = guild
+        self.store = store
+        self.posted_store = posted_store
+
+    def get_twitter_data(self, key):
+        return {
+            "channel": self.guild.channel.name,
+            "listscreenname": self.guild.list.owner,
+            "listslug": self.guild.list.slug,
+        }[key]
+
+    def get_text_channel_from_name(self, name):
+        if name == self.guild.channel.name:
+            return self.guild.channel
+        return None
+
+    def get_twitter_next_post_time(self):
+        return self.store.get(self.guild.id)
+
+    def set_twitter_next_post_time(self, next_post_time):
+        self.store[self.guild.id] = next_post_time
+
+    def get_webhook_posting_enabled(self):
+        return False
+
+    def get_twitter_posted_tweet_ids(self, channel):
+        return set(self.posted_store.get(self.guild.id, ()))
+
+    def add_twitter_posted_tweet_id(self, channel, tweet_id, max_tweets):
+        posted = self.posted_store.setdefault(self.guild.id, collections.OrderedDict())
+        if tweet_id in posted:
+            return False
+        posted[tweet_id] = None
+        while len(posted) > max_tweets:
+            posted.popitem(last=False)
+        return True
+
+    def remove_twitter_posted_tweet_id(self, channel, tweet_id):
+        self.posted_store.get(self.guild.id, {}).pop(tweet_id, None)
+
+class Simulation(object):
+    ''' Runs the scheduler for a population of fake guilds and collects statistics. '''
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.loop = VirtualTimeEventLoop()
+        asyncio.set_event_loop(self.loop)
+        self.send_latency = args.send_latency
+
+        lists = [
+            _FakeList(self.rng, "owner%d" % (index,), "list%d" % (index,), args.list_members,
+                      args.tweets_per_day, self.loop.time())
+            for index in range(args.lists)
+        ]
+        self.backend = FakeTwitterBackend(self, lists, args.api_latency)
+        self.api_client = FakeTwitterApiClient(self.backend)
+        self.guilds = [
+            _FakeGuild(self, guild_id, lists[guild_id % len(lists)])
+            for guild_id in range(1, args.guilds + 1)
+        ]
+
+        self.persisted_due_times = {}
+        self.persisted_posted_tweets = {}
+        self.guild_data = {}
+        self.scheduler = None
+        self.restart_times = []
+        self.posts = []
+        self.posts_by_screen_name = collections.Counter()
+        self.peak_posts_in_progress = 0
+
+    def get_guild_data(self, guild):
+        guild_data = self.guild_data.get(guild.id)
+        if guild_data is None:
+            guild_data = self.guild_data[guild.id] = _FakeGuildData(
+                guild, self.persisted_due_times, self.persisted_posted_tweets)
+        return guild_data
+
+    def observe_concurrency(self):
+        if self.scheduler:
+            self.peak_posts_in_progress = max(
+                self.peak_posts_in_progress, self.scheduler.posts_in_progress)
+
+    def record_post(self, guild, content):
+        self.posts.append(self.loop.time())
+        # Tweet URLs look like https://twitter.com/<screen_name>/status/<id>
+        self.posts_by_screen_name[content.split("/")[3]] += 1
+
+    def _start_scheduler(self):
+        ''' Start a scheduler with fresh in-memory state, as the bot does on startup. '''
+        list_sampler = twitter.sampler.TwitterListSampler(self.api_client, clock=self.loop.time)
+        self.scheduler = twitter.scheduler.TwitterScheduler(
+            None, list_sampler=list_sampler, clock=self.loop.time,
+            get_guild_data=self.get_guild_data)
+        for guild in self.guilds:
+            self.scheduler.add_guild(guild)
+        self.scheduler.start()
+
+    async def _stop_scheduler(self):
+        self.scheduler._task.cancel()
+        try:
+            await self.scheduler._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        duration = self.args.days * 86400
+        restart_interval = self.args.restart_every * 3600 if self.args.restart_every else None
+
+        self._start_scheduler()
+        end_time = self.loop.time() + duration
+        while self.loop.time() < end_time:
+            if restart_interval:
+                await asyncio.sleep(min(restart_interval, end_time - self.loop.time()))
+                if self.loop.time() < end_time:
+                    await self._stop_scheduler()
+                    self.restart_times.append(self.loop.time())
+                    self._start_scheduler()
+            else:
+                await asyncio.sleep(end_time - self.loop.time())
+        await self._stop_scheduler()
+
+    def run(self):
+        self.loop.run_until_complete(self._run())
+
+    def report(self):
+        hours = int(self.args.days * 24)
+        calls_per_hour = _histogram(self.backend.request_times, 3600, hours)
+        posts_per_hour = _histogram(self.posts, 3600, hours)
+
+        print("Simulated %d guilds, %d lists of %d members, over %g days (%d restarts)" % (
+            len(self.guilds), self.args.lists, self.args.list_members, self.args.days,
+            len(self.restart_times)))
+        print()
+        print("API calls:               %d" % (len(self.backend.request_times),))
+        for endpoint, count in sorted(self.backend.requests_by_endpoint.items()):
+            print("  %-22s %d" % (endpoint, count))
+        print("API calls per hour:      mean %.1f, median %d, max %d" % (
+            _mean(calls_per_hour), _percentile(calls_per_hour, 50), max(calls_per_hour)))
+        print("Peak concurrent requests: %d" % (self.backend.peak_in_flight,))
+        print("Peak concurrent posts:    %d (cap %d)" % (
+            self.peak_posts_in_progress, self.scheduler.max_concurrent_posts))
+        print()
+        print("Posts:                   %d" % (len(self.posts),))
+        print("Posts per hour:          mean %.1f, median %d, max %d" % (
+            _mean(posts_per_hour), _percentile(posts_per_hour, 50), max(posts_per_hour)))
+        if self.restart_times:
+            after_restart = _histogram(
+                [post_time for post_time in self.posts
+                 if any(0 <= post_time - restart_time < 3600
+                        for restart_time in self.restart_times)],
+                3600, hours)
+            print("Posts in hour after restart: mean %.1f" % (
+                sum(after_restart) / float(len(self.restart_times)),))
+        print()
+
+        accounts = sum(len(fake_list.screen_names) for fake_list in self.backend.lists.values())
+        counts = [self.posts_by_screen_name.get(screen_name, 0)
+                  for fake_list in self.backend.lists.values()
+                  for screen_name in fake_list.screen_names]
+        print("Accounts posted at least once: %d of %d" % (
+            sum(1 for count in counts if count), accounts))
+        print("Posts per account:       median %d, p90 %d, p99 %d, max %d" % (
+            _percentile(counts, 50), _percentile(counts, 90), _percentile(counts, 99),
+            max(counts)))
+        print("Gini coefficient:        %.3f" % (_gini(counts),))
+
+def _histogram(times, bucket_size, bucket_count):
+    buckets = [0] * bucket_count
+    for event_time in times:
+        index = int(event_time // bucket_size)
+        if index < bucket_count:
+            buckets[index] += 1
+    return buckets
+
+def _mean(values):
+    return sum(values) / float(len(values)) if values else 0.0
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+def _gini(values):
+    ''' 0.0 means posts are spread evenly across accounts, 1.0 means one account got them all. '''
+    ordered = sorted(values)
+    total = sum(ordered)
+    if not total:
+        return 0.0
+    weighted_sum = sum((index + 1) * value for index, value in enumerate(ordered))
+    return (2.0 * weighted_sum) / (len(ordered) * total) - (len(ordered) + 1.0) / len(ordered)
+
+def _write_config():
+    ''' The bot's modules read settings from the config file, so provide a minimal one. '''
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({
+        "discord": {"client_id": 0, "token": "simulation"},
+        "database": {"host": "localhost", "port": 6379},
+        "twitter": {
+            "consumer_key": "simulation",
+            "consumer_secret": "simulation",
+            "access_token": "simulation",
+            "access_token_secret": "simulation",
+        },
+    }, config_file)
+    config_file.close()
+    return config_file.name
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate Tweet scheduling for many guilds in virtual time.")
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--lists", type=int, default=50,
+                        help="Number of distinct Twitter lists shared between the guilds")
+    parser.add_argument("--list-members", type=int, default=100)
+    parser.add_argument("--tweets-per-day", type=float, default=200.0,
+                        help="Average number of tweets per list per day")
+    parser.add_argument("--days", type=float, default=7.0)
+    parser.add_argument("--restart-every", type=float, default=0.0,
+                        help="Restart the bot every this many hours (0 to never restart)")
+    parser.add_argument("--api-latency", type=float, default=0.3)
+    parser.add_argument("--send-latency", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    # The scheduler jitters due times with the random module
+    random.seed(args.seed)
+
+    config_path = _write_config()
+    os.environ[utils.config.config_json_file_envvar] = config_path
+    try:
+        simulation = Simulation(args)
+        simulation.run()
+        simulation.report()
+    finally:
+        os.remove(config_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+''' A local stand-in for the parts of the Twitter API that the bot uses, so the Twitter client
+    can be exercised without real credentials or network access.
+
+    Requests must be signed with the credentials in the bot's twitter config, and signatures
+    are checked with the same code the client uses to make them. Lists and accounts are
+    created the first time they're asked for, and accounts tweet as independent Poisson
+    processes with heavy-tailed rates. Latency, error rates and rate limits are configurable.
+
+    Usage, from the discord-bot directory:
+        DISCORD_BOT_CONFIG_JSON_FILE=<config file> python3 -m twitter.standin_server --port 8080
+    then set "api_base_url": "http://127.0.0.1:8080" in the twitter section of that config.
+'''
+
+import argparse
+import collections
+import heapq
+import itertools
+import logging
+import random
+import re
+import time
+import urllib
+
+import aiohttp.web
+import asyncio
+
+import twitter.client
+import utils.config
+
+# Twitter only serves roughly this many of the most recent tweets from a timeline
+timeline_retention = 3200
+# Signed requests must carry a timestamp within this many seconds of the server's clock
+max_timestamp_skew = 300
+# How many recent nonces to remember, to reject replayed requests
+max_remembered_nonces = 10000
+
+oauth_param_regex = re.compile(r'([A-Za-z_]+)="([^"]*)"')
+
+def _error_response_data(code, message):
+    return {"errors": [{"code": code, "message": message}]}
+
+class _Account(object):
+    ''' A Twitter account with a generated timeline. '''
+    def __init__(self, rng, screen_name, tweets_per_day, now):
+        self.rng = rng
+        self.screen_name = screen_name
+        # The Pareto distribution with alpha 1.5 has a mean of 3
+        self.rate = rng.paretovariate(1.5) * tweets_per_day / 86400.0 / 3.0
+        self.tweet_ids = collections.deque(maxlen=timeline_retention) # Oldest first
+        self.next_tweet_time = now + rng.expovariate(self.rate)
+
+    def advance(self, now, id_source):
+        ''' Generate the tweets posted up to now. '''
+        while self.next_tweet_time <= now:
+            self.tweet_ids.append(next(id_source))
+            self.next_tweet_time += self.rng.expovariate(self.rate)
+
+    def query(self, count, since_id=None, max_id=None):
+        ''' Return up to count tweet IDs, newest first. '''
+        results = []
+        for tweet_id in reversed(self.tweet_ids):
+            if len(results) >= count or (since_id and tweet_id <= since_id):
+                break
+            if max_id and tweet_id > max_id:
+                continue
+            results.append(tweet_id)
+        return results
+
+class _RateLimitWindow(object):
+    ''' Counts requests to one endpoint family in fixed windows, like Twitter does. '''
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.reset_time = 0
+        self.remaining = limit
+
+    def consume(self, now):
+        ''' Count a request. Return False if the limit was already reached. '''
+        if now >= self.reset_time:
+            self.reset_time = now + self.window
+            self.remaining = self.limit
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def get_headers(self):
+        return {
+            "x-rate-limit-limit": str(self.limit),
+            "x-rate-limit-remaining": str(self.remaining),
+            "x-rate-limit-reset": str(int(self.reset_time)),
+        }
+
+class StandinTwitterServer(object):
+    ''' Serves lists/statuses, statuses/user_timeline, lists/show and lists/members/*
+        from generated data.
+    '''
+    def __init__(self, credentials, latency=0.0, error_rate=0.0, rate_limit=900,
+            rate_limit_window=900, tweets_per_day=20.0, list_members=100, seed=None,
+            clock=None):
+        ''' credentials is a dict with consumer_key, consumer_secret, access_token and
+            access_token_secret keys, as in the bot's twitter config.
+        '''
+        self.logger = logging.getLogger(__name__)
+        self.credentials = credentials
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.tweets_per_day = tweets_per_day
+        self.list_members = list_members
+        self.rng = random.Random(seed)
+        self._clock = clock or time.time
+
+        self._accounts = {} # Maps lowercase screen names to _Account objects
+        self._lists = {} # Maps (lowercase owner, slug) to lists of member screen names
+        self._rate_limits = {} # Maps endpoint families to _RateLimitWindow objects
+        self._nonces = collections.OrderedDict()
+        self._id_source = iter(range(10 ** 18, 10 ** 19))
+
+        self.requests_by_endpoint = collections.Counter()
+        self.responses_by_status = collections.Counter()
+
+    def make_app(self):
+        ''' Return an aiohttp application serving the stand-in endpoints. '''
+        app = aiohttp.web.Application()
+        routes = [
+            ("GET", "lists/statuses", self._handle_list_statuses),
+            ("GET", "statuses/user_timeline", self._handle_user_timeline),
+            ("GET", "lists/show", self._handle_list_show),
+            ("POST", "lists/members/create", self._handle_list_members_create),
+            ("POST", "lists/members/create_all", self._handle_list_members_create),
+            ("POST", "lists/members/destroy", self._handle_list_members_destroy),
+            ("POST", "lists/members/destroy_all", self._handle_list_members_destroy),
+        ]
+        for method, endpoint, handler in routes:
+            app.router.add_route(method, "/1.1/%s.json" % (endpoint,),
+                                 self._make_route_handler(endpoint, handler))
+        return app
+
+    def _make_route_handler(self, endpoint, handler):
+        async def route_handler(request):
+            status, resp_data, headers = await self._handle(request, endpoint, handler)
+            self.responses_by_status[status] += 1
+            return aiohttp.web.json_response(resp_data, status=status, headers=headers)
+        return route_handler
+
+    async def _handle(self, request, endpoint, handler):
+        ''' Returns a three-part tuple: (status, resp_data, headers). '''
+        self.requests_by_endpoint[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+
+        request_params = dict(request.query)
+        error_reason = self._verify_signature(request, request_params)
+        if error_reason:
+            self.logger.info("StandinTwitterServer: rejecting %s: %s", request.path, error_reason)
+            return (401, _error_response_data(32, "Could not authenticate you."), {})
+
+        family = "lists/members" if endpoint.startswith("lists/members/") else endpoint
+        rate_limit = self._rate_limits.get(family)
+        if rate_limit is None:
+            rate_limit = self._rate_limits[family] = _RateLimitWindow(
+                    self.rate_limit, self.rate_limit_window)
+        if not rate_limit.consume(self._clock()):
+            return (429, _error_response_data(88, "Rate limit exceeded"),
+                    rate_limit.get_headers())
+
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return (503, _error_response_data(130, "Over capacity"), rate_limit.get_headers())
+
+        status, resp_data = handler(request_params)
+        return (status, resp_data, rate_limit.get_headers())
+
+    def _verify_signature(self, request, request_params):
+        ''' Return None if the request is signed correctly, otherwise the reason it isn't. '''
+        auth_header = request.headers.get("Authorization", "")
+        if not auth_header.startswith("OAuth "):
+            return "missing OAuth Authorization header"
+
+        oauth_params = {urllib.parse.unquote_plus(key): urllib.parse.unquote_plus(value)
+                        for key, value in oauth_param_regex.findall(auth_header)}
+        signature = oauth_params.pop("oauth_signature", None)
+        if signature is None:
+            return "missing oauth_signature"
+        if oauth_params.get("oauth_consumer_key") != self.credentials["consumer_key"]:
+            return "unknown consumer key"
+        if oauth_params.get("oauth_token") != self.credentials["access_token"]:
+            return "unknown access token"
+
+        try:
+            timestamp = int(oauth_params.get("oauth_timestamp"))
+        except (TypeError, ValueError):
+            return "bad oauth_timestamp"
+        if abs(self._clock() - timestamp) > max_timestamp_skew:
+            return "oauth_timestamp too far from server time"
+
+        nonce = oauth_params.get("oauth_nonce")
+        if not nonce or nonce in self._nonces:
+            return "missing or reused oauth_nonce"
+
+        base_url = str(request.url.with_query(None))
+        expected_signature = twitter.client._make_signature(
+                self.logger, request.method, base_url, request_params, oauth_params,
+                self.credentials["consumer_secret"], self.credentials["access_token_secret"])
+        if signature != expected_signature:
+            return "signature mismatch"
+
+        self._nonces[nonce] = None
+        while len(self._nonces) > max_remembered_nonces:
+            self._nonces.popitem(last=False)
+        return None
+
+    def _get_account(self, screen_name):
+        key = screen_name.lower()
+        account = self._accounts.get(key)
+        if account is None:
+            account = self._accounts[key] = _Account(
+                    self.rng, screen_name, self.tweets_per_day, self._clock())
+        account.advance(self._clock(), self._id_source)
+        return account
+
+    def _get_list(self, request_params):
+        ''' Return the member screen names of the requested list, creating it if needed.
+            Returns None if the request doesn't identify a list.
+        '''
+        owner = request_params.get("owner_screen_name")
+        slug = request_params.get("slug")
+        if not owner or not slug:
+            return None
+        key = (owner.lower(), slug)
+        members = self._lists.get(key)
+        if members is None:
+            members = self._lists[key] = [
+                "%s_%d" % (slug[:9], index) for index in range(self.list_members)]
+        return members
+
+    def _make_list_data(self, request_params, members):
+        return {
+            "slug": request_params["slug"],
+            "name": request_params["slug"],
+            "member_count": len(members),
+            "user": {"screen_name": request_params["owner_screen_name"]},
+        }
+
+    @staticmethod
+    def _make_tweet_data(tweet_id, screen_name):
+        return {
+            "id": tweet_id,
+            "id_str": str(tweet_id),
+            "text": "Tweet %d from @%s" % (tweet_id, screen_name),
+            "user": {"screen_name": screen_name},
+        }
+
+    @staticmethod
+    def _get_timeline_params(request_params):
+        ''' Return a three-part tuple: (count, since_id, max_id). '''
+        since_id = request_params.get("since_id")
+        max_id = request_params.get("max_id")
+        return (min(int(request_params.get("count", 20)), 200),
+                int(since_id) if since_id else None,
+                int(max_id) if max_id else None)
+
+    def _handle_list_statuses(self, request_params):
+        members = self._get_list(request_params)
+        if members is None:
+            return (404, _error_response_data(34, "Sorry, that page does not exist."))
+
+        count, since_id, max_id = self._get_timeline_params(request_params)
+        timelines = []
+        for screen_name in members:
+            account = self._get_account(screen_name)
+            timelines.append([(tweet_id, account.screen_name) for tweet_id in
+                              account.query(count, since_id=since_id, max_id=max_id)])
+
+        # Each member's timeline is newest first, so merge them into one newest first timeline
+        merged = heapq.merge(*timelines, reverse=True)
+        return (200, [self._make_tweet_data(tweet_id, screen_name)
+                      for tweet_id, screen_name in itertools.islice(merged, count)])
+
+    def _handle_user_timeline(self, request_params):
+        screen_name = request_params.get("screen_name")
+        if not screen_name or not twitter.client.screen_name_regex.match(screen_name):
+            return (404, _error_response_data(34, "Sorry, that page does not exist."))
+
+        count, since_id, max_id = self._get_timeline_params(request_params)
+        account = self._get_account(screen_name)
+        return (200, [self._make_tweet_data(tweet_id, account.screen_name) for tweet_id in
+                      account.query(count, since_id=since_id, max_id=max_id)])
+
+    def _handle_list_show(self, request_params):
+        members = self._get_list(request_params)
+        if members is None:
+            return (404, _error_response_data(34, "Sorry, that page does not exist."))
+        return (200, self._make_list_data(request_params, members))
+
+    def _handle_list_members_create(self, request_params):
+        members = self._get_list(request_params)
+        if members is None:
+            return (404, _error_response_data(34, "Sorry, that page does not exist."))
+
+        known = {screen_name.lower() for screen_name in members}
+        for screen_name in request_params.get("screen_name", "").split(","):
+            if screen_name and screen_name.lower() not in known:
+                members.append(screen_name)
+                known.add(screen_name.lower())
+        return (200, self._make_list_data(request_params, members))
+
+    def _handle_list_members_destroy(self, request_params):
+        members = self._get_list(request_params)
+        if members is None:
+            return (404, _error_response_data(34, "Sorry, that page does not exist."))
+
+        removed = {screen_name.lower()
+                   for screen_name in request_params.get("screen_name", "").split(",")}
+        members[:] = [screen_name for screen_name in members
+                      if screen_name.lower() not in removed]
+        return (200, self._make_list_data(request_params, members))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="mean response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with a 503 error")
+    parser.add_argument("--rate-limit", type=int, default=900,
+                        help="requests allowed per endpoint family per window")
+    parser.add_argument("--rate-limit-window", type=int, default=900,
+                        help="rate limit window in seconds")
+    parser.add_argument("--tweets-per-day", type=float, default=20.0,
+                        help="typical tweets per day per account")
+    parser.add_argument("--list-members", type=int, default=100,
+                        help="members in each newly created list")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = StandinTwitterServer(
+            utils.config.get().get_twitter_config(),
+            latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+            rate_limit_window=args.rate_limit_window, tweets_per_day=args.tweets_per_day,
+            list_members=args.list_members, seed=args.seed)
+    aiohttp.web.run_app(server.make_app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
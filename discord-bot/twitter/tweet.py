@@ -0,0 +1,62 @@
+''' Compact tweet records decoded from Twitter API responses.
+
+    Timeline responses carry full tweet objects (entities, user profiles and more), but the
+    bot only ever reads a tweet's ID and its author's screen name. Decoding projects each tweet
+    down to just those fields so large pages don't stay resident as nested dicts.
+'''
+
+import logging
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+class Tweet(object):
+    ''' The fields of a tweet that the bot uses. '''
+    __slots__ = ['id', 'screen_name']
+
+    def __init__(self, tweet_id, screen_name):
+        self.id = tweet_id
+        self.screen_name = screen_name
+
+    def __repr__(self):
+        return "Tweet(%r, %r)" % (self.id, self.screen_name)
+
+    @property
+    def url(self):
+        ''' The URL of the tweet on twitter.com. '''
+        return "https://twitter.com/%s/status/%s" % (self.screen_name, self.id)
+
+    @classmethod
+    def from_data(cls, tweet_data):
+        ''' Project a tweet object from the Twitter API into a Tweet.
+            Returns None if the tweet object lacks a required field.
+        '''
+        try:
+            return cls(tweet_data["id"], tweet_data["user"]["screen_name"])
+        except (KeyError, TypeError):
+            logger.warning("Tweet.from_data: Bad tweet data from Twitter API, missing id or"
+                    " user screen_name field: %r", tweet_data)
+            return None
+
+def decode_response(raw_data):
+    ''' Decode a JSON response body from a Twitter timeline endpoint.
+        - If the body is an array of tweets, return a list of Tweet objects. Malformed
+          tweets are left out.
+        - Otherwise (for example, an error response), return the decoded JSON as is.
+    '''
+    resp_data = _loads(raw_data)
+    if not isinstance(resp_data, list):
+        return resp_data
+
+    results = []
+    for tweet_data in resp_data:
+        tweet = Tweet.from_data(tweet_data)
+        if tweet is not None:
+            results.append(tweet)
+    return results
@@ -45,14 +45,27 @@ class _Config(object):
         self._discord = None
         self._database = None
         self._logging = None
+        self._logging_queue = None
         self._twitter = None
+        self._stream_notifications = None
+        self._metrics = None
+        self._loop_monitor = None
+        self._overload = None
+        self._profiling = None
+        self._memory = None
 
         self.load()
 
     def get_logging_config(self):
-        """ Returns the "logging" section of the bot configuration. """
+        """ Returns the "logging" section of the bot configuration, without the "queue" key,
+            ready for logging.config.dictConfig.
+        """
         return self._logging
 
+    def get_logging_queue_config(self):
+        """ Returns the "queue" key of the "logging" section of the bot configuration. """
+        return self._logging_queue
+
     def get_jaeger_config(self):
         """ Returns the "jaeger" section of the bot configuration. """
         return self._jaeger
@@ -69,6 +82,30 @@ class _Config(object):
         """ Returns the "twitter" section of the bot configuration. """
         return self._twitter
 
+    def get_stream_notifications_config(self):
+        """ Returns the "stream_notifications" section of the bot configuration. """
+        return self._stream_notifications
+
+    def get_metrics_config(self):
+        """ Returns the "metrics" section of the bot configuration. """
+        return self._metrics
+
+    def get_loop_monitor_config(self):
+        """ Returns the "loop_monitor" section of the bot configuration. """
+        return self._loop_monitor
+
+    def get_overload_config(self):
+        """ Returns the "overload" section of the bot configuration. """
+        return self._overload
+
+    def get_profiling_config(self):
+        """ Returns the "profiling" section of the bot configuration. """
+        return self._profiling
+
+    def get_memory_config(self):
+        """ Returns the "memory" section of the bot configuration. """
+        return self._memory
+
     def load(self):
         """ Load the JSON configuration from disk.
             Raise RuntimeError if config is not present or lacks required features.
@@ -114,6 +151,10 @@ class _Config(object):
             self._logging = _get_config_section(
                 self._raw_config, "logging",
                 optional=True)
+            # dictConfig doesn't know about the queue settings, so separate them
+            if self._logging:
+                self._logging = dict(self._logging)
+                self._logging_queue = self._logging.pop("queue", None)
 
             self._twitter = _get_config_section(
                 self._raw_config, "twitter",
@@ -121,6 +162,31 @@ class _Config(object):
                                "access_token", "access_token_secret"),
                 optional=True)
 
+            self._stream_notifications = _get_config_section(
+                self._raw_config, "stream_notifications",
+                optional=True)
+
+            self._metrics = _get_config_section(
+                self._raw_config, "metrics",
+                required_keys=("port",),
+                optional=True)
+
+            self._loop_monitor = _get_config_section(
+                self._raw_config, "loop_monitor",
+                optional=True)
+
+            self._overload = _get_config_section(
+                self._raw_config, "overload",
+                optional=True)
+
+            self._profiling = _get_config_section(
+                self._raw_config, "profiling",
+                optional=True)
+
+            self._memory = _get_config_section(
+                self._raw_config, "memory",
+                optional=True)
+
         except KeyError as exc:
             error_message = "Failed to load config due to exception: %r" % (exc,)
             self.logger.error(error_message)
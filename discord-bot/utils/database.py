@@ -2,9 +2,13 @@
     database that stores our data.
 '''
 
+import functools
+import time
+
 import redis
 
 import utils.config
+import utils.metrics
 
 # Some of these keys use 'server' as a synonym for 'guild',
 # since they predate Discord.py version 1.x where the naming changed.
@@ -15,6 +19,7 @@ multi_member_set_key = 'multimember'
 
 hash_key = 'hash'
 set_key = 'set'
+sorted_set_key = 'zset'
 
 def get():
     """ Return the Database object. """
@@ -22,6 +27,24 @@ def get():
         _Database.instance = _Database()
     return _Database.instance
 
+operation_seconds = utils.metrics.histogram(
+    "discord_bot_database_operation_seconds",
+    "Time taken by database operations, including pipelines, by _Database method",
+    ("operation",))
+
+def _timed(method):
+    """ Decorator recording how long each call to a _Database method takes. """
+    child = operation_seconds.labels(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            child.observe(time.perf_counter() - start_time)
+    return wrapper
+
 def _make_key(*parts):
     # Ensure keys are byte strings based on utf-8 encoding
     parts = [str(part) for part in parts]
@@ -37,62 +60,123 @@ class _Database(object):
 
     # Guild-specific data
 
+    @_timed
     def get_guild_specific_hash_data(self, guild_id):
         """ Return database data associated with the guild identified by guild_id. """
         return self._db.hgetall(_make_key(discord_guild_key, hash_key, guild_id))
 
+    @_timed
     def set_guild_specific_hash_data(self, guild_id, guild_data_dict):
         """ Set database data associated with the guild identified by guild_id. """
         return self._db.hmset(_make_key(discord_guild_key, hash_key, guild_id), guild_data_dict)
 
+    @_timed
     def add_item_to_guild_specific_set(self, guild_id, set_name, item):
         """ Add an item to the data set associated with the guild identified by guild_id. """
         return self._db.sadd(_make_key(discord_guild_key, set_key, set_name, guild_id), item)
 
+    @_timed
     def remove_item_from_guild_specific_set(self, guild_id, set_name, item):
         """ Remove an item from the data set associated with the guild identified by guild_id. """
         return self._db.srem(_make_key(discord_guild_key, set_key, set_name, guild_id), item)
 
+    @_timed
     def get_guild_specific_set_members(self, guild_id, set_name):
         """ Return the data set associated with the guild identified by guild_id. """
         return self._db.smembers(_make_key(discord_guild_key, set_key, set_name, guild_id))
 
+    @_timed
+    def add_item_to_guild_specific_capped_sorted_set(self, guild_id, set_name, item, score,
+            max_items):
+        """ Add an item to the sorted set associated with the guild identified by guild_id,
+            then trim the set to the max_items highest scoring items.
+            Return True if the item was added, or False if it was already in the set.
+        """
+        key = _make_key(discord_guild_key, sorted_set_key, set_name, guild_id)
+        pipeline = self._db.pipeline()
+        # ZADD's argument order differs between redis-py versions, so send the command directly
+        pipeline.execute_command('ZADD', key, 'NX', score, item)
+        pipeline.zremrangebyrank(key, 0, -(max_items + 1))
+        added, _ = pipeline.execute()
+        return bool(added)
+
+    @_timed
+    def remove_item_from_guild_specific_sorted_set(self, guild_id, set_name, item):
+        """ Remove an item from the sorted set associated with the guild identified by guild_id. """
+        return self._db.zrem(
+            _make_key(discord_guild_key, sorted_set_key, set_name, guild_id), item)
+
+    @_timed
+    def get_guild_specific_sorted_set_members(self, guild_id, set_name):
+        """ Return the items in the sorted set associated with the guild identified by guild_id. """
+        return self._db.zrange(
+            _make_key(discord_guild_key, sorted_set_key, set_name, guild_id), 0, -1)
+
     # Guild Member-specific data
 
+    @_timed
     def get_member_specific_hash_data(self, guild_id, member_id):
         """ Return database data associated with the guild identified by guild_id. """
         return self._db.hgetall(_make_key(
             discord_guild_member_key, hash_key, guild_id, member_id))
 
+    @_timed
     def set_member_specific_hash_data(self, guild_id, member_id, member_data_dict):
         """ Set database data associated with the guild identified by guild_id. """
         return self._db.hmset(_make_key(
                 discord_guild_member_key, hash_key, guild_id, member_id), member_data_dict)
 
+    @_timed
+    def get_member_specific_hash_data_bulk(self, guild_member_ids):
+        """ Return database data for many members at once, given a list of two-part tuples:
+            [(guild_id, member_id), ...]. Results are returned in the same order.
+        """
+        pipeline = self._db.pipeline()
+        for guild_id, member_id in guild_member_ids:
+            pipeline.hgetall(_make_key(discord_guild_member_key, hash_key, guild_id, member_id))
+        return pipeline.execute()
+
+    @_timed
+    def set_member_specific_hash_data_bulk(self, guild_member_data):
+        """ Set database data for many members at once, given a list of three-part tuples:
+            [(guild_id, member_id, member_data_dict), ...].
+        """
+        pipeline = self._db.pipeline()
+        for guild_id, member_id, member_data_dict in guild_member_data:
+            pipeline.hmset(_make_key(
+                discord_guild_member_key, hash_key, guild_id, member_id), member_data_dict)
+        return pipeline.execute()
+
     # Sets of guilds
 
+    @_timed
     def add_guild_to_multi_guild_set(self, set_key_suffix, guild_id):
         """ Add a guild_id to a multi-guild set. """
         return self._db.sadd(_make_key(multi_guild_set_key, set_key_suffix), guild_id)
 
+    @_timed
     def remove_guild_from_multi_guild_set(self, set_key_suffix, guild_id):
         """ Remove a guild_id from a multi-guild set. """
         return self._db.srem(_make_key(multi_guild_set_key, set_key_suffix), guild_id)
 
+    @_timed
     def get_multi_guild_set_members(self, set_key_suffix):
         """ Return the data associated with a multi-guild set. """
         return self._db.smembers(_make_key(multi_guild_set_key, set_key_suffix))
 
     # Sets of members
 
+    @_timed
     def add_member_to_multi_member_set(self, set_key_suffix, member_id):
         """ Add a member_id to a multi-member set. """
         return self._db.sadd(_make_key(multi_member_set_key, set_key_suffix), member_id)
 
+    @_timed
     def remove_member_from_multi_member_set(self, set_key_suffix, member_id):
         """ Remove a member_id from a multi-member set. """
         return self._db.srem(_make_key(multi_member_set_key, set_key_suffix), member_id)
 
+    @_timed
     def get_multi_member_set_members(self, set_key_suffix):
         """ Return the data associated with a multi-member set. """
         return self._db.smembers(_make_key(multi_member_set_key, set_key_suffix))
@@ -4,11 +4,14 @@
     - A GuildDataMap class, intended as the access point for GuildData objects.
 '''
 import logging
+import time
 
 import discord
 
 import utils.database
 import utils.member
+import utils.memory
+import utils.overload
 
 command_prefix_hash_key = 'command_prefix'
 member_role_hash_key = 'member_role'
@@ -16,6 +19,11 @@ officer_role_hash_key = 'officer_role'
 member_assignable_role_names_set_key = 'member_assignable_role_names'
 
 twitch_target_channel_hash_key = 'twitch_target_channel'
+twitter_next_post_time_hash_key = 'twitter_next_post_time'
+twitter_posted_tweets_sorted_set_key = 'twitter_posted_tweets'
+
+webhook_posting_hash_key = 'webhook_posting'
+webhook_url_hash_key_prefix = 'webhook_url'
 
 guild_default_command_prefix = '!'
 
@@ -32,15 +40,17 @@ class _GuildDataMap(object):
         self.logger = logging.getLogger(__name__)
         self.database = database
         self._map = {}
+        utils.memory.register_cache("guild_data", lambda: self._map)
 
     def get(self, guild):
         """ Get data associated with a guild. """
         guild_id = getattr(guild, "id", None)
         if not guild_id:
             return None
-        guild_data = self._map.setdefault(
-            guild_id,
-            _GuildData(self.database, guild))
+        # Only construct GuildData (which reads from the database) for guilds we haven't seen
+        guild_data = self._map.get(guild_id)
+        if guild_data is None:
+            guild_data = self._map[guild_id] = _GuildData(self.database, guild)
         return guild_data
 
 class _GuildData(object):
@@ -53,6 +63,7 @@ class _GuildData(object):
         self.guild = guild
         self._hash = {}
         self._member_assignable_roles = []
+        self._text_channel_ids = {} # Maps channel names to IDs, checked on each use
         self.update()
 
     def update(self):
@@ -88,9 +99,11 @@ class _GuildData(object):
                               'could not get member role name, returning False')
             return False
 
-        self.logger.debug('guild._GuildData.user_has_member_permissions: '
-                          'member_role_name = %r, member.roles = %r',
-                          member_role_name, member.roles)
+        # Building member.roles is costly, so only do it for debug logs when not overloaded
+        if self.logger.isEnabledFor(logging.DEBUG) and utils.overload.get().is_tracing_enabled():
+            self.logger.debug('guild._GuildData.user_has_member_permissions: '
+                              'member_role_name = %r, member.roles = %r',
+                              member_role_name, member.roles)
         for role in member.roles:
             if role.name == member_role_name:
                 return True
@@ -111,9 +124,10 @@ class _GuildData(object):
                               'could not get officer role name, returning False')
             return False
 
-        self.logger.debug('guild._GuildData.user_has_officer_permissions: '
-                          'officer_role_name = %r, member.roles = %r',
-                          officer_role_name, member.roles)
+        if self.logger.isEnabledFor(logging.DEBUG) and utils.overload.get().is_tracing_enabled():
+            self.logger.debug('guild._GuildData.user_has_officer_permissions: '
+                              'officer_role_name = %r, member.roles = %r',
+                              officer_role_name, member.roles)
         for role in member.roles:
             if role.name == officer_role_name:
                 return True
@@ -201,6 +215,68 @@ class _GuildData(object):
         self.database.set_guild_specific_hash_data(self.guild.id, data)
         self.update()
 
+    def get_twitter_next_post_time(self):
+        """ Return the time at which Tweets are next due to be posted to this guild. """
+        try:
+            return float(self._hash.get(
+                twitter_next_post_time_hash_key.encode('utf-8')).decode('utf-8'))
+        except Exception:
+            return None
+
+    def set_twitter_next_post_time(self, next_post_time):
+        """ Set the time at which Tweets are next due to be posted to this guild. """
+        data = {twitter_next_post_time_hash_key: str(next_post_time)}
+        self.database.set_guild_specific_hash_data(self.guild.id, data)
+        self.update()
+
+    def get_twitter_posted_tweet_ids(self, channel):
+        """ Return the set of IDs of tweets recently posted to a channel. """
+        set_name = '%s:%s' % (twitter_posted_tweets_sorted_set_key, channel.id)
+        return {int(tweet_id) for tweet_id in
+                self.database.get_guild_specific_sorted_set_members(self.guild.id, set_name)}
+
+    def add_twitter_posted_tweet_id(self, channel, tweet_id, max_tweets):
+        """ Record that a tweet is being posted to a channel, remembering up to max_tweets of
+            the most recent ones. Return False if it was already recorded.
+        """
+        set_name = '%s:%s' % (twitter_posted_tweets_sorted_set_key, channel.id)
+        return self.database.add_item_to_guild_specific_capped_sorted_set(
+            self.guild.id, set_name, tweet_id, time.time(), max_tweets)
+
+    def remove_twitter_posted_tweet_id(self, channel, tweet_id):
+        """ Forget that a tweet was posted to a channel. """
+        set_name = '%s:%s' % (twitter_posted_tweets_sorted_set_key, channel.id)
+        self.database.remove_item_from_guild_specific_sorted_set(
+            self.guild.id, set_name, tweet_id)
+
+    def get_webhook_posting_enabled(self):
+        """ Return True if scheduled and notification messages should be sent by webhook. """
+        try:
+            return self._hash.get(webhook_posting_hash_key.encode('utf-8')) == b'1'
+        except Exception:
+            return False
+
+    def set_webhook_posting_enabled(self, enabled):
+        """ Set whether scheduled and notification messages should be sent by webhook. """
+        data = {webhook_posting_hash_key: '1' if enabled else '0'}
+        self.database.set_guild_specific_hash_data(self.guild.id, data)
+        self.update()
+
+    def get_webhook_url(self, channel):
+        """ Return the URL of the webhook cached for a channel, or None. """
+        key = '%s:%s' % (webhook_url_hash_key_prefix, channel.id)
+        try:
+            return self._hash.get(key.encode('utf-8')).decode('utf-8') or None
+        except Exception:
+            return None
+
+    def set_webhook_url(self, channel, webhook_url):
+        """ Cache the URL of a channel's webhook. An empty string forgets it. """
+        key = '%s:%s' % (webhook_url_hash_key_prefix, channel.id)
+        data = {key: webhook_url}
+        self.database.set_guild_specific_hash_data(self.guild.id, data)
+        self.update()
+
     def get_role_from_name(self, role_name):
         """ Return a guild Role with the provided role name. """
         for role in self.guild.roles:
@@ -212,7 +288,15 @@ class _GuildData(object):
         ''' Given a text channel name (string), return the channel name.
             Otherwise, return None.
         '''
+        # Channels can be renamed or deleted, so confirm a remembered channel still matches
+        channel_id = self._text_channel_ids.get(name)
+        if channel_id is not None:
+            channel = self.guild.get_channel(channel_id)
+            if channel is not None and channel.name == name:
+                return channel
+
         for channel in self.guild.channels:
             if channel.name == name and channel.type == discord.ChannelType.text:
+                self._text_channel_ids[name] = channel.id
                 return channel
         return None
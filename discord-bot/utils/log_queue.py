@@ -0,0 +1,183 @@
+""" Asynchronous logging through a bounded queue.
+
+    When the "logging" config section has a "queue" key, the root logger's handlers are moved
+    behind a queue that a background thread drains. Logging calls on the event loop then only
+    prepare a record and put it on the queue, instead of writing to files or streams.
+    If the queue is full, records are dropped according to the drop policy, and a warning
+    saying how many were dropped is logged once there's room again.
+
+    For example:
+
+        "logging": {
+            "version": 1,
+            ...
+            "queue": {"max_size": 10000, "drop_policy": "drop_oldest"}
+        }
+
+    Records keep their attributes through the queue, so they can be formatted as JSON lines
+    by using JsonFormatter as a formatter factory:
+
+        "formatters": {"json": {"()": "utils.log_queue.JsonFormatter"}}
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+import utils.metrics
+
+default_max_size = 10000
+drop_newest = "drop_newest" # Discard records that arrive while the queue is full
+drop_oldest = "drop_oldest" # Discard the oldest queued record to make room
+drop_policies = (drop_newest, drop_oldest)
+# On shutdown, wait this long for room to ask the background thread to stop, in seconds
+stop_timeout = 5
+
+dropped_records = utils.metrics.counter(
+    "discord_bot_log_records_dropped_total",
+    "Log records dropped because the log queue was full, by level",
+    ("level",))
+
+# Attributes every LogRecord has. Any others were passed with extra= and are included in JSON.
+_standard_record_attributes = frozenset(logging.makeLogRecord({}).__dict__) | {"message"}
+
+_listener = None
+_handler = None
+
+def install(queue_config):
+    """ Move the root logger's handlers behind a queue drained by a background thread.
+        Raises ValueError if the config is invalid.
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return
+
+    max_size = queue_config.get("max_size", default_max_size)
+    drop_policy = queue_config.get("drop_policy", drop_newest)
+    if drop_policy not in drop_policies:
+        raise ValueError("Unknown log queue drop_policy %r, expected one of %r" % (
+            drop_policy, drop_policies))
+
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    record_queue = queue.Queue(maxsize=max_size)
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+    _handler = _BoundedQueueHandler(record_queue, drop_policy)
+    root_logger.addHandler(_handler)
+
+    _listener = _QueueWriter(record_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    logging.getLogger(__name__).info(
+        "Logging through a queue of up to %d records, with policy %r", max_size, drop_policy)
+
+def stop():
+    """ Write out queued records and stop the background thread. Never raises, since it's
+        called while the bot is exiting.
+    """
+    global _listener, _handler
+    if _listener is None:
+        return
+    # Records logged from now on mustn't displace the sentinel that stops the thread
+    _handler.stopping = True
+    _listener.stop()
+    _listener, _handler = None, None
+
+class _QueueWriter(logging.handlers.QueueListener):
+    ''' A QueueListener whose stop waits a limited time for room in a full queue and for the
+        writer to finish, rather than raising or hanging.
+    '''
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel, timeout=stop_timeout)
+
+    def stop(self):
+        deadline = time.monotonic() + stop_timeout
+        try:
+            self.enqueue_sentinel()
+            self._thread.join(max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        if self._thread.is_alive():
+            # The writer is stuck, so give up on the queued records. It's a daemon thread,
+            # so it won't keep the process alive.
+            sys.stderr.write("Log writer didn't drain the log queue within %d seconds, "
+                             "%d records were not written\n" % (stop_timeout, self.queue.qsize()))
+        self._thread = None
+
+class _BoundedQueueHandler(logging.handlers.QueueHandler):
+    ''' Puts records on a bounded queue without blocking, dropping records when it's full. '''
+    def __init__(self, record_queue, drop_policy):
+        super(_BoundedQueueHandler, self).__init__(record_queue)
+        self.drop_policy = drop_policy
+        self.dropped_count = 0 # Dropped since the last report
+        self.stopping = False # Set during shutdown, after which queued records are kept
+
+    def prepare(self, record):
+        ''' Make the record safe to handle on another thread, keeping its attributes. Unlike
+            QueueHandler.prepare, the message isn't formatted into a line here, so the writer's
+            formatters still see the separate fields.
+        '''
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            # Tracebacks reference frames that can change once the handler returns
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.dropped_count and self.queue.qsize() < self.queue.maxsize - 1:
+            self._report_dropped_records()
+
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.drop_policy == drop_oldest and not self.stopping:
+            try:
+                oldest_record = self.queue.get_nowait()
+                self.queue.put_nowait(record)
+                record = oldest_record
+            except (queue.Empty, queue.Full):
+                pass
+
+        self.dropped_count += 1
+        dropped_records.labels(record.levelname).inc()
+
+    def _report_dropped_records(self):
+        dropped_count, self.dropped_count = self.dropped_count, 0
+        report = logging.makeLogRecord({
+            "name": __name__,
+            "levelno": logging.WARNING,
+            "levelname": logging.getLevelName(logging.WARNING),
+            "msg": "Dropped %d log records because the log queue was full" % (dropped_count,),
+            "dropped_count": dropped_count,
+        })
+        try:
+            self.queue.put_nowait(report)
+        except queue.Full:
+            self.dropped_count += dropped_count
+
+class JsonFormatter(logging.Formatter):
+    ''' Formats records as single-line JSON objects, including any extra= attributes. '''
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _standard_record_attributes:
+                data[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["traceback"] = record.exc_text
+        return json.dumps(data, default=repr)
@@ -0,0 +1,166 @@
+""" Monitoring of event loop lag, and detection of calls that block the event loop.
+
+    A task wakes up at a fixed interval and measures how late it ran. Meanwhile a watchdog
+    thread checks that the task keeps running: if it hasn't run for longer than the blocking
+    threshold, something is holding up the event loop, so the watchdog captures the event
+    loop thread's stack to show which call site is responsible.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import asyncio
+
+import utils.config
+import utils.metrics
+import utils.misc
+
+# How often to measure lag, in seconds
+default_sample_interval = 0.25
+# Capture a stack when the event loop is blocked for longer than this, in seconds
+default_blocking_threshold = 0.5
+# Percentiles cover this many of the latest samples
+default_window_size = 1200
+# Keep this many captured stacks for inspection
+max_recent_stalls = 10
+
+lag_quantiles = (0.5, 0.9, 0.99, 1.0)
+
+lag_seconds = utils.metrics.histogram(
+    "discord_bot_event_loop_lag_seconds",
+    "How much later than scheduled the event loop resumed the lag monitor")
+recent_lag_seconds = utils.metrics.gauge(
+    "discord_bot_event_loop_recent_lag_seconds",
+    "Percentiles of the latest event loop lag samples",
+    ("quantile",))
+stalls = utils.metrics.counter(
+    "discord_bot_event_loop_stalls_total",
+    "Times the event loop was blocked for longer than the blocking threshold")
+
+def get():
+    """ Return the LoopMonitor object. """
+    if not _LoopMonitor.instance:
+        _LoopMonitor.instance = _LoopMonitor()
+    return _LoopMonitor.instance
+
+class _Stall(object):
+    ''' A period where the event loop was blocked, and where it was blocked. '''
+    __slots__ = ['start_time', 'last_tick', 'duration', 'stack']
+
+    def __init__(self, start_time, last_tick, stack):
+        self.start_time = start_time # time.time() when the stall was detected
+        self.last_tick = last_tick # When the monitor last ran before the stall
+        self.duration = None # Set once the event loop runs the monitor again
+        self.stack = stack # Formatted stack of the event loop thread
+
+class _LoopMonitor(object):
+    ''' Measures event loop lag and captures the stacks of blocking calls. '''
+    instance = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.config = utils.config.get()
+
+        loop_monitor_config = self.config.get_loop_monitor_config() or {}
+        self.sample_interval = loop_monitor_config.get(
+            "sample_interval", default_sample_interval)
+        self.blocking_threshold = loop_monitor_config.get(
+            "blocking_threshold", default_blocking_threshold)
+
+        self._samples = collections.deque(maxlen=default_window_size)
+        self.recent_stalls = collections.deque(maxlen=max_recent_stalls) # _Stall objects
+        self.stall_count = 0
+
+        self._task = None
+        self._watchdog_thread = None
+        self._loop_thread_id = None
+        # Written by the event loop thread and read by the watchdog thread. Assignments of
+        # single attributes are atomic, so no lock is needed.
+        self._last_tick = None
+        self._current_stall = None
+
+        recent_lag_seconds.set_function(self._get_lag_quantile_values)
+
+    def start(self):
+        ''' Start monitoring, if it hasn't started already. Call from the event loop thread. '''
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._task = asyncio.ensure_future(self._run())
+
+        self._watchdog_thread = threading.Thread(
+            target=self._watch, name="loop-monitor-watchdog", daemon=True)
+        self._watchdog_thread.start()
+
+    def get_lag_percentile(self, quantile, sample_count=None):
+        ''' Return a percentile of the latest lag samples, in seconds, or 0.0 if there are
+            none. quantile is between 0 and 1. If sample_count is given, only that many of the
+            latest samples are considered.
+        '''
+        if not self._samples:
+            return 0.0
+        samples = list(self._samples)
+        if sample_count:
+            samples = samples[-sample_count:]
+        samples.sort()
+        return samples[min(int(quantile * len(samples)), len(samples) - 1)]
+
+    def _get_lag_quantile_values(self):
+        ''' Return lag percentiles in the form expected by Metric.set_function. '''
+        if not self._samples:
+            return []
+        samples = sorted(self._samples)
+        return [((str(quantile),), samples[min(int(quantile * len(samples)), len(samples) - 1)])
+                for quantile in lag_quantiles]
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                expected_time = loop.time() + self.sample_interval
+                await asyncio.sleep(self.sample_interval)
+                lag = max(loop.time() - expected_time, 0.0)
+                self._last_tick = time.monotonic()
+                self._samples.append(lag)
+                lag_seconds.observe(lag)
+
+                stall, self._current_stall = self._current_stall, None
+                if stall is not None:
+                    stall.duration = self._last_tick - stall.last_tick - self.sample_interval
+                    self.logger.warning(
+                        "Event loop was blocked for about %.3f seconds, at:\n%s",
+                        stall.duration, stall.stack)
+
+            # The only scenario we should abort is when asyncio cancels us
+            except asyncio.CancelledError:
+                break
+
+            except Exception as exc:
+                self.logger.info("Exception in _LoopMonitor._run: %r", exc)
+                utils.misc.log_traceback(self.logger)
+
+    def _watch(self):
+        ''' Runs in the watchdog thread. Capture the event loop thread's stack once per stall. '''
+        while True:
+            time.sleep(self.blocking_threshold / 2)
+            if self._current_stall is not None:
+                continue
+
+            last_tick = self._last_tick
+            if time.monotonic() - last_tick - self.sample_interval < self.blocking_threshold:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stall = _Stall(time.time(), last_tick, ''.join(traceback.format_stack(frame)))
+            del frame
+
+            self.stall_count += 1
+            stalls.inc()
+            self.recent_stalls.append(stall)
+            self._current_stall = stall
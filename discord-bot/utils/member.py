@@ -3,40 +3,70 @@ import logging
 import time
 
 import utils.database
+import utils.memory
 
 last_stream_notify_time_hash_key = 'last_stream_notify_time'
 stream_advertise_cooldown = 21600 # 6 hours
 
-def get(member):
-    """ Get the data associated with this guild member. """
+def get_many(members):
+    """ Get the data associated with many guild members, loading any that aren't cached
+        from the database in a single round trip.
+    """
+    return _get_map().get_many(members)
+
+def update_last_stream_notify_times(member_data_list):
+    """ Mark that we notified for streams by many guild members, in a single database
+        round trip.
+    """
+    _get_map().update_last_stream_notify_times(member_data_list)
+
+def _get_map():
     if not _MemberDataMap.instance:
         _MemberDataMap.instance = _MemberDataMap()
-    return _MemberDataMap.instance.get(member)
+    return _MemberDataMap.instance
 
 class _MemberDataMap(object):
     instance = None
     def __init__(self):
         self.logger = logging.getLogger(__name__)
-        self._map = {}
+        self.database = utils.database.get()
+        self._map = {} # Maps (guild_id, member_id) tuples to _MemberData objects
+        utils.memory.register_cache("member_data", lambda: self._map)
+
+    def get_many(self, members):
+        """ Return a list of member data for these members, in the same order. """
+        missing_members = [member for member in members
+                           if (member.guild.id, member.id) not in self._map]
+        if missing_members:
+            hash_data_list = self.database.get_member_specific_hash_data_bulk(
+                [(member.guild.id, member.id) for member in missing_members])
+            for member, hash_data in zip(missing_members, hash_data_list):
+                self._map[(member.guild.id, member.id)] = _MemberData(member, hash_data)
+
+        member_data_list = [self._map[(member.guild.id, member.id)] for member in members]
+        for member, member_data in zip(members, member_data_list):
+            member_data.member = member
+        return member_data_list
 
-    def get(self, member):
-        """ Return the member data for this member ID. """
-        member_data = self._map.setdefault(member.id, _MemberData(member))
-        return member_data
+    def update_last_stream_notify_times(self, member_data_list):
+        """ Update the last stream notify time of many members at once. """
+        if not member_data_list:
+            return
+        data = {last_stream_notify_time_hash_key: str(time.time())}
+        self.database.set_member_specific_hash_data_bulk(
+            [(member_data.member.guild.id, member_data.member.id, data)
+             for member_data in member_data_list])
+        # We're the only writer, so update cached data without reading it back
+        encoded_data = {key.encode('utf-8'): value.encode('utf-8') for key, value in data.items()}
+        for member_data in member_data_list:
+            member_data._hash.update(encoded_data)
 
 class _MemberData(object):
     """ Collates data about a user from their discord object and from our database. """
-    def __init__(self, member):
+    def __init__(self, member, hash_data):
         self.logger = logging.getLogger(__name__)
-        self.database = utils.database.get()
         self.member = member
-        self._hash = {}
-        self.update()
-
-    def update(self):
-        """ Ensure data consistency with the database. """
-        self._hash = self.database.get_member_specific_hash_data(
-                self.member.guild.id, self.member.id)
+        self._hash = hash_data
 
     def get_last_stream_notify_time(self):
         """ Return the last time this member's stream was advertised. """
@@ -46,14 +76,6 @@ class _MemberData(object):
         except Exception:
             return None
 
-    def update_last_stream_notify_time(self):
-        """ Mark that we notified for a stream so it doesn't happen again for
-            the cooldown period.
-        """
-        data = {last_stream_notify_time_hash_key: str(time.time())}
-        self.database.set_member_specific_hash_data(self.member.guild.id, self.member.id, data)
-        self.update()
-
     def should_advertise_stream(self):
         """ Return True if a stream should be advertised or False otherwise. """
         # Make sure we didn't already advertise a stream for this member recently
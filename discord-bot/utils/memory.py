@@ -0,0 +1,223 @@
+""" Memory accounting for the bot's in-process caches, and tracemalloc snapshot diffs.
+
+    Modules register their caches with register_cache, giving a function that returns the
+    container. Reports then list each cache's entry count and approximate size, so a cache
+    that keeps growing stands out. Sizes are estimated by walking the container with
+    sys.getsizeof: discord.py objects, and this bot's singletons, are counted shallowly since
+    they're shared rather than owned by the cache, and large containers are sampled.
+
+    For leaks outside the registered caches, tracemalloc snapshots can be diffed to show which
+    lines allocated the memory that's grown in between.
+
+    Sizing caches and taking and comparing snapshots are slow, so they run in the default
+    executor rather than on the event loop. The event loop keeps changing the caches meanwhile,
+    so each container's items are copied in a single C call, which other threads can't
+    interrupt, before being walked.
+"""
+import collections
+import itertools
+import logging
+import os
+import sys
+import tracemalloc
+
+import asyncio
+
+import utils.config
+import utils.metrics
+import utils.misc
+
+# Containers with more items than this are sized from a sample of their items
+max_sampled_items = 1000
+default_top_n = 10
+default_tracemalloc_frames = 1
+# Objects from these packages are sized deeply. Anything else is sized shallowly.
+owned_module_prefixes = ("utils.", "twitter.", "handlers.")
+
+cache_entries = utils.metrics.gauge(
+    "discord_bot_cache_entries",
+    "Number of entries in each in-process cache",
+    ("cache",))
+
+def get():
+    """ Return the MemoryMonitor object. """
+    if not _MemoryMonitor.instance:
+        _MemoryMonitor.instance = _MemoryMonitor()
+    return _MemoryMonitor.instance
+
+def register_cache(name, get_container):
+    """ Include a cache in memory reports. get_container is a function returning the cache's
+        container, such as a dict. Registering a name again replaces the previous cache.
+    """
+    get().caches[name] = get_container
+
+def _is_owned(obj):
+    ''' Return True if the object belongs to a cache rather than being shared with others. '''
+    obj_type = type(obj)
+    if not obj_type.__module__.startswith(owned_module_prefixes):
+        return False
+    # Singletons, which use an "instance" class attribute, are shared
+    return not hasattr(obj_type, "instance")
+
+_sequence_types = (list, tuple, set, frozenset, collections.deque)
+
+def _get_children(obj):
+    ''' Return an iterable of the objects referred to by a container or an owned object.
+        Only the first max_sampled_items items of a container are included.
+    '''
+    if isinstance(obj, dict):
+        return itertools.chain.from_iterable(
+            list(itertools.islice(obj.items(), max_sampled_items)))
+    if isinstance(obj, _sequence_types):
+        return list(itertools.islice(obj, max_sampled_items))
+    if _is_owned(obj):
+        children = list(getattr(obj, "__dict__", {}).values())
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                children.append(getattr(obj, slot))
+        return children
+    return ()
+
+def get_approximate_size(obj, seen=None):
+    """ Return the approximate size of an object and everything it owns, in bytes. """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    children_size = sum(get_approximate_size(child, seen) for child in _get_children(obj))
+    # Extrapolate from the sampled items of large containers
+    if isinstance(obj, (dict,) + _sequence_types) and len(obj) > max_sampled_items:
+        children_size = children_size * len(obj) // max_sampled_items
+    return sys.getsizeof(obj) + children_size
+
+def _get_rss():
+    ''' Return the process's resident set size in bytes, or None if it's unknown. '''
+    try:
+        with open("/proc/self/statm") as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GiB" % (size,)
+
+class _MemoryMonitor(object):
+    ''' Reports cache sizes and tracemalloc diffs, on demand or periodically. '''
+    instance = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.config = utils.config.get()
+        memory_config = self.config.get_memory_config() or {}
+        self.report_interval = memory_config.get("report_interval")
+        self.report_tracemalloc_diffs = memory_config.get("report_tracemalloc_diffs", False)
+        self.top_n = memory_config.get("top_n", default_top_n)
+        self.tracemalloc_frames = memory_config.get(
+            "tracemalloc_frames", default_tracemalloc_frames)
+
+        self.caches = collections.OrderedDict() # Maps names to functions returning containers
+        self._baselines = {} # Maps names to tracemalloc snapshots to compare with
+        self._task = None
+        cache_entries.set_function(self._get_cache_entry_counts)
+
+    def _get_cache_entry_counts(self):
+        ''' Return cache entry counts in the form expected by Metric.set_function. '''
+        return [((name,), len(get_container())) for name, get_container in self.caches.items()]
+
+    def get_cache_report(self):
+        """ Return a list of three-part tuples: [(cache_name, entry_count, approximate_size)]. """
+        report = []
+        for name, get_container in self.caches.items():
+            container = get_container()
+            report.append((name, len(container), get_approximate_size(container)))
+        return report
+
+    def _format_cache_report(self):
+        rss = _get_rss()
+        lines = ["Resident memory: %s" % (_format_size(rss) if rss is not None else "unknown",)]
+        for name, entry_count, size in self.get_cache_report():
+            lines.append("%-34s %8d entries %12s" % (name, entry_count, _format_size(size)))
+        return '\n'.join(lines)
+
+    async def format_cache_report(self):
+        """ Return a human readable report of process and cache memory usage. """
+        return await asyncio.get_event_loop().run_in_executor(None, self._format_cache_report)
+
+    def _format_snapshot_diff(self, snapshot, baseline):
+        stats = snapshot.compare_to(baseline, "lineno")
+        traced_size, traced_peak = tracemalloc.get_traced_memory()
+        lines = ["Traced memory: %s (peak %s)" % (
+            _format_size(traced_size), _format_size(traced_peak))]
+        lines.extend(str(stat) for stat in stats[:self.top_n])
+        return '\n'.join(lines)
+
+    async def take_snapshot_diff(self, baseline_name):
+        """ Take a tracemalloc snapshot and compare it with the previous one of the same name,
+            which it then replaces. Tracing starts on the first call, so it returns None then.
+            Otherwise it returns a report of the lines whose allocations grew most.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+            self.logger.info("Started tracing memory allocations")
+
+        loop = asyncio.get_event_loop()
+        snapshot = await loop.run_in_executor(None, _take_snapshot)
+        baseline = self._baselines.get(baseline_name)
+        self._baselines[baseline_name] = snapshot
+        if baseline is None:
+            return None
+        return await loop.run_in_executor(
+            None, self._format_snapshot_diff, snapshot, baseline)
+
+    def stop_tracing(self, baseline_name):
+        """ Forget the snapshot of this name. Tracing memory allocations stops once no
+            snapshots remain. Returns True if tracing stopped, or False if other snapshots
+            still need it.
+        """
+        self._baselines.pop(baseline_name, None)
+        if self._baselines:
+            return False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.logger.info("Stopped tracing memory allocations")
+        return True
+
+    def start(self):
+        """ Start the periodic report task, if one is configured and it isn't running. """
+        if not self.report_interval:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """ Log memory reports periodically. """
+        while True:
+            try:
+                await asyncio.sleep(self.report_interval)
+                self.logger.info("Memory report:\n%s", await self.format_cache_report())
+                if not self.report_tracemalloc_diffs:
+                    continue
+                diff = await self.take_snapshot_diff("periodic")
+                if diff:
+                    self.logger.info("Memory allocation changes since the last report:\n%s", diff)
+
+            # The only scenario we should abort is when asyncio cancels us
+            except asyncio.CancelledError:
+                break
+
+            except Exception as exc:
+                self.logger.info("Exception in _MemoryMonitor.run: %r", exc)
+                utils.misc.log_traceback(self.logger)
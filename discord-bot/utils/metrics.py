@@ -0,0 +1,237 @@
+""" A small metrics registry, served over HTTP in the Prometheus text format.
+
+    Modules declare their metrics at import time, for example:
+
+        dispatch_seconds = utils.metrics.histogram(
+            "discord_bot_dispatch_seconds", "Time taken to dispatch commands",
+            ("handler", "outcome"))
+        ...
+        dispatch_seconds.labels("twitter", "applied").observe(elapsed)
+
+    Updating a metric is a dictionary lookup and some arithmetic, so it's cheap enough for hot
+    paths. Nothing is served unless the optional "metrics" config section is present.
+"""
+
+import bisect
+import logging
+
+import aiohttp.web
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def get():
+    """ Return the metrics Registry object. """
+    if not _Registry.instance:
+        _Registry.instance = _Registry()
+    return _Registry.instance
+
+def counter(name, documentation, label_names=()):
+    """ Return the Counter with this name, registering it if needed. """
+    return get().register(name, Counter, documentation, label_names)
+
+def gauge(name, documentation, label_names=()):
+    """ Return the Gauge with this name, registering it if needed. """
+    return get().register(name, Gauge, documentation, label_names)
+
+def histogram(name, documentation, label_names=(), buckets=default_buckets):
+    """ Return the Histogram with this name, registering it if needed. """
+    return get().register(name, Histogram, documentation, label_names, buckets=buckets)
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape_label_value(value))
+             for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join(pairs),)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class _Metric(object):
+    ''' Base class for metrics. Each combination of label values has its own child. '''
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {} # Maps tuples of label values to children
+        self._function = None
+
+    def labels(self, *label_values):
+        ''' Return the child for these label values, creating it if needed. '''
+        child = self._children.get(label_values)
+        if child is None:
+            assert len(label_values) == len(self.label_names), \
+                "Expected labels %r for %s, got %r" % (self.label_names, self.name, label_values)
+            child = self._children[label_values] = self._make_child()
+        return child
+
+    def set_function(self, function):
+        ''' Take values from a function when rendering, instead of from children. The function
+            must return a list of two-part tuples: [(label_values, value), ...].
+            This suits values that are already counted elsewhere.
+        '''
+        self._function = function
+
+    def _make_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        ''' Return a list of lines in the Prometheus text format. '''
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation.replace('\n', ' ')),
+            '# TYPE %s %s' % (self.name, self.metric_type),
+        ]
+        if self._function is not None:
+            for label_values, value in self._function():
+                lines.append('%s%s %s' % (
+                    self.name, _format_labels(self.label_names, label_values),
+                    _format_value(value)))
+            return lines
+
+        for label_values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, label_values))
+        return lines
+
+class _ValueChild(object):
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0.0
+
+    def render(self, name, label_names, label_values):
+        return ['%s%s %s' % (name, _format_labels(label_names, label_values),
+                             _format_value(self.value))]
+
+class _CounterChild(_ValueChild):
+    __slots__ = []
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class _GaugeChild(_ValueChild):
+    __slots__ = []
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Counter(_Metric):
+    ''' A value that only goes up. '''
+    metric_type = 'counter'
+
+    def _make_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        ''' Increment an unlabelled counter. '''
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    ''' A value that can go up and down. '''
+    metric_type = 'gauge'
+
+    def _make_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        ''' Set an unlabelled gauge. '''
+        self.labels().set(value)
+
+class _HistogramChild(object):
+    __slots__ = ['upper_bounds', 'bucket_counts', 'sum', 'count']
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, label_names, label_values):
+        lines = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(
+                self.upper_bounds + (float('inf'),), self.bucket_counts):
+            cumulative_count += bucket_count
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(label_names, label_values,
+                                     'le="%s"' % (_format_value(upper_bound),)),
+                cumulative_count))
+        lines.append('%s_sum%s %s' % (
+            name, _format_labels(label_names, label_values), _format_value(self.sum)))
+        lines.append('%s_count%s %d' % (
+            name, _format_labels(label_names, label_values), self.count))
+        return lines
+
+class Histogram(_Metric):
+    ''' Counts observations, such as latencies, in buckets. '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names, buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.upper_bounds = tuple(sorted(buckets))
+
+    def _make_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        ''' Observe a value for an unlabelled histogram. '''
+        self.labels().observe(value)
+
+class _Registry(object):
+    ''' Holds every metric, and serves them over HTTP. '''
+    instance = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._metrics = {} # Maps names to metrics
+        self._runner = None
+
+    def register(self, name, metric_class, documentation, label_names, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_class(
+                name, documentation, label_names, **kwargs)
+        return metric
+
+    def render(self):
+        ''' Return every metric in the Prometheus text format. '''
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        lines.append('')
+        return '\n'.join(lines)
+
+    async def _handle_metrics_request(self, request):
+        return aiohttp.web.Response(
+            text=self.render(), content_type='text/plain', charset='utf-8',
+            headers={'X-Content-Format': 'prometheus-0.0.4'})
+
+    async def start_server(self, host, port):
+        ''' Serve metrics at http://<host>:<port>/metrics. '''
+        if self._runner is not None:
+            return
+        app = aiohttp.web.Application()
+        app.router.add_get('/metrics', self._handle_metrics_request)
+        self._runner = aiohttp.web.AppRunner(app)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, host, port).start()
+        self.logger.info("Serving metrics at http://%s:%d/metrics", host, port)
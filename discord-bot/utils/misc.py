@@ -1,8 +1,9 @@
 ''' Utility methods which don't belong elsewhere.
 '''
-import logging
 import sys
-import traceback
+
+# Discord refuses messages longer than this
+max_message_length = 2000
 
 def get_required_bot_permissions_value():
     ''' Get a permissions value as an integer that can be inserted in a Discord URL to
@@ -15,6 +16,7 @@ def get_required_bot_permissions_value():
         + (1 << 18) # 0x00020000 MENTION_EVERYONE
         + (1 << 19) # 0x00040000 USE_EXTERNAL_EMOJIS
         + (1 << 28) # 0x10000000 MANAGE_ROLES
+        + (1 << 29) # 0x20000000 MANAGE_WEBHOOKS
     )
     return permissions
 
@@ -23,10 +25,27 @@ def get_invite_link(client_id):
     return 'https://discordapp.com/oauth2/authorize?&client_id=%s&scope=bot&permissions=%s' % (
             client_id, perm_value)
 
+def split_into_code_blocks(text, max_length=max_message_length):
+    ''' Split text into a list of messages, each a code block no longer than max_length.
+        Lines are kept whole unless a single line is too long.
+    '''
+    max_content_length = max_length - len("```\n\n```")
+    chunks = []
+    current_lines = []
+    current_length = 0
+    for line in text.splitlines():
+        line = line[:max_content_length]
+        if current_lines and current_length + 1 + len(line) > max_content_length:
+            chunks.append('\n'.join(current_lines))
+            current_lines, current_length = [], 0
+        current_length += len(line) + (1 if current_lines else 0)
+        current_lines.append(line)
+    if current_lines:
+        chunks.append('\n'.join(current_lines))
+    return ["```\n%s\n```" % (chunk,) for chunk in chunks]
+
 def log_traceback(logger):
-    trace = traceback.extract_tb(sys.exc_info()[2])
-    logger.error('Traceback: ')
-    # Lines are four part tuples (file, linenum, funcname, text)
-    for line in trace:
-        logger.error('%s %d %s ', line[0], line[1], line[2])
-        logger.error('    %s', line[3])
+    ''' Log the exception being handled, with its traceback, as a single record. '''
+    if sys.exc_info()[0] is None:
+        return
+    logger.error('Traceback: ', exc_info=True)
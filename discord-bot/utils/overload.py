@@ -0,0 +1,154 @@
+""" Shedding of optional work while the bot is overloaded.
+
+    The controller periodically compares event loop lag and the number of pending asyncio tasks
+    with a threshold for each overload level. Each level sheds more work:
+
+    1. Tracing, and debug logging that's costly to prepare.
+    2. Also defers stream notifications into larger batches and pauses Twitter prefetching.
+    3. Also pauses Tweet scheduling and ignores member commands. Admin and officer commands
+       are always served.
+
+    The level rises as soon as a threshold is crossed, and falls one level at a time once lag
+    and pending tasks stay well below the current level's threshold, so it doesn't flap.
+"""
+import collections
+import logging
+
+import asyncio
+
+import utils.config
+import utils.loop_monitor
+import utils.metrics
+import utils.misc
+
+level_normal = 0
+level_shed_tracing = 1
+level_defer_background = 2
+level_pause_scheduler = 3
+
+# Thresholds for entering each level above normal: lag percentile in seconds, pending tasks
+default_tiers = (
+    {"lag": 0.1, "tasks": 1000},
+    {"lag": 0.25, "tasks": 2500},
+    {"lag": 0.5, "tasks": 5000},
+)
+# How often to evaluate load, in seconds
+default_evaluation_interval = 5
+# Lag is measured as this percentile of the samples since the last evaluation
+default_lag_quantile = 0.9
+# Step down a level once lag and pending tasks are below this fraction of its thresholds...
+default_recovery_ratio = 0.5
+# ...for this many evaluations in a row
+default_recovery_evaluations = 3
+
+overload_level = utils.metrics.gauge(
+    "discord_bot_overload_level",
+    "Current overload level. 0 is normal and higher levels shed more optional work.")
+overload_transitions = utils.metrics.counter(
+    "discord_bot_overload_transitions_total",
+    "Overload level changes, by previous and new level",
+    ("from_level", "to_level"))
+
+def get():
+    """ Return the OverloadController object. """
+    if not _OverloadController.instance:
+        _OverloadController.instance = _OverloadController()
+    return _OverloadController.instance
+
+class _OverloadController(object):
+    ''' Tracks the overload level, which other modules check before doing optional work. '''
+    instance = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.config = utils.config.get()
+
+        overload_config = self.config.get_overload_config() or {}
+        self.tiers = overload_config.get("tiers", default_tiers)
+        self.evaluation_interval = overload_config.get(
+            "evaluation_interval", default_evaluation_interval)
+        self.lag_quantile = overload_config.get("lag_quantile", default_lag_quantile)
+        self.recovery_ratio = overload_config.get("recovery_ratio", default_recovery_ratio)
+        self.recovery_evaluations = overload_config.get(
+            "recovery_evaluations", default_recovery_evaluations)
+
+        self.level = level_normal
+        self._calm_evaluations = 0
+        self.transition_counts = collections.Counter() # Keyed by (from_level, to_level)
+        self._task = None
+        overload_level.set(self.level)
+
+    def start(self):
+        """ Start the controller task if it isn't already running. """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    def is_tracing_enabled(self):
+        ''' Return False if tracing and costly debug logging should be skipped. '''
+        return self.level < level_shed_tracing
+
+    def is_background_work_deferred(self):
+        ''' Return True if stream notifications should be batched for longer and Twitter
+            prefetching should pause.
+        '''
+        return self.level >= level_defer_background
+
+    def is_scheduler_paused(self):
+        ''' Return True if Tweet scheduling and member commands should pause. '''
+        return self.level >= level_pause_scheduler
+
+    def _get_level_for_load(self, lag, pending_tasks, ratio=1.0):
+        ''' Return the highest level whose thresholds, scaled by ratio, are reached. '''
+        level = level_normal
+        for tier_level, tier in enumerate(self.tiers, start=1):
+            if lag >= tier["lag"] * ratio or pending_tasks >= tier["tasks"] * ratio:
+                level = tier_level
+        return level
+
+    def evaluate(self, lag, pending_tasks):
+        ''' Update the level for the latest load measurements. Returns the new level. '''
+        new_level = self.level
+        load_level = self._get_level_for_load(lag, pending_tasks)
+        if load_level > self.level:
+            # Shed load straight away
+            new_level = load_level
+            self._calm_evaluations = 0
+
+        elif self.level > level_normal:
+            # Only recover once load is well below what caused the current level
+            if self._get_level_for_load(lag, pending_tasks, self.recovery_ratio) < self.level:
+                self._calm_evaluations += 1
+            else:
+                self._calm_evaluations = 0
+            if self._calm_evaluations >= self.recovery_evaluations:
+                new_level = self.level - 1
+                self._calm_evaluations = 0
+
+        if new_level != self.level:
+            log = self.logger.warning if new_level > self.level else self.logger.info
+            log("Overload level changing from %d to %d (lag %.3fs, %d pending tasks)",
+                self.level, new_level, lag, pending_tasks)
+            self.transition_counts[(self.level, new_level)] += 1
+            overload_transitions.labels(str(self.level), str(new_level)).inc()
+            self.level = new_level
+            overload_level.set(new_level)
+        return self.level
+
+    async def run(self):
+        """ Evaluate load periodically. """
+        loop_monitor = utils.loop_monitor.get()
+        while True:
+            try:
+                await asyncio.sleep(self.evaluation_interval)
+                sample_count = int(self.evaluation_interval / loop_monitor.sample_interval)
+                lag = loop_monitor.get_lag_percentile(self.lag_quantile, sample_count)
+                pending_tasks = sum(1 for task in asyncio.Task.all_tasks() if not task.done())
+                self.evaluate(lag, pending_tasks)
+
+            # The only scenario we should abort is when asyncio cancels us
+            except asyncio.CancelledError:
+                break
+
+            except Exception as exc:
+                self.logger.info("Exception in _OverloadController.run: %r", exc)
+                utils.misc.log_traceback(self.logger)
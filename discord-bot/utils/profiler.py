@@ -0,0 +1,94 @@
+""" On-demand CPU profiling of the running bot.
+
+    cProfile profiles the thread it's enabled on, and everything on the event loop runs on that
+    thread, so enabling it while sleeping for the profiling window captures whatever every task
+    and callback did meanwhile. A coroutine's time is counted from each resumption to its next
+    suspension, so time spent awaiting isn't attributed to it.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+
+import asyncio
+
+import utils.config
+
+default_output_dir = "profiles"
+default_max_seconds = 60
+default_top_n = 25
+# Profiling slows every guild down, so after each profile others must wait this many seconds
+default_cooldown = 10 * 60 # 10 minutes
+
+_profile_in_progress = False
+_last_profile_end_time = None
+
+def is_enabled():
+    """ Return True if profiling is configured. """
+    return utils.config.get().get_profiling_config() is not None
+
+def get_max_seconds():
+    """ Return the longest allowed profiling window, in seconds. """
+    profiling_config = utils.config.get().get_profiling_config() or {}
+    return profiling_config.get("max_seconds", default_max_seconds)
+
+def get_cooldown_remaining():
+    """ Return how many seconds must pass before another profile may be taken, or 0. """
+    if _last_profile_end_time is None:
+        return 0
+    profiling_config = utils.config.get().get_profiling_config() or {}
+    cooldown = profiling_config.get("cooldown", default_cooldown)
+    return max(_last_profile_end_time + cooldown - time.monotonic(), 0)
+
+async def profile_event_loop(seconds, name_prefix="profile"):
+    """ Profile everything the event loop runs for some seconds.
+        Returns a two part tuple: (result, error_reason).
+        - On success, result is a two-part tuple: (summary, path), where summary is the top
+          functions by cumulative time and path is where the raw profile was saved, and
+          error_reason is None.
+        - On failure, result is None and error_reason explains why.
+    """
+    global _profile_in_progress, _last_profile_end_time
+    logger = logging.getLogger(__name__)
+    profiling_config = utils.config.get().get_profiling_config() or {}
+    output_dir = profiling_config.get("output_dir", default_output_dir)
+    top_n = profiling_config.get("top_n", default_top_n)
+
+    # Only one profiler can be active at once
+    if _profile_in_progress:
+        return (None, "A profile is already being taken, try again shortly!")
+
+    cooldown_remaining = get_cooldown_remaining()
+    if cooldown_remaining:
+        return (None, "A profile was taken recently, try again in %d seconds!" % (
+            cooldown_remaining + 1,))
+
+    _profile_in_progress = True
+    profiler = cProfile.Profile()
+    try:
+        logger.info("Profiling the event loop for %s seconds", seconds)
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    finally:
+        _profile_in_progress = False
+        _last_profile_end_time = time.monotonic()
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, "%s-%s.pstats" % (
+            name_prefix, time.strftime("%Y%m%d-%H%M%S")))
+        profiler.dump_stats(path)
+    except OSError as exc:
+        logger.warning("Couldn't save profile: %r", exc)
+        return (None, "Couldn't save the profile: %s" % (exc,))
+    logger.info("Saved profile to %r", path)
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(top_n)
+    return ((stream.getvalue().strip(), path), None)
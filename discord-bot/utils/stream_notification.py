@@ -1,99 +1,325 @@
 """ Utilities to notify Discord chatrooms when members begin streaming. """
+import asyncio
 import discord
+import heapq
 import logging
 
+import utils.config
 import utils.member
 import utils.guild
+import utils.memory
+import utils.metrics
+import utils.misc
+import utils.overload
+import utils.webhook
+
+# A stream is announced this many seconds after it starts, unless it stopped again meanwhile.
+# Streams that come due together are announced together.
+default_debounce_window = 10
+# While overloaded, stream starts wait this long instead, making fewer, larger batches
+default_overload_debounce_window = 60
+max_message_length = 2000
+
+stream_notification_events = utils.metrics.counter(
+    "discord_bot_stream_notification_events_total",
+    "Stream notification activity: member updates seen and filtered by the fast path, streams "
+    "debounced, adverts made and messages sent",
+    ("kind",))
+
+def _has_stream(activities):
+    """ Return True if any of the activities is a stream. """
+    for activity in activities:
+        if isinstance(activity, discord.Streaming):
+            return True
+    return False
 
 class StreamNotifications(object):
     def __init__(self, client):
         self.logger = logging.getLogger(__name__)
         self.client = client
+        # IDs of users we've seen streaming. Streaming is a property of a user, not of their
+        # membership of one guild, so a user in many guilds is tracked once.
+        # Only streaming users are tracked, so this stays small.
+        self._streaming_user_ids = set()
+        # Maps user IDs to the IDs of the guilds they share with the bot, so notifications only
+        # visit the user's own guilds
+        self._user_guild_ids = {}
+
+        stream_notifications_config = utils.config.get().get_stream_notifications_config() or {}
+        self.debounce_window = stream_notifications_config.get(
+            "debounce_window", default_debounce_window)
+        self.overload_debounce_window = stream_notifications_config.get(
+            "overload_debounce_window", default_overload_debounce_window)
+        self._pending_members = {} # Maps user IDs to members whose streams await announcement
+        self._due_times = [] # Heap of (due_time, user_id) tuples for the pending members
+        self._flush_handle = None # Timer for the next flush, or None
+        utils.memory.register_cache(
+            "stream_streaming_user_ids", lambda: self._streaming_user_ids)
+        utils.memory.register_cache("stream_pending_members", lambda: self._pending_members)
+        utils.memory.register_cache("stream_user_guild_ids", lambda: self._user_guild_ids)
+
+        self.member_update_count = 0
+        self.filtered_member_update_count = 0
+        self.debounced_stream_count = 0 # Streams that stopped before being announced
+        self.advert_count = 0 # Streams announced, counted once per channel
+        self.sent_message_count = 0 # Messages sent, each announcing one or more streams
+        stream_notification_events.set_function(self._get_event_counts)
+
+    def _get_event_counts(self):
+        ''' Return event counts in the form expected by Metric.set_function. '''
+        return [
+            (("member_update",), self.member_update_count),
+            (("filtered_member_update",), self.filtered_member_update_count),
+            (("debounced_stream",), self.debounced_stream_count),
+            (("advert",), self.advert_count),
+            (("sent_message",), self.sent_message_count),
+        ]
+
+    def snapshot_streaming_state(self):
+        ''' Record who is streaming right now, and which guilds each user is in, from the client's
+            member cache. Call this when the gateway connection is (re)established, so that
+            streams which were already live aren't mistaken for new ones as presence updates
+            arrive.
+        '''
+        streaming_user_ids = set()
+        user_guild_ids = {}
+        for guild in self.client.guilds:
+            for member in guild.members:
+                user_guild_ids.setdefault(member.id, set()).add(guild.id)
+                if member.id not in streaming_user_ids and _has_stream(member.activities):
+                    streaming_user_ids.add(member.id)
+        self._user_guild_ids = user_guild_ids
+
+        self.logger.info("Stream notifications: %d users are streaming (previously %d)",
+                         len(streaming_user_ids), len(self._streaming_user_ids))
+        self._streaming_user_ids = streaming_user_ids
+
+    def add_member(self, member):
+        ''' Call when a member joins a guild. '''
+        self._user_guild_ids.setdefault(member.id, set()).add(member.guild.id)
+
+    def remove_member(self, member):
+        ''' Call when a member leaves a guild. '''
+        guild_ids = self._user_guild_ids.get(member.id)
+        if guild_ids is None:
+            return
+        guild_ids.discard(member.guild.id)
+        if not guild_ids:
+            del self._user_guild_ids[member.id]
+
+    def add_guild(self, guild):
+        ''' Call when the bot joins a guild. '''
+        for member in guild.members:
+            self.add_member(member)
+
+    def remove_guild(self, guild):
+        ''' Call when the bot leaves a guild. '''
+        for member in guild.members:
+            self.remove_member(member)
 
     def is_member_starting_to_stream(self, member_before, member_after):
-        ''' Return True if the member just began streaming, or False otherwise.
+        ''' Return True if the member's user just began streaming, or False otherwise.
+            A user who shares several guilds with the bot produces an update per guild, but
+            only the first of them returns True.
         '''
-        self.logger.debug('In utils.stream_notification.StreamNotifications.isMemberStartingToStream')
-        try:
-            is_streaming = any((isinstance(x, discord.Streaming) for x in member_after.activities))
-        except Exception:
-            # Not playing a game
+        self.member_update_count += 1
+
+        # Nickname and role updates share the activities tuple with the previous member state,
+        # so they can't have started a stream
+        activities = member_after.activities
+        if activities is member_before.activities:
+            self.filtered_member_update_count += 1
             return False
 
-        was_streaming = False
-        try:
-            was_streaming = any((isinstance(x, discord.Streaming) for x in member_before.activities))
-        except Exception:
-            pass
+        user_id = member_after.id
+        was_tracked = user_id in self._streaming_user_ids
+        is_streaming = _has_stream(activities)
+
+        # Most presence updates are status or game changes with no change in streaming state,
+        # and updates from the user's other guilds repeat a transition we've already seen
+        if is_streaming == was_tracked:
+            self.filtered_member_update_count += 1
+            return False
+
+        if not is_streaming:
+            self._streaming_user_ids.discard(user_id)
+            return False
 
-        # Detect when a member's state changes from non-streaming to streaming
-        return was_streaming == False and is_streaming == True
+        self._streaming_user_ids.add(user_id)
+
+        # Users who were already streaming before we started tracking them aren't starting now
+        self.logger.debug('utils.stream_notification.StreamNotifications.'
+                          'is_member_starting_to_stream: user %r started streaming', user_id)
+        return not _has_stream(member_before.activities)
 
     async def on_member_update(self, member_before, member_after):
         ''' Call whenever a Member is updated.
         '''
-        # Stream start check
+        # Stream start check, once per user
         if not self.is_member_starting_to_stream(member_before, member_after):
             return
 
-        # Permissions check
-        self.logger.debug('utils.stream_notification.StreamNotifications.onMemberUpdate: '
-                          'Permissions check')
-        guild = member_after.guild
-        guild_data = utils.guild.get(guild)
-        if not guild_data.user_has_member_permissions(member_after):
+        # Wait out this member's debounce window. A user who restarts their stream in the
+        # meantime keeps their original due time, and is still only announced once.
+        user_id = member_after.id
+        is_pending = user_id in self._pending_members
+        self._pending_members[user_id] = member_after
+        if is_pending:
             return
 
-        # Decide whether to advertise the member's stream
-        self.logger.debug('utils.stream_notification.StreamNotifications.onMemberUpdate: '
-                          'Should advertise stream check')
-        member_data = utils.member.get(member_after)
-        if not member_data.should_advertise_stream():
-            return
+        if utils.overload.get().is_background_work_deferred():
+            window = self.overload_debounce_window
+        else:
+            window = self.debounce_window
+        due_time = asyncio.get_event_loop().time() + window
+        # Windows differ while overloaded, so this may be due before the others
+        is_earliest = not self._due_times or due_time < self._due_times[0][0]
+        heapq.heappush(self._due_times, (due_time, user_id))
+        if is_earliest:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        ''' Arm the flush timer for the earliest due time, replacing any previous timer. '''
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._due_times:
+            self._flush_handle = asyncio.get_event_loop().call_at(
+                self._due_times[0][0], self._on_flush_timer)
 
-        self.logger.debug('utils.stream_notification.StreamNotifications.onMemberUpdate: '
-                          'Calling self.advertiseStream')
-        await self.advertise_stream(member_after)
+    def _on_flush_timer(self):
+        self._flush_handle = None
+        asyncio.ensure_future(self._flush_due_members())
 
-    async def advertise_stream(self, member):
-        ''' Advertise a stream in the Discord guild of the streaming member.
+    async def _flush_due_members(self):
+        ''' Announce the streams whose debounce windows have elapsed, then re-arm the timer
+            for the next due member.
         '''
-        self.logger.debug('In utils.stream_notification.StreamNotifications.advertiseStream')
-        guild_data = utils.guild.get(member.guild)
-        notification_channel_name = guild_data.get_twitch_data("channel")
-        notification_channel = guild_data.get_text_channel_from_name(notification_channel_name)
-        if not notification_channel:
-            return None
+        try:
+            now = asyncio.get_event_loop().time()
+            members = []
+            while self._due_times and self._due_times[0][0] <= now:
+                _, user_id = heapq.heappop(self._due_times)
+                member = self._pending_members.pop(user_id)
+                # Drop streams that have stopped since they started
+                if user_id in self._streaming_user_ids:
+                    members.append(member)
+                else:
+                    self.debounced_stream_count += 1
+            self._schedule_flush()
+
+            await self.advertise_streams(members)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as exc:
+            self.logger.info("Exception in StreamNotifications._flush_due_members: %r", exc)
+            utils.misc.log_traceback(self.logger)
+
+    def _get_notification_targets(self, user_id):
+        ''' Return a list of two-part tuples: [(member, notification_channel), ...] for each
+            guild the user is a member of, with permission to be advertised and a configured
+            notification channel. Only in-memory data is used.
+        '''
+        targets = []
+        for guild_id in self._user_guild_ids.get(user_id, ()):
+            guild = self.client.get_guild(guild_id)
+            if guild is None:
+                continue
+            member = guild.get_member(user_id)
+            if member is None:
+                continue
+
+            guild_data = utils.guild.get(guild)
+            notification_channel = guild_data.get_text_channel_from_name(
+                guild_data.get_twitch_data("channel"))
+            if not notification_channel:
+                continue
+
+            if not guild_data.user_has_member_permissions(member):
+                continue
 
-        member_name = member.nick or member.name
+            targets.append((member, notification_channel))
+        return targets
 
-        stream_name = None
-        stream_url = None
+    @staticmethod
+    def _get_stream_details(member):
+        ''' Return a two-part tuple: (stream_name, stream_url), or (None, None). '''
         for x in member.activities:
             if isinstance(x, discord.Streaming):
-                stream_name = x.name
-                stream_url = x.url
-                break
-
-        # Abort early if we couldn't get the stream data
-        if not stream_url:
-            self.logger.debug('utils.stream_notification.StreamNotifications.advertiseStream: '
-                              'aborting early: could not detect stream URL')
+                return (x.name, x.url)
+        return (None, None)
+
+    async def advertise_streams(self, members):
+        ''' Advertise the streams of several users in every Discord guild each is a member of.
+            Streams announced in the same channel are combined into one message.
+        '''
+        self.logger.debug('In utils.stream_notification.StreamNotifications.advertiseStreams')
+        targets = [] # (guild_member, notification_channel, stream_name, stream_url) tuples
+        for member in members:
+            stream_name, stream_url = self._get_stream_details(member)
+            # Skip if we couldn't get the stream data
+            if not stream_url:
+                self.logger.debug('utils.stream_notification.StreamNotifications.'
+                                  'advertiseStreams: could not detect stream URL')
+                continue
+
+            for guild_member, notification_channel in self._get_notification_targets(member.id):
+                targets.append((guild_member, notification_channel, stream_name, stream_url))
+
+        if not targets:
+            return
+
+        # Decide which guilds to advertise each stream in, loading cooldowns in one round trip
+        member_data_list = utils.member.get_many([target[0] for target in targets])
+        advertised = [(target, member_data) for target, member_data in zip(
+                      targets, member_data_list) if member_data.should_advertise_stream()]
+        if not advertised:
             return
 
-        # Update timestamp first to minimise chance of race conditions while
-        # waiting for the advert message to be successfully sent
-        self.logger.debug('utils.stream_notification.StreamNotifications.advertiseStream: '
-                          'Updating last stream notify time')
-        member_data = utils.member.get(member)
-        member_data.update_last_stream_notify_time()
-
-        # Now advertise in the configured channel
-        self.logger.debug('utils.stream_notification.StreamNotifications.advertiseStream: '
-                          'Sending stream advert message')
-        await notification_channel.send(
-            '\n'.join([
+        # Update timestamps first to minimise chance of race conditions while
+        # waiting for the advert messages to be successfully sent
+        self.logger.debug('utils.stream_notification.StreamNotifications.advertiseStreams: '
+                          'Updating last stream notify time for %d adverts', len(advertised))
+        utils.member.update_last_stream_notify_times(
+            [member_data for _, member_data in advertised])
+
+        # Group the adverts by channel
+        channel_adverts = {} # Maps channel IDs to (channel, [advert, ...]) tuples
+        for (guild_member, notification_channel, stream_name, stream_url), _ in advertised:
+            member_name = guild_member.nick or guild_member.name
+            advert = '\n'.join([
                 '%s is streaming **%s**:' % (member_name, stream_name),
                 stream_url
             ])
-        )
+            channel_adverts.setdefault(
+                notification_channel.id, (notification_channel, []))[1].append(advert)
+
+        # Now advertise in the configured channels
+        self.logger.debug('utils.stream_notification.StreamNotifications.advertiseStreams: '
+                          'Sending stream advert messages to %d channels', len(channel_adverts))
+        channels = [channel for channel, _ in channel_adverts.values()]
+        results = await asyncio.gather(*[
+            self._send_adverts(channel, adverts) for channel, adverts in channel_adverts.values()
+        ], return_exceptions=True)
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                self.logger.warning('Failed to advertise streams in guild %r: %r',
+                                    channel.guild.name, result)
+
+    async def _send_adverts(self, notification_channel, adverts):
+        ''' Send adverts to a channel in as few messages as possible. '''
+        guild_data = utils.guild.get(notification_channel.guild)
+        messages = []
+        for advert in adverts:
+            if messages and len(messages[-1]) + len(advert) + 2 <= max_message_length:
+                messages[-1] = '\n\n'.join([messages[-1], advert])
+            else:
+                messages.append(advert)
+
+        self.advert_count += len(adverts)
+        for message in messages:
+            self.sent_message_count += 1
+            await utils.webhook.get().send(guild_data, notification_channel, message,
+                                           purpose="stream_notification")
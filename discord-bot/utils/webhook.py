@@ -0,0 +1,108 @@
+""" Posting of scheduled and notification messages through channel webhooks.
+
+    Webhooks are rate limited separately from the bot's own messages, so a burst of
+    notifications sent this way doesn't hold up replies to commands. Guilds opt in with
+    `!admin webhook on`, and otherwise messages are sent as the bot.
+"""
+import logging
+import time
+
+import aiohttp
+import asyncio
+import discord
+
+import utils.metrics
+
+# After being refused permission to use webhooks in a channel, send as the bot there for this
+# many seconds before trying again
+forbidden_backoff = 3600
+
+sent_messages = utils.metrics.counter(
+    "discord_bot_sent_messages_total",
+    "Messages sent, by purpose and by whether they were sent through a webhook or as the "
+    "bot. Replies to commands have the purposes reply and private_reply.",
+    ("purpose", "via"))
+
+def get():
+    """ Return the WebhookSender object. """
+    if not _WebhookSender.instance:
+        _WebhookSender.instance = _WebhookSender()
+    return _WebhookSender.instance
+
+class _WebhookSender(object):
+    ''' Sends messages through a cached webhook per channel, creating it when first needed. '''
+    instance = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.session = None
+        # Maps channel IDs to locks, so concurrent sends to a channel create one webhook
+        self._creation_locks = {}
+        # Maps channel IDs to when we may next try webhooks there, after being refused
+        self._forbidden_until = {}
+
+    def _get_session(self):
+        ''' Retrieve the AIOHTTP client session used for webhook requests. '''
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def _get_webhook(self, guild_data, channel):
+        ''' Return a Webhook for the channel, creating one if the guild doesn't have one cached. '''
+        webhook_url = guild_data.get_webhook_url(channel)
+        if not webhook_url:
+            lock = self._creation_locks.setdefault(channel.id, asyncio.Lock())
+            async with lock:
+                # Another send may have created it while we waited
+                webhook_url = guild_data.get_webhook_url(channel)
+                if not webhook_url:
+                    self.logger.info("Creating a webhook for channel %r in guild %r",
+                                     channel.name, channel.guild.name)
+                    webhook = await channel.create_webhook(name=channel.guild.me.name)
+                    webhook_url = webhook.url
+                    guild_data.set_webhook_url(channel, webhook_url)
+
+        return discord.Webhook.from_url(
+            webhook_url, adapter=discord.AsyncWebhookAdapter(self._get_session()))
+
+    async def send(self, guild_data, channel, content, purpose="other"):
+        ''' Send a message to a channel, through its webhook if the guild has enabled webhook
+            posting, otherwise as the bot. Falls back to sending as the bot if the webhook
+            can't be created or used. purpose labels the message in metrics.
+        '''
+        if not guild_data.get_webhook_posting_enabled():
+            return await self._send_as_bot(channel, content, purpose)
+
+        forbidden_until = self._forbidden_until.get(channel.id)
+        if forbidden_until is not None:
+            if time.monotonic() < forbidden_until:
+                return await self._send_as_bot(channel, content, purpose)
+            del self._forbidden_until[channel.id]
+
+        try:
+            webhook = await self._get_webhook(guild_data, channel)
+            me = channel.guild.me
+            message = await webhook.send(content, username=me.display_name,
+                                         avatar_url=str(me.avatar_url))
+            sent_messages.labels(purpose, "webhook").inc()
+            return message
+
+        except discord.NotFound:
+            # The webhook was deleted, so make a new one next time
+            self.logger.warning("Webhook for channel %r in guild %r no longer exists",
+                                channel.name, channel.guild.name)
+            guild_data.set_webhook_url(channel, '')
+
+        except discord.Forbidden:
+            self.logger.warning("Not allowed to use webhooks in channel %r in guild %r, sending "
+                                "as the bot there for %d seconds", channel.name,
+                                channel.guild.name, forbidden_backoff)
+            self._forbidden_until[channel.id] = time.monotonic() + forbidden_backoff
+
+        return await self._send_as_bot(channel, content, purpose)
+
+    @staticmethod
+    async def _send_as_bot(channel, content, purpose):
+        message = await channel.send(content)
+        sent_messages.labels(purpose, "bot").inc()
+        return message